@@ -0,0 +1,481 @@
+"""
+🏋️ Нагрузочный тест Flower Dashboard Bot.
+
+N параллельных «менеджеров» проходят через настоящие хендлеры dp:
+полный отчёт (город → … → 14 оплат → ✅ Записать), вставку смен и
+маркетинга. Telegram подменяется локальным HTTP-сервером Bot API
+(aiogram ходит в него через TelegramAPIServer), Google Sheets — таким же
+сервером REST API для асинхронного клиента и фейковым клиентом gspread
+(лист сводки); у обоих задержка и случайные 429.
+
+    python bench_bot.py --users 50 --latency 300 --error-rate 0.05
+
+Печатает p50/p95/p99 задержки хендлеров по шагам, пропускную
+способность, число запросов к Sheets на отчёт, память на сессию и
+обращения к хранилищу FSM на апдейт со снимком и без.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from datetime import datetime
+
+# Базы бота — во временную папку, токен — любой валидный по формату
+_tmp = tempfile.mkdtemp(prefix="bench_bot_")
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARKBENCHMARKBENCHMARKBENCH")
+os.environ.setdefault("METRICS_PORT", "0")
+for var, name in (("JOURNAL_DB", "journal.db"), ("FSM_DB", "fsm.db"), ("REPLICA_DB", "replica.db")):
+    os.environ[var] = os.path.join(_tmp, name)
+
+# Бот импортируем первым, чтобы замер включал aiogram и всё остальное
+_import_start = time.perf_counter()
+import bot_v2                                   # noqa: E402
+IMPORT_TIME = time.perf_counter() - _import_start
+
+import gspread                                  # noqa: E402
+import requests                                 # noqa: E402
+from aiogram import Bot, types                  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer      # noqa: E402
+from aiohttp import web                         # noqa: E402
+
+# ============================================================
+# 📡  ФЕЙКОВЫЙ BOT API
+# ============================================================
+class FakeTelegram:
+    def __init__(self):
+        self.calls: Counter[str] = Counter()
+        self._msg_id = 0
+
+    def _message(self, chat_id, text) -> dict:
+        self._msg_id += 1
+        return {"message_id": self._msg_id, "date": int(time.time()),
+                "chat": {"id": int(chat_id), "type": "private"}, "text": text or ""}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        form = await request.post()
+        if method in ("sendMessage", "editMessageText"):
+            result = self._message(form.get("chat_id", 0), form.get("text"))
+        elif method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self) -> tuple[web.AppRunner, str]:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return runner, f"http://127.0.0.1:{port}"
+
+# ============================================================
+# 🗂️  ФЕЙКОВЫЙ GOOGLE SHEETS
+# ============================================================
+class FakeSheets:
+    """Клиент gspread в памяти: каждый «HTTP-запрос» спит latency секунд
+    и с вероятностью error_rate отвечает 429."""
+
+    def __init__(self, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls: Counter[str] = Counter()
+        self.errors = 0
+        self.rows: dict[tuple[str, str], list[list]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def request(self, kind: str):
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls[kind] += 1
+            if random.random() < self.error_rate:
+                self.errors += 1
+                resp = requests.Response()
+                resp.status_code = 429
+                resp._content = json.dumps(
+                    {"error": {"code": 429, "message": "Quota exceeded", "status": "RESOURCE_EXHAUSTED"}}
+                ).encode()
+                raise gspread.exceptions.APIError(resp)
+
+    def open_by_key(self, sid: str):
+        self.request("open_by_key")
+        return FakeSpreadsheet(self, sid)
+
+    # --- REST API (асинхронный клиент бота) ---
+    async def arequest(self, kind: str) -> web.Response | None:
+        await asyncio.sleep(self.latency)
+        with self._lock:
+            self.calls[kind] += 1
+            if random.random() < self.error_rate:
+                self.errors += 1
+                return web.json_response({"error": {"code": 429, "message": "Quota exceeded",
+                                                    "status": "RESOURCE_EXHAUSTED"}}, status=429)
+        return None
+
+    @staticmethod
+    def _range(rng: str) -> tuple[str, str, int]:
+        """"'Лист'!Z5:Z" → (лист, колонка, первая строка)."""
+        m = re.fullmatch(r"'((?:[^']|'')*)'(?:!([A-Z]+)(\d+))?.*", rng)
+        return m.group(1).replace("''", "'"), m.group(2) or "A", int(m.group(3) or 1)
+
+    async def rest_titles(self, request: web.Request) -> web.Response:
+        if err := await self.arequest("titles"):
+            return err
+        return web.json_response({"sheets": [
+            {"properties": {"title": t, "sheetId": i,
+                            "gridProperties": {"rowCount": 100_000, "columnCount": 40}}}
+            for i, t in enumerate(FakeSpreadsheet.TITLES)
+        ]})
+
+    async def rest_structure(self, request: web.Request) -> web.Response:
+        if err := await self.arequest("batch_update_spreadsheet"):
+            return err
+        replies = []
+        for r in (await request.json())["requests"]:
+            add = r.get("addSheet")
+            replies.append({"addSheet": {"properties": {**add["properties"], "sheetId": 99}}}
+                           if add else {})
+        return web.json_response({"replies": replies})
+
+    async def rest_get(self, request: web.Request) -> web.Response:
+        if err := await self.arequest("get"):
+            return err
+        sheet, col, start = self._range(request.match_info["rng"])
+        with self._lock:
+            rows = [list(r) for r in self.rows[(request.match_info["sid"], sheet)][start - 1:]]
+        if col != "A":                         # одна колонка: поиск ключей отправки
+            i = ord(col) - ord("A")
+            rows = [[r[i]] if len(r) > i and r[i] else [] for r in rows]
+        return web.json_response({"values": rows})
+
+    async def rest_batch_get(self, request: web.Request) -> web.Response:
+        if err := await self.arequest("batch_get"):
+            return err
+        out = []
+        with self._lock:
+            for rng in request.query.getall("ranges", []):
+                sheet, _, n = self._range(rng)
+                rows = self.rows[(request.match_info["sid"], sheet)]
+                out.append({"range": rng, "values": [list(rows[n - 1])] if n <= len(rows) else []})
+        return web.json_response({"valueRanges": out})
+
+    async def rest_append(self, request: web.Request) -> web.Response:
+        if err := await self.arequest("append_rows"):
+            return err
+        sheet = self._range(request.match_info["rng"])[0]
+        values = (await request.json())["values"]
+        with self._lock:
+            rows = self.rows[(request.match_info["sid"], sheet)]
+            start = len(rows) + 1
+            rows.extend(values)
+        return web.json_response({"updates": {
+            "updatedRange": f"'{sheet}'!A{start}:Z{start + len(values) - 1}"}})
+
+    async def rest_batch_update(self, request: web.Request) -> web.Response:
+        if err := await self.arequest("batch_update"):
+            return err
+        body = await request.json()
+        with self._lock:
+            for d in body["data"]:
+                sheet, _, n = self._range(d["range"])
+                rows = self.rows[(request.match_info["sid"], sheet)]
+                rows.extend([] for _ in range(n + len(d["values"]) - 1 - len(rows)))
+                rows[n - 1:n - 1 + len(d["values"])] = d["values"]
+        return web.json_response({})
+
+    async def start(self) -> tuple[web.AppRunner, str]:
+        app = web.Application()
+        app.router.add_get("/v4/spreadsheets/{sid}", self.rest_titles)
+        app.router.add_get("/v4/spreadsheets/{sid}/values:batchGet", self.rest_batch_get)
+        app.router.add_get("/v4/spreadsheets/{sid}/values/{rng}", self.rest_get)
+        app.router.add_post("/v4/spreadsheets/{sid}/values/{rng}:append", self.rest_append)
+        app.router.add_post("/v4/spreadsheets/{sid}/values:batchUpdate", self.rest_batch_update)
+        app.router.add_post("/v4/spreadsheets/{sid}:batchUpdate", self.rest_structure)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return runner, f"http://127.0.0.1:{port}/v4/spreadsheets"
+
+class FakeSpreadsheet:
+    TITLES = ["Продажи", "Смены флористов", "Смены логистов", "Маркетинг", "Сводка"]
+
+    def __init__(self, backend: FakeSheets, sid: str):
+        self.backend, self.id = backend, sid
+
+    def worksheet(self, title: str):
+        self.backend.request("worksheet")
+        if title not in self.TITLES:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return FakeWorksheet(self.backend, self.id, title)
+
+    def worksheets(self):
+        self.backend.request("worksheets")
+        return [FakeWorksheet(self.backend, self.id, t) for t in self.TITLES]
+
+class FakeWorksheet:
+    def __init__(self, backend: FakeSheets, sid: str, title: str):
+        self.backend, self.sid, self.title = backend, sid, title
+
+    @property
+    def _rows(self) -> list[list]:
+        return self.backend.rows[(self.sid, self.title)]
+
+    def append_rows(self, rows, value_input_option=None, **kwargs):
+        self.backend.request("append_rows")
+        with self.backend._lock:
+            start = len(self._rows) + 1
+            self._rows.extend(rows)
+        return {"updates": {"updatedRange": f"'{self.title}'!A{start}:Z{start + len(rows) - 1}"}}
+
+    def batch_update(self, data, **kwargs):
+        self.backend.request("batch_update")
+        with self.backend._lock:
+            for d in data:
+                if m := re.fullmatch(r"A(\d+)", d["range"]):   # сводка пишет и в другие колонки
+                    n = int(m.group(1))
+                    rows = self._rows
+                    rows.extend([] for _ in range(n + len(d["values"]) - 1 - len(rows)))
+                    rows[n - 1:n - 1 + len(d["values"])] = d["values"]
+        return {}
+
+    def get(self, rng: str, **kwargs):
+        self.backend.request("get")
+        start = int(rng.split(":")[0].lstrip("A"))
+        with self.backend._lock:
+            return [list(r) for r in self._rows[start - 1:]]
+
+# ============================================================
+# 👥  СЦЕНАРИИ
+# ============================================================
+_update_id = 0
+
+def make_update(uid: int, text: str) -> types.Update:
+    global _update_id
+    _update_id += 1
+    return types.Update(update_id=_update_id, message=types.Message(
+        message_id=_update_id, date=datetime.now(),
+        chat=types.Chat(id=uid, type="private"),
+        from_user=types.User(id=uid, is_bot=False, first_name=f"user{uid}"),
+        text=text,
+    ))
+
+def report_script(uid: int) -> list[tuple[str, str]]:
+    """(шаг, текст) для полного отчёта менеджера."""
+    today = datetime.now().strftime("%d.%m.%Y")
+    steps = [("start", "/start"), ("action", "📊 Отчёт менеджера"), ("city", "🏙 Астана"),
+             ("name", f"Менеджер {uid}"), ("shift", bot_v2.SHIFTS[uid % len(bot_v2.SHIFTS)]),
+             ("date", f"📅 Сегодня ({today})"), ("leads", str(random.randint(10, 80))),
+             ("orders", str(random.randint(1, 10)))]
+    steps += [("payment", f"{random.randint(0, 200)}.{random.randint(100, 999)}")
+              for _ in bot_v2.PAYMENT_STEPS]
+    steps.append(("confirm", "✅ Записать"))
+    return steps
+
+def schedule_script(uid: int) -> list[tuple[str, str]]:
+    names = "\n".join(f"Флорист {uid}-{i}" for i in range(6))
+    return [("action", "🌺 Смены флористов"), ("city", "🏔 Алматы"),
+            ("schedule", f"{datetime.now():%d.%m}\n{names}")]
+
+def marketing_script(uid: int) -> list[tuple[str, str]]:
+    lines = "\n".join(f"{d:02d}.06 100 {80 + uid % 20} 0.9 50 450" for d in range(1, 31))
+    return [("action", "🎯 Маркетинг"), ("city", "🏔 Алматы"), ("marketing", lines)]
+
+async def run_user(bot: Bot, uid: int, think: float, latencies: dict[str, list[float]]):
+    for script in (report_script(uid), schedule_script(uid), marketing_script(uid)):
+        for step, text in script:
+            t = time.perf_counter()
+            await bot_v2.dp.feed_update(bot, make_update(uid, text))
+            latencies[step].append(time.perf_counter() - t)
+            if think:
+                await asyncio.sleep(random.uniform(0, 2 * think))
+
+async def session_memory(bot: Bot, n: int) -> tuple[float, float]:
+    """Память на незавершённую сессию (на середине оплат): tracemalloc и JSON."""
+    storage = bot_v2.fsm_storage
+    base_uid = 10_000_000
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for uid in range(base_uid, base_uid + n):
+        for _, text in report_script(uid)[:8 + len(bot_v2.PAYMENT_STEPS) // 2]:
+            await bot_v2.dp.feed_update(bot, make_update(uid, text))
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    sizes = [len(json.dumps(r.data, ensure_ascii=False).encode())
+             for k, r in storage._sessions.items() if f":{base_uid}" in k]
+    return (after - before) / n, statistics.mean(sizes) if sizes else 0.0
+
+async def fsm_ops(bot: Bot, n: int) -> list[str]:
+    """Обращения к хранилищу FSM на апдейт на n отчётах (без записи):
+    обычный FSMContext против снимка на апдейт."""
+    mw, storage = bot_v2.fsm_snapshot, bot_v2.fsm_storage
+    was = mw.enabled
+    out = ["", f"FSM storage ops per update, {n} reports:"]
+    for enabled in (False, True):
+        mw.enabled, mw.updates = enabled, 0
+        storage.ops.clear()
+        for uid in range(20_000_000 + enabled * n, 20_000_000 + (enabled + 1) * n):
+            for _, text in report_script(uid)[:-1]:
+                await bot_v2.dp.feed_update(bot, make_update(uid, text))
+        ops = ", ".join(f"{op} {k}" for op, k in storage.ops.most_common())
+        out.append(f"{'snapshot' if enabled else 'plain':<9} {mw.ops_per_update():>5.2f}  ({ops})")
+    mw.enabled = was
+    return out
+
+def fsm_benchmark(n: int) -> list[str]:
+    """Прежний формат сессии (словарь, оплаты словарём) против компактного
+    на n сессиях в середине ввода оплат: байты, сериализация, память, flush."""
+    import sqlite3
+    codec = bot_v2.fsm_storage.codec
+    cities = list(bot_v2.CITIES)
+
+    def session(i: int, compact: bool) -> dict:
+        amounts = [random.randint(0, 500_000) if j < 7 else 0 for j in range(len(bot_v2.PAYMENT_COLS))]
+        return {"action": "manager", "city": cities[i % len(cities)], "name": f"Менеджер {i % 50}",
+                "shift": bot_v2.SHIFTS[i % 3], "date": "16.10.2026", "leads": 40, "orders": 7,
+                "pay_index": 7,
+                "payments": amounts if compact else dict(zip(bot_v2.PAYMENT_COLS, amounts))}
+
+    formats = {
+        "legacy":  (lambda d: json.dumps(d, ensure_ascii=False), json.loads, False),
+        "compact": (codec.encode, lambda raw: codec.decode(raw)[0], True),
+    }
+    out = ["", f"FSM sessions x{n}:",
+           f"{'format':<8} {'B/session':>10} {'encode us':>10} {'decode us':>10} "
+           f"{'mem B':>8} {'flush ms':>9}"]
+    for name, (encode, decode, compact) in formats.items():
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        sessions = {f"fsm:1:{i}:{i}:default":
+                    bot_v2.SessionRecord("S:m_payment", session(i, compact), time.time())
+                    for i in range(n)}
+        mem = (tracemalloc.get_traced_memory()[0] - before) / n
+        tracemalloc.stop()
+
+        t = time.perf_counter()
+        encoded = [(k, r.state, encode(r.data), r.touched) for k, r in sessions.items()]
+        t_enc = time.perf_counter() - t
+        t = time.perf_counter()
+        for _, _, raw, _ in encoded:
+            decode(raw)
+        t_dec = time.perf_counter() - t
+        size = statistics.mean(len(raw.encode()) for _, _, raw, _ in encoded)
+
+        db = sqlite3.connect(os.path.join(_tmp, f"fsm_{name}.db"), isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE fsm (key TEXT PRIMARY KEY, state TEXT, data TEXT, touched REAL)")
+        t = time.perf_counter()
+        with db:
+            db.executemany("INSERT OR REPLACE INTO fsm VALUES (?, ?, ?, ?)", encoded)
+        t_flush = time.perf_counter() - t
+        db.close()
+        out.append(f"{name:<8} {size:>10.0f} {t_enc / n * 1e6:>10.2f} {t_dec / n * 1e6:>10.2f} "
+                   f"{mem:>8.0f} {t_flush * 1000:>9.1f}")
+    return out
+
+def pct(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+# ============================================================
+# 🏁  ЗАПУСК
+# ============================================================
+async def main(args):
+    random.seed(args.seed)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    telegram = FakeTelegram()
+    runner, base = await telegram.start()
+    sheets = FakeSheets(args.latency / 1000, args.error_rate)
+    bot_v2._client = sheets
+    sheets_runner, bot_v2.sheets_api.base_url = await sheets.start()
+    bot = Bot(token=os.environ["BOT_TOKEN"],
+              session=AiohttpSession(api=TelegramAPIServer.from_base(base)))
+
+    t = time.perf_counter()
+    await bot_v2.dp.emit_startup(bot=bot)
+    startup_time = time.perf_counter() - t
+    await bot_v2.sheets_ready.wait()             # прогрев Sheets идёт фоном
+    warm_time = time.perf_counter() - t
+
+    latencies: dict[str, list[float]] = defaultdict(list)
+    t = time.perf_counter()
+    await asyncio.gather(*(run_user(bot, uid, args.think / 1000, latencies)
+                           for uid in range(1, args.users + 1)))
+    handlers_time = time.perf_counter() - t
+
+    mem_traced, mem_json = await session_memory(bot, args.sessions)
+    ops_lines = await fsm_ops(bot, args.fsm_ops) if args.fsm_ops else []
+
+    t = time.perf_counter()
+    await bot_v2.dp.emit_shutdown(bot=bot)       # дожидается очереди записи
+    drain_time = time.perf_counter() - t
+    await bot.session.close()
+    await runner.cleanup()
+    await sheets_runner.cleanup()
+
+    all_lat = [x for v in latencies.values() for x in v]
+    n_updates = len(all_lat)
+    api_calls = sum(sheets.calls.values())
+    st = bot_v2.sheets_scheduler.stats()
+
+    out = [
+        f"🏋️  users={args.users} latency={args.latency}ms error_rate={args.error_rate} "
+        f"think={args.think}ms",
+        f"startup: import {IMPORT_TIME * 1000:.0f} ms, on_startup {startup_time * 1000:.0f} ms, "
+        f"Sheets warm after {warm_time * 1000:.0f} ms (background)",
+        "",
+        f"{'step':<10} {'n':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}",
+    ]
+    for step, values in list(latencies.items()) + [("ALL", all_lat)]:
+        ms = [v * 1000 for v in values]
+        out.append(f"{step:<10} {len(ms):>6} {pct(ms, 50):>8.1f} {pct(ms, 95):>8.1f} {pct(ms, 99):>8.1f}")
+    out += [
+        "",
+        f"throughput: {n_updates / handlers_time:.0f} updates/s "
+        f"({n_updates} updates in {handlers_time:.2f} s)",
+        f"write drain after last update: {drain_time:.2f} s",
+        f"Sheets API calls: {api_calls} ({dict(sheets.calls)}), "
+        f"per report: {api_calls / args.users:.2f}",
+        f"Sheets 429 injected: {sheets.errors}, scheduler retries: {st['retries']}",
+        f"Telegram API calls: {sum(telegram.calls.values())} "
+        f"({telegram.calls['sendMessage']} sendMessage)",
+        f"memory per session: {mem_traced / 1024:.1f} KiB traced, {mem_json:.0f} B serialized",
+    ]
+    out += ops_lines
+    if args.fsm_sessions:
+        out += fsm_benchmark(args.fsm_sessions)
+    print("\n".join(out))
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--users", type=int, default=50, help="параллельных менеджеров")
+    p.add_argument("--latency", type=float, default=300, help="задержка Sheets API, мс")
+    p.add_argument("--error-rate", type=float, default=0.02, help="доля ответов 429")
+    p.add_argument("--think", type=float, default=0, help="средняя пауза между сообщениями, мс")
+    p.add_argument("--sessions", type=int, default=200, help="сессий для замера памяти")
+    p.add_argument("--fsm-sessions", type=int, default=10_000,
+                   help="сессий для сравнения форматов FSM (0 — не сравнивать)")
+    p.add_argument("--fsm-ops", type=int, default=50,
+                   help="отчётов для замера обращений к FSM на апдейт (0 — не замерять)")
+    p.add_argument("--seed", type=int, default=1)
+    asyncio.run(main(p.parse_args()))
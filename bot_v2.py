@@ -5,19 +5,42 @@
 """
 
 import re
+import csv
+import inspect
 import logging
 import asyncio
 import os
 import json
-from datetime import datetime, timedelta
+import signal
+import time
+import random
+import sqlite3
+import tempfile
+import threading
+from collections import Counter, deque
+from itertools import islice
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Iterable, Iterator, Mapping
 
-import gspread
-from google.oauth2.service_account import Credentials
-from aiogram import Bot, Dispatcher, types, F
+STARTED_AT = time.perf_counter()   # для замера холодного старта
+
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
+from aiogram.exceptions import (TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError,
+                                TelegramRetryAfter, TelegramServerError)
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.middleware import FSMContextMiddleware
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import SimpleEventIsolation
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector, web
+
+if TYPE_CHECKING:
+    import gspread
 
 # ============================================================
 # ⚙️  НАСТРОЙКИ
@@ -26,17 +49,69 @@ BOT_TOKEN           = os.getenv("BOT_TOKEN",           "ВСТАВЬТЕ_ТОК
 SPREADSHEET_ASTANA  = os.getenv("SPREADSHEET_ASTANA",  "1MkzKzmNLKfxI5OaXJnzh03LhcHMYNbz0zAHaCfb80WA")
 SPREADSHEET_ALMATY  = os.getenv("SPREADSHEET_ALMATY",  "1yNuArFAE9UkEHilVZDHd4LyY6070xz8KBA7dojZMLGI")
 CREDENTIALS_FILE    = "credentials.json"
+CITIES_FILE         = os.getenv("CITIES_FILE", "cities.json")
 ALLOWED_USERS: list[int] = []   # пусто = доступ для всех
+ADMIN_USERS: list[int] = []     # /perf; пусто = никому
+
+# Режим работы: polling (по умолчанию) или webhook
+BOT_MODE             = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL          = os.getenv("WEBHOOK_URL", "")        # пусто = вебхук не регистрируем
+WEBHOOK_PATH         = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET       = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_PORT         = int(os.getenv("PORT", "8080"))
+WEBHOOK_MAX_INFLIGHT = int(os.getenv("WEBHOOK_MAX_INFLIGHT", "64"))
 
 # ============================================================
-# 👤  МЕНЕДЖЕРЫ И СМЕНЫ
+# 🏙  ГОРОДА, МЕНЕДЖЕРЫ И СМЕНЫ
 # ============================================================
-MANAGERS = {
-    "Астана": ["Камилла", "Еркежан", "Багнур", "Дилара", "Жансерик"],
-    "Алматы": [],  # пустой список → ввод текстом
-}
+# Реестр читается из переменной CITIES (JSON) или файла CITIES_FILE:
+#   [{"name": "Шымкент", "emoji": "🌇", "spreadsheet": "1AbC…",
+#     "managers": ["Айгерим"], "shifts": ["9:00-21:00"]}, …]
+# Без конфига — Астана и Алматы. Пустой managers → имя вводится текстом,
+# shifts не задан → SHIFTS. Кнопки городов и смен строятся из реестра.
+# Менеджеров и смены можно вести и в таблице города — см. 📚 СПРАВОЧНИК.
 SHIFTS = ["8:00-16:30", "16:30-01:00", "8:00-01:00"]
 
+DEFAULT_CITIES = [
+    {"name": "Астана", "emoji": "🏙", "spreadsheet": SPREADSHEET_ASTANA,
+     "managers": ["Камилла", "Еркежан", "Багнур", "Дилара", "Жансерик"]},
+    {"name": "Алматы", "emoji": "🏔", "spreadsheet": SPREADSHEET_ALMATY, "managers": []},
+]
+
+@dataclass(frozen=True)
+class City:
+    name:     str
+    sid:      str
+    emoji:    str = "🏙"
+    managers: tuple[str, ...] = ()
+    shifts:   tuple[str, ...] = tuple(SHIFTS)
+
+    @property
+    def button(self) -> str:
+        return f"{self.emoji} {self.name}"
+
+def load_cities() -> dict[str, City]:
+    raw = os.getenv("CITIES")
+    if raw:
+        config = json.loads(raw)
+    elif os.path.exists(CITIES_FILE):
+        with open(CITIES_FILE, encoding="utf-8") as f:
+            config = json.load(f)
+    else:
+        config = DEFAULT_CITIES
+    cities = {}
+    for c in config:
+        city = City(c["name"], c["spreadsheet"], c.get("emoji", "🏙"),
+                    tuple(c.get("managers") or ()), tuple(c.get("shifts") or SHIFTS))
+        cities[city.name] = city
+    if not cities:
+        raise RuntimeError("Реестр городов пуст")
+    return cities
+
+CITIES = load_cities()
+CITY_BY_BUTTON = {c.button: c.name for c in CITIES.values()}
+ALL_SHIFTS = list(dict.fromkeys(s for c in CITIES.values() for s in c.shifts))
+
 # ============================================================
 # 💳  ШАГИ ОПЛАТЫ
 # ============================================================
@@ -71,6 +146,191 @@ def parse_number(text: str) -> int:
     except ValueError:
         return 0
 
+DATE_RE = r"^\d{1,2}\.\d{1,2}(?:\.\d{2,4})?$"
+
+def full_date(d: str) -> str:
+    """'01.06' → '01.06.<текущий год>'."""
+    return d + f".{datetime.now().year}" if len(d.split(".")) == 2 else d
+
+# ============================================================
+# 💳  ОПЛАТЫ ОДНИМ СООБЩЕНИЕМ
+# ============================================================
+# Либо с подписями (по строке на способ, в любом порядке):
+#   Каспи пей 144.890
+#   Наличные: 12 000
+# либо просто суммы по строкам в порядке PAYMENT_STEPS (остальные = 0).
+
+PAYMENT_ALIASES = {label.split(" ", 1)[1].lower().replace("ё", "е"): col
+                   for col, label in PAYMENT_STEPS}
+PAYMENT_ALIASES.update({
+    "нал": "cash", "наличка": "cash", "kaspi pay": "kaspi_pay", "kaspi red": "kaspi_red",
+    "халык": "halyk_terminal", "межд карта": "international", "доплата": "surcharge",
+    "возврат": "returns",
+})
+_ALIASES_BY_LEN = sorted(PAYMENT_ALIASES, key=len, reverse=True)
+LABEL_BY_COL    = {col: label.split(" ", 1)[1] for col, label in PAYMENT_STEPS}
+
+def parse_payments(text: str) -> tuple[dict[str, int], list[str]] | None:
+    """Разбирает все оплаты из одного сообщения.
+    None — если это не пакетный ввод (одна строка), иначе (оплаты, ошибки)."""
+    lines = [l.strip() for l in text.strip().split("\n") if l.strip()]
+    if len(lines) < 2:
+        return None
+    payments, errors = {}, []
+    if any(re.search(r"[^\W\d_]", l) for l in lines):
+        for n, line in enumerate(lines, start=1):
+            low = line.lower().replace("ё", "е")
+            alias = next((a for a in _ALIASES_BY_LEN if low.startswith(a)), None)
+            if alias is None:
+                errors.append(f"стр. {n}: неизвестный способ оплаты")
+                continue
+            raw = line[len(alias):].strip(" :—-=")
+            if not re.search(r"\d", raw):
+                errors.append(f"стр. {n}: нет суммы")
+                continue
+            col = PAYMENT_ALIASES[alias]
+            if col in payments:
+                errors.append(f"стр. {n}: «{LABEL_BY_COL[col]}» уже указан выше")
+                continue
+            payments[col] = parse_number(raw)
+    else:
+        if len(lines) > len(PAYMENT_STEPS):
+            errors.append(f"сумм больше, чем способов оплаты ({len(PAYMENT_STEPS)})")
+        for (col, _), line in zip(PAYMENT_STEPS, lines):
+            payments[col] = parse_number(line)
+    errors += [f"{label}: отрицательная сумма"
+               for col, label in PAYMENT_STEPS if payments.get(col, 0) < 0]
+    return payments, errors
+
+# ============================================================
+# 📈  МЕТРИКИ
+# ============================================================
+# Гистограммы и счётчики в памяти процесса. Пишутся из цикла событий
+# (хендлеры) и из рабочих потоков (Sheets), отдаются в формате Prometheus
+# на http://METRICS_HOST:METRICS_PORT/metrics; METRICS_PORT=0 — без сервера.
+
+METRICS_HOST    = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT    = int(os.getenv("METRICS_PORT", "9108"))
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PERF_RECENT     = 1000    # последних апдейтов для /perf
+
+Labels = tuple[tuple[str, str], ...]
+
+class Histogram:
+    def __init__(self, buckets: tuple = METRICS_BUCKETS):
+        self.buckets = buckets
+        self.counts  = [0] * (len(buckets) + 1)   # последний — +Inf
+        self.sum     = 0.0
+        self.count   = 0
+
+    def observe(self, value: float):
+        i = next((i for i, b in enumerate(self.buckets) if value <= b), len(self.buckets))
+        self.counts[i] += 1
+        self.sum   += value
+        self.count += 1
+
+class Metrics:
+    def __init__(self):
+        self.histograms: dict[str, dict[Labels, Histogram]] = {}
+        self.counters:   dict[str, dict[Labels, float]] = {}
+        self.help: dict[str, str] = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, text: str):
+        self.help[name] = text
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            h = series.get(key)
+            if h is None:
+                h = series[key] = Histogram()
+            h.observe(value)
+
+    def inc(self, name: str, n: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + n
+
+    def total(self, name: str, **labels) -> float:
+        """Сумма счётчика по сериям, у которых совпадают заданные метки."""
+        want = set(labels.items())
+        with self._lock:
+            return sum(v for k, v in self.counters.get(name, {}).items() if want <= set(k))
+
+    def timer(self, name: str, **labels):
+        return _Timer(self, name, labels)
+
+    def render(self) -> str:
+        def fmt(labels: Labels, extra: tuple = ()) -> str:
+            items = list(labels) + list(extra)
+            if not items:
+                return ""
+            esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+        out = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                if name in self.help:
+                    out.append(f"# HELP {name} {self.help[name]}")
+                out.append(f"# TYPE {name} counter")
+                out += [f"{name}{fmt(k)} {v:g}" for k, v in series.items()]
+            for name, series in sorted(self.histograms.items()):
+                if name in self.help:
+                    out.append(f"# HELP {name} {self.help[name]}")
+                out.append(f"# TYPE {name} histogram")
+                for k, h in series.items():
+                    acc = 0
+                    for b, c in zip(list(h.buckets) + ["+Inf"], h.counts):
+                        acc += c
+                        out.append(f"{name}_bucket{fmt(k, (('le', b),))} {acc}")
+                    out.append(f"{name}_sum{fmt(k)} {h.sum:.6f}")
+                    out.append(f"{name}_count{fmt(k)} {h.count}")
+        out.append(f"bot_uptime_seconds {time.time() - self.started:.0f}")
+        return "\n".join(out) + "\n"
+
+class _Timer:
+    def __init__(self, metrics: Metrics, name: str, labels: dict):
+        self.metrics, self.name, self.labels = metrics, name, labels
+
+    def __enter__(self):
+        self.t = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *_):
+        self.metrics.observe(self.name, time.perf_counter() - self.t,
+                             **self.labels, outcome="error" if exc_type else "ok")
+
+metrics = Metrics()
+metrics.describe("bot_handler_seconds", "Handler latency by handler and FSM state")
+metrics.describe("bot_handler_errors_total", "Handler exceptions")
+metrics.describe("sheets_call_seconds", "Sheets API call latency by operation (one attempt)")
+metrics.describe("sheets_quota_wait_seconds", "Time spent waiting for the per-spreadsheet quota")
+metrics.describe("sheets_errors_total", "Failed Sheets API attempts by operation and status")
+metrics.describe("sheets_retries_total", "Retried Sheets API attempts by operation")
+metrics.describe("sheets_verified_total", "Ambiguous append failures checked by idempotency key")
+metrics.describe("fsm_storage_ops_total", "FSM storage calls by operation")
+metrics.describe("fsm_updates_total", "Updates that went through the FSM middleware")
+
+async def serve_metrics() -> web.AppRunner | None:
+    if not METRICS_PORT:
+        return None
+
+    async def handle(_request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info(f"Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
 # ============================================================
 # 🗂️  GOOGLE SHEETS
 # ============================================================
@@ -78,28 +338,550 @@ SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets",
     "https://www.googleapis.com/auth/drive",
 ]
+TOKEN_REFRESH_MARGIN = 300    # сек: обновляем токен заранее, не дожидаясь истечения
+TOKEN_CHECK_INTERVAL = 600    # сек между проверками, если срок токена неизвестен
+SHEETS_TIMEOUT = float(os.getenv("SHEETS_TIMEOUT", "30"))   # сек на один HTTP-запрос
+
+# gspread и google-auth тянут за собой requests/oauthlib (~0.2 с импорта),
+# поэтому грузятся при первом обращении — обычно фоном из sheets_warmup().
 _client = None
+_creds  = None
+_client_lock = threading.Lock()
+
+def _gspread():
+    import gspread
+    return gspread
 
 def get_client():
-    global _client
+    global _client, _creds
     if _client is None:
-        raw = os.getenv("GOOGLE_CREDENTIALS")
-        if raw:
-            creds = Credentials.from_service_account_info(json.loads(raw), scopes=SCOPES)
-        else:
-            creds = Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
-        _client = gspread.authorize(creds)
+        with _client_lock:
+            if _client is None:
+                with metrics.timer("sheets_call_seconds", op="auth"):
+                    from google.oauth2.service_account import Credentials
+                    raw = os.getenv("GOOGLE_CREDENTIALS")
+                    if raw:
+                        creds = Credentials.from_service_account_info(json.loads(raw), scopes=SCOPES)
+                    else:
+                        creds = Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
+                    client = _gspread().authorize(creds)
+                    # Без таймаута зависший запрос держит полосу записи вечно;
+                    # с ним медленный append обрывается и перепроверяется по ключу
+                    client.set_timeout(SHEETS_TIMEOUT)
+                    _creds, _client = creds, client
     return _client
 
-def get_sheet(city: str):
-    sid = SPREADSHEET_ASTANA if city == "Астана" else SPREADSHEET_ALMATY
-    return get_client().open_by_key(sid)
+def refresh_token() -> float:
+    """Обновляет OAuth-токен, если он не получен или скоро истечёт, — чтобы
+    обмен токена не попадал в запрос пользователя. Возвращает, через сколько
+    секунд проверить снова. Вызывается из потока."""
+    get_client()
+    if _creds is None:            # клиент подменён (тесты, бенчмарк)
+        return TOKEN_CHECK_INTERVAL
+    now = datetime.now(timezone.utc).replace(tzinfo=None)   # expiry у google-auth — наивное UTC
+    if not _creds.token or _creds.expiry is None or \
+            (_creds.expiry - now).total_seconds() < TOKEN_REFRESH_MARGIN:
+        from google.auth.transport.requests import Request
+        with metrics.timer("sheets_call_seconds", op="token"):
+            _creds.refresh(Request())
+        logging.info(f"Sheets token refreshed, expires {_creds.expiry:%H:%M} UTC")
+    if _creds.expiry is None:
+        return TOKEN_CHECK_INTERVAL
+    left = (_creds.expiry - datetime.now(timezone.utc).replace(tzinfo=None)).total_seconds()
+    return max(30.0, left - TOKEN_REFRESH_MARGIN)
+
+# ---------- планировщик запросов ----------
+# Все обращения к Sheets API идут через sheets_scheduler.call(): у каждой
+# таблицы свои корзины токенов на чтение и запись (по квоте «запросов в
+# минуту на пользователя»), 429/5xx и сетевые ошибки повторяются с
+# экспоненциальной задержкой и джиттером, а после серии отказов подряд
+# автомат-предохранитель на время перестаёт дёргать API.
+# Вызывается из рабочих потоков, поэтому ожидание — обычный time.sleep.
+
+SHEETS_READ_RPM    = int(os.getenv("SHEETS_READ_RPM",  "60"))   # квота чтения, запросов/мин
+SHEETS_WRITE_RPM   = int(os.getenv("SHEETS_WRITE_RPM", "60"))   # квота записи, запросов/мин
+# Google считает квоту на пользователя проекта (один сервисный аккаунт на все
+# города), поэтому поверх полос таблиц — общая корзина на весь бот
+SHEETS_PROJECT_READ_RPM  = int(os.getenv("SHEETS_PROJECT_READ_RPM",  str(SHEETS_READ_RPM)))
+SHEETS_PROJECT_WRITE_RPM = int(os.getenv("SHEETS_PROJECT_WRITE_RPM", str(SHEETS_WRITE_RPM)))
+SHEETS_MAX_RETRIES = int(os.getenv("SHEETS_MAX_RETRIES", "5"))
+SHEETS_BACKOFF_MAX = 32.0    # сек, потолок одной паузы
+BREAKER_THRESHOLD  = 5       # отказов подряд до размыкания
+BREAKER_COOLDOWN   = 30.0    # сек до пробного запроса
+RETRY_STATUSES     = {429, 500, 502, 503, 504}
+
+class CircuitOpenError(Exception):
+    pass
+
+class TokenBucket:
+    def __init__(self, per_minute: int, burst: int | None = None):
+        self.rate     = per_minute / 60
+        self.capacity = burst or max(1, per_minute // 6)
+        self.tokens   = float(self.capacity)
+        self.updated  = time.monotonic()
+        self._lock    = threading.Lock()
+
+    def reserve(self) -> float:
+        """Забирает токен (в долг, если корзина пуста) и возвращает,
+        сколько секунд нужно подождать до его появления."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+class CircuitBreaker:
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown  = cooldown
+        self.failures  = 0
+        self.opened_at: float | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                # Пропускаем один пробный запрос, остальные ждут его исхода
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures, self.opened_at = 0, None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+class SheetsAPIError(Exception):
+    """Ответ REST API с ошибкой (асинхронный клиент)."""
+
+    def __init__(self, status: int, message: str, retry_after: str | None = None):
+        super().__init__(f"[{status}]: {message}")
+        self.status = status
+        self.retry_after = retry_after
+
+def _status(e: Exception) -> int | None:
+    """HTTP-статус ошибки Sheets (gspread или REST), None — ответа не было."""
+    if isinstance(e, SheetsAPIError):
+        return e.status
+    return getattr(getattr(e, "response", None), "status_code", None)
+
+def _network_error(e: Exception) -> bool:
+    # OSError — сетевые ошибки requests; ClientError — aiohttp. Таймаут
+    # asyncio стал подклассом OSError только в 3.11 — проверяем явно
+    return isinstance(e, (asyncio.TimeoutError, ClientError, OSError))
+
+def _retryable(e: Exception) -> bool:
+    status = _status(e)
+    if status is not None:
+        return status in RETRY_STATUSES
+    return _network_error(e)
+
+def _ambiguous(e: Exception) -> bool:
+    """Ошибка, после которой неизвестно, выполнил ли Google запрос: 5xx,
+    таймаут или обрыв соединения. 429 — запрос точно отклонён."""
+    status = _status(e)
+    if status is not None:
+        return status >= 500
+    return _network_error(e)
+
+def _retry_after(e: Exception) -> float | None:
+    if isinstance(e, SheetsAPIError):
+        raw = e.retry_after
+    else:
+        response = getattr(e, "response", None)
+        raw = response.headers.get("Retry-After") if response is not None else None
+    try:
+        return float(raw) if raw else None
+    except ValueError:
+        return None
+
+class SheetsScheduler:
+    def __init__(self, read_rpm: int = SHEETS_READ_RPM, write_rpm: int = SHEETS_WRITE_RPM,
+                 max_retries: int = SHEETS_MAX_RETRIES,
+                 project_read_rpm: int = SHEETS_PROJECT_READ_RPM,
+                 project_write_rpm: int = SHEETS_PROJECT_WRITE_RPM):
+        self.rpm = {"read": read_rpm, "write": write_rpm}
+        self.max_retries = max_retries
+        self._buckets:  dict[tuple[str, str], TokenBucket] = {}
+        self._project = {"read": TokenBucket(project_read_rpm), "write": TokenBucket(project_write_rpm)}
+        self._breakers: dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+        self.waiting = 0                          # потоков, ждущих токен или паузу
+        self.waits: deque[float] = deque(maxlen=200)
+        self.calls = self.retries = self.errors = 0
+
+    def _bucket(self, sid: str, kind: str) -> TokenBucket:
+        with self._lock:
+            b = self._buckets.get((sid, kind))
+            if b is None:
+                b = self._buckets[(sid, kind)] = TokenBucket(self.rpm[kind])
+            return b
+
+    def breaker(self, sid: str) -> CircuitBreaker:
+        with self._lock:
+            return self._breakers.setdefault(sid, CircuitBreaker())
+
+    def _sleep(self, seconds: float):
+        with self._lock:
+            self.waiting += 1
+        try:
+            time.sleep(seconds)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    async def _asleep(self, seconds: float):
+        with self._lock:
+            self.waiting += 1
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def _admit(self, sid: str, kind: str, op: str) -> float:
+        """Проверяет предохранитель и берёт токен; возвращает, сколько ждать."""
+        if not self.breaker(sid).allow():
+            metrics.inc("sheets_errors_total", op=op, status="breaker")
+            raise CircuitOpenError(f"Sheets API недоступен, пауза {BREAKER_COOLDOWN:.0f} с")
+        # Токен берём из обеих корзин: ждём ту, что освободится позже
+        wait = max(self._bucket(sid, kind).reserve(), self._project[kind].reserve())
+        self.waits.append(wait)
+        metrics.observe("sheets_quota_wait_seconds", wait, kind=kind)
+        with self._lock:
+            self.calls += 1
+        return wait
+
+    def _failed(self, sid: str, op: str, e: Exception, elapsed: float) -> bool:
+        """Учитывает неудачную попытку. False — такую ошибку не повторяем."""
+        metrics.observe("sheets_call_seconds", elapsed, op=op, outcome="error")
+        metrics.inc("sheets_errors_total", op=op, status=_status(e) or type(e).__name__)
+        if not _retryable(e):
+            return False
+        self.breaker(sid).failure()
+        with self._lock:
+            self.errors += 1
+        return True
+
+    def _backoff(self, kind: str, op: str, attempt: int, e: Exception) -> float:
+        delay = _retry_after(e) or random.uniform(0, min(SHEETS_BACKOFF_MAX, 2 ** attempt))
+        logging.warning(f"Sheets {kind} retry {attempt + 1}/{self.max_retries} "
+                        f"in {delay:.1f}s: {e}")
+        with self._lock:
+            self.retries += 1
+        metrics.inc("sheets_retries_total", op=op)
+        return delay
+
+    def _done(self, sid: str, op: str, elapsed: float):
+        metrics.observe("sheets_call_seconds", elapsed, op=op, outcome="ok")
+        self.breaker(sid).success()
+
+    def call(self, sid: str, kind: str, fn, *args, **kwargs):
+        """Выполняет fn(*args, **kwargs) с учётом квоты таблицы sid.
+        kind — "read" или "write". Для вызовов gspread из потока."""
+        op = getattr(fn, "__name__", "call")   # open_by_key, worksheet, batch_update, ...
+        for attempt in range(self.max_retries + 1):
+            wait = self._admit(sid, kind, op)
+            if wait:
+                self._sleep(wait)
+            t = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if not self._failed(sid, op, e, time.perf_counter() - t) or attempt == self.max_retries:
+                    raise
+                self._sleep(self._backoff(kind, op, attempt, e))
+                continue
+            self._done(sid, op, time.perf_counter() - t)
+            return result
+
+    async def acall(self, sid: str, kind: str, fn, *args,
+                    verify: Callable[[], Awaitable[Any]] | None = None, **kwargs):
+        """То же для корутин асинхронного клиента: ожидание — asyncio.sleep.
+        verify — для неидемпотентных запросов (append): после ошибки с
+        неизвестным исходом проверяет, дошёл ли запрос, и возвращает его
+        результат или None. Без verify такой запрос повторяется вслепую;
+        если проверка сама не удалась, повтора нет."""
+        op = getattr(fn, "__name__", "call")
+        for attempt in range(self.max_retries + 1):
+            wait = self._admit(sid, kind, op)
+            if wait:
+                await self._asleep(wait)
+            t = time.perf_counter()
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                if not self._failed(sid, op, e, time.perf_counter() - t):
+                    raise
+                if verify is not None and _ambiguous(e):
+                    try:
+                        landed = await verify()
+                    except Exception as ve:
+                        logging.warning(f"Sheets {op}: could not verify after {e!r}: {ve}")
+                        metrics.inc("sheets_verified_total", op=op, outcome="unknown")
+                        raise e
+                    metrics.inc("sheets_verified_total", op=op,
+                                outcome="missing" if landed is None else "landed")
+                    if landed is not None:
+                        logging.info(f"Sheets {op}: written despite error ({e!r})")
+                        self.breaker(sid).success()
+                        return landed
+                if attempt == self.max_retries:
+                    raise
+                await self._asleep(self._backoff(kind, op, attempt, e))
+                continue
+            self._done(sid, op, time.perf_counter() - t)
+            return result
+
+    def stats(self) -> dict:
+        waits = list(self.waits)
+        return {
+            "waiting":   self.waiting,
+            "avg_wait":  sum(waits) / len(waits) if waits else 0.0,
+            "max_wait":  max(waits, default=0.0),
+            "calls":     self.calls,
+            "retries":   self.retries,
+            "errors":    self.errors,
+            "breakers":  {sid: b.state for sid, b in self._breakers.items()},
+        }
+
+sheets_scheduler = SheetsScheduler()
+
+# ---------- асинхронный клиент ----------
+# Запись, чтение диапазонов и метаданные таблиц идут напрямую в REST API
+# через одну aiohttp-сессию с пулом keep-alive соединений: без потоков и
+# без TLS-рукопожатия на каждый запрос, сколько угодно запросов разом (темп
+# задаёт планировщик). Токен заранее обновляет sheets_warmup(); запрос сам
+# идёт за токеном, только если тот уже истёк (например, после сна машины).
+# Структуру таблицы (лист сводки, число строк) меняет тот же клиент через
+# spreadsheets:batchUpdate; от gspread остаётся только авторизация.
+
+SHEETS_API_URL   = os.getenv("SHEETS_API_URL", "https://sheets.googleapis.com/v4/spreadsheets")
+SHEETS_POOL_SIZE = int(os.getenv("SHEETS_POOL_SIZE", "16"))   # соединений в пуле
+
+def a1(sheet: str, rng: str = "") -> str:
+    """('Продажи', 'A5') → "'Продажи'!A5"."""
+    name = "'" + sheet.replace("'", "''") + "'"
+    return f"{name}!{rng}" if rng else name
+
+def token_fresh() -> bool:
+    if _creds is None:
+        return _client is not None        # клиент подменён (тесты, бенчмарк)
+    if not _creds.token:
+        return False
+    if _creds.expiry is None:
+        return True
+    return (_creds.expiry - datetime.now(timezone.utc).replace(tzinfo=None)).total_seconds() > 60
+
+class SheetsClient:
+    def __init__(self, base_url: str = SHEETS_API_URL, pool_size: int = SHEETS_POOL_SIZE,
+                 timeout: float = SHEETS_TIMEOUT):
+        self.base_url  = base_url
+        self.pool_size = pool_size
+        self.timeout   = timeout
+        self._session: ClientSession | None = None
+        self._auth_lock = asyncio.Lock()
+
+    def _http(self) -> ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                connector=TCPConnector(limit=self.pool_size, keepalive_timeout=60, ttl_dns_cache=300),
+                timeout=ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def _headers(self) -> dict[str, str]:
+        if not token_fresh():
+            async with self._auth_lock:
+                if not token_fresh():
+                    await asyncio.to_thread(refresh_token)
+        token = _creds.token if _creds is not None else None
+        return {"Authorization": f"Bearer {token}"} if token else {}
+
+    async def _request(self, method: str, sid: str, path: str = "", *,
+                       params: dict | list | None = None, body: dict | None = None) -> dict:
+        async with self._http().request(method, f"{self.base_url}/{sid}{path}", params=params,
+                                        json=body, headers=await self._headers()) as resp:
+            text = await resp.text()
+            if resp.status >= 400:
+                try:
+                    message = json.loads(text)["error"]["message"]
+                except (ValueError, KeyError, TypeError):
+                    message = text[:200] or resp.reason
+                raise SheetsAPIError(resp.status, message, resp.headers.get("Retry-After"))
+            return json.loads(text) if text else {}
+
+    # Имена методов — как у gspread: по ним планировщик подписывает метрики
+    async def append_rows(self, sid: str, sheet: str, rows: list[list]) -> dict:
+        return await self._request("POST", sid, f"/values/{quote(a1(sheet), safe='')}:append",
+                                   params={"valueInputOption": "USER_ENTERED"},
+                                   body={"values": rows})
+
+    async def batch_update(self, sid: str, data: list[dict]) -> dict:
+        return await self._request("POST", sid, "/values:batchUpdate",
+                                   body={"valueInputOption": "USER_ENTERED", "data": data})
+
+    async def get(self, sid: str, rng: str, **params) -> list[list]:
+        resp = await self._request("GET", sid, f"/values/{quote(rng, safe='')}", params=params)
+        return resp.get("values", [])
+
+    async def batch_get(self, sid: str, ranges: list[str], **params) -> list[list[list]]:
+        """Несколько диапазонов одним запросом, в порядке ranges."""
+        resp = await self._request("GET", sid, "/values:batchGet",
+                                   params=[("ranges", r) for r in ranges] + list(params.items()))
+        return [vr.get("values", []) for vr in resp.get("valueRanges", [])]
+
+    async def titles(self, sid: str) -> list[str]:
+        resp = await self._request("GET", sid, params={"fields": "sheets.properties.title"})
+        return [sh["properties"]["title"] for sh in resp.get("sheets", [])]
+
+    async def sheet_properties(self, sid: str) -> dict[str, dict]:
+        """Название листа → properties (sheetId, gridProperties)."""
+        resp = await self._request("GET", sid, params={"fields": "sheets.properties"})
+        return {sh["properties"]["title"]: sh["properties"] for sh in resp.get("sheets", [])}
+
+    async def batch_update_spreadsheet(self, sid: str, requests: list[dict]) -> dict:
+        """Изменения структуры: addSheet, appendDimension, ..."""
+        return await self._request("POST", sid, ":batchUpdate", body={"requests": requests})
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+sheets_api = SheetsClient()
+
+# ---------- таблицы городов ----------
+
+SPREADSHEETS = {c.name: c.sid for c in CITIES.values()}
+
+def city_sid(city: str) -> str:
+    return CITIES[city].sid
+
+async def prewarm_sheet(city: str) -> int:
+    """Открывает соединение к таблице города и проверяет, что листы на месте.
+    Возвращает число листов."""
+    sid = city_sid(city)
+    titles = await sheets_scheduler.acall(sid, "read", sheets_api.titles, sid)
+    missing = [sh for sh in REPLICA_SHEETS if sh not in titles]
+    if missing:
+        logging.warning(f"Sheets prewarm: {city} has no sheets {missing}")
+    return len(titles)
+
+sheets_ready = asyncio.Event()   # токен получен, соединения к таблицам городов открыты
+
+async def sheets_warmup():
+    """Фоновая задача: авторизация, токен и таблицы городов, пока бот уже
+    принимает апдейты; дальше обновляет токен до его истечения."""
+    t = time.perf_counter()
+    try:
+        delay = await asyncio.to_thread(refresh_token)
+        await prewarm_sheets()
+        logging.info(f"Sheets warm in {time.perf_counter() - t:.2f}s")
+    except Exception as e:
+        logging.warning(f"Sheets warmup failed: {e}")
+        delay = 60
+    sheets_ready.set()
+    while True:
+        await asyncio.sleep(delay)
+        try:
+            delay = await asyncio.to_thread(refresh_token)
+        except Exception as e:
+            logging.warning(f"Sheets token refresh failed: {e}")
+            delay = 60
+
+async def prewarm_sheets():
+    """Параллельно прогревает кэш для всех городов (ошибки только логируются)."""
+    cities = list(SPREADSHEETS)
+    results = await asyncio.gather(*(prewarm_sheet(c) for c in cities), return_exceptions=True)
+    for city, res in zip(cities, results):
+        if isinstance(res, Exception):
+            logging.warning(f"Sheets prewarm failed for {city}: {res}")
+        else:
+            logging.info(f"Sheets prewarm: {city} — {res} worksheets")
 
 # ---------- запись ----------
+# write_* не ходят в Google сами: строки встают в очередь write_queue,
+# а результат приходит в notify(err) — err=None, если строки записаны.
+
+Notify = Callable[[Exception | None], Awaitable[None]]
+
+async def append_rows(city: str, sheet_name: str, rows: list[list], probe: bool = False) -> dict:
+    """Единственная точка записи в таблицу (её ждёт воркер очереди).
+    Возвращает ответ API — в нём updatedRange с номерами новых строк.
+    Строки с ключом отправки после таймаута или 5xx не повторяются вслепую:
+    сначала ищем ключи в листе. probe=True — искать и до первой попытки
+    (повтор из журнала: прошлый append мог дойти)."""
+    sid = city_sid(city)
+    keys = [k for k in map(row_key, rows) if k]
 
-def write_manager_report(entry: dict, city: str) -> int:
-    """Пишет строку в лист 'Продажи', возвращает итого."""
-    ws = get_sheet(city).worksheet("Продажи")
+    async def landed() -> dict | None:
+        return idem_index.response(sheet_name, keys, await find_keys(city, sheet_name, keys))
+
+    if probe and keys:
+        resp = idem_index.response(sheet_name, keys) or await landed()
+        if resp:
+            logging.info(f"Sheets append skipped: {city}/{sheet_name} rows already written")
+            return resp
+    return await sheets_scheduler.acall(sid, "write", sheets_api.append_rows, sid, sheet_name, rows,
+                                        verify=landed if keys else None)
+
+class RowsMovedError(Exception):
+    """На местах at уже не те строки, что в копии (лист правили руками)."""
+
+def row_identity(city: str, sheet: str, row: list):
+    """Чем строка узнаётся перед перезаписью: ключ отправки, ключ дубля
+    (дата, имя[, смена]) или дата."""
+    if not row:
+        return None
+    return row_key(row) or dup_key(city, sheet, row) or iso_day(row[0])
+
+async def check_rows(city: str, sheet_name: str, at: list[int]):
+    """Сверяет строки at в листе с копией одним batchGet. Копия знает
+    только номера строк, а удалённая руками строка сдвигает всё ниже —
+    запись по старому номеру затёрла бы чужой отчёт."""
+    expected = replica.rows_at(city, sheet_name, at)
+    wanted = [n for n in at if row_identity(city, sheet_name, expected.get(n)) is not None]
+    if not wanted:
+        return
+    sid = city_sid(city)
+    found = await sheets_scheduler.acall(
+        sid, "read", sheets_api.batch_get, sid, [a1(sheet_name, f"A{n}:Z{n}") for n in wanted],
+        valueRenderOption="UNFORMATTED_VALUE", dateTimeRenderOption="FORMATTED_STRING",
+    )
+    moved = [n for n, values in zip(wanted, found)
+             if row_identity(city, sheet_name, values[0] if values else [])
+             != row_identity(city, sheet_name, expected[n])]
+    if moved:
+        logging.warning(f"Rows moved in {city}/{sheet_name}: {moved}, in-place write skipped")
+        raise RowsMovedError(f"строки {', '.join(map(str, moved))} листа «{sheet_name}» "
+                             "уже не те (лист правили вручную) — запись отменена, "
+                             "исправьте в таблице")
+
+async def update_rows(city: str, sheet_name: str, at: list[int], rows: list[list]) -> dict:
+    """Перезаписывает строки листа с номерами at одним batch_update,
+    если на этих местах всё ещё те строки, что в копии (check_rows)."""
+    await check_rows(city, sheet_name, at)
+    sid = city_sid(city)
+    data = [{"range": a1(sheet_name, f"A{n}"), "values": [r]} for n, r in zip(at, rows)]
+    return await sheets_scheduler.acall(sid, "write", sheets_api.batch_update, sid, data)
+
+def manager_report_row(entry: dict) -> tuple[list, int]:
+    """Строка листа 'Продажи' и итого."""
     pay_sum  = sum(entry.get(c, 0) for c in PAYMENT_COLS[:12])
     surcharge = entry.get("surcharge", 0)
     returns   = entry.get("returns",   0)
@@ -109,25 +891,1339 @@ def write_manager_report(entry: dict, city: str) -> int:
            entry["leads"], entry["orders"]]
     row += [entry.get(c, 0) for c in PAYMENT_COLS]
     row += [total, conv]
-    ws.append_row(row, value_input_option="USER_ENTERED")
-    return total
+    return with_key(row, entry.get("key")), total
 
-def write_schedule(entries: list[dict], city: str, role: str) -> int:
-    sheet_name = "Смены флористов" if role == "Флорист" else "Смены логистов"
-    ws = get_sheet(city).worksheet(sheet_name)
-    if role == "Логист":
-        rows = [[e["date"], e["name"], e.get("shift_type", "Полная")] for e in entries]
+async def write_manager_report(entry: dict, city: str, notify: Notify | None = None,
+                               chat_id: int | None = None, at: int | None = None) -> int | None:
+    """Ставит строку в очередь на лист 'Продажи' (at — перезаписать эту
+    строку вместо добавления), возвращает итого. None — отчёт с этим
+    ключом уже принят: ничего не ставим, notify не будет вызван."""
+    row, total = manager_report_row(entry)
+    if not idem_index.claim([row]):
+        logging.info(f"Report {entry.get('key')} already submitted, skipped")
+        return None
+    if at:
+        await write_queue.submit(city, "Продажи", [row], notify, chat_id, at=[at])
     else:
-        rows = [[e["date"], e["name"]] for e in entries]
+        dup_index.mark(city, "Продажи", [row])
+        await write_queue.submit(city, "Продажи", [row], notify, chat_id)
+    return total
+
+async def write_manager_reports(entries: list[dict], city: str, notify: Notify | None = None,
+                                chat_id: int | None = None) -> int:
+    """Пачка отчётов одним заданием (импорт из файла)."""
+    rows = idem_index.claim([manager_report_row(e)[0] for e in entries])
     if rows:
-        ws.append_rows(rows, value_input_option="USER_ENTERED")
+        dup_index.mark(city, "Продажи", rows)
+        await write_queue.submit(city, "Продажи", rows, notify, chat_id)
     return len(rows)
 
-def write_marketing(date, lp, l, sp, sl, rt, city):
-    get_sheet(city).worksheet("Маркетинг").append_row(
-        [date, lp, l, "", sp, "", sl, "", "", "", rt, "", ""],
-        value_input_option="USER_ENTERED",
-    )
+def schedule_sheet(role: str) -> str:
+    return "Смены флористов" if role == "Флорист" else "Смены логистов"
+
+def schedule_row(e: dict, role: str) -> list:
+    if role == "Логист":
+        return with_key([e["date"], e["name"], e.get("shift_type", "Полная")], e.get("key"))
+    return with_key([e["date"], e["name"]], e.get("key"))
+
+async def write_schedule(entries: list[dict], city: str, role: str,
+                         notify: Notify | None = None, chat_id: int | None = None,
+                         overwrite: bool = False, skip_dupes: bool = False
+                         ) -> tuple[int, list[dict]]:
+    """Ставит смены в очередь. Уже записанные смены (по индексу дублей)
+    при overwrite=True перезаписываются на месте, при skip_dupes=True
+    пропускаются; дубль, который ещё в очереди, пропускается в обоих
+    случаях. Возвращает (поставлено строк, пропущенные смены)."""
+    sheet_name = schedule_sheet(role)
+    rows, at, updates, skipped = [], [], [], []
+    for e in entries:
+        row = schedule_row(e, role)
+        found, n = dup_index.find(city, sheet_name, row) if overwrite or skip_dupes else (False, None)
+        if found and (skip_dupes or n is None):
+            skipped.append(e)
+            continue
+        if not idem_index.claim([row]):
+            continue
+        if n:
+            at.append(n)
+            updates.append(row)
+        else:
+            rows.append(row)
+    jobs = [j for j in (rows, updates) if j]
+    if notify and len(jobs) > 1:
+        notify = notify_all(len(jobs), notify)
+    if updates:
+        await write_queue.submit(city, sheet_name, updates, notify, chat_id, at=at)
+    if rows:
+        dup_index.mark(city, sheet_name, rows)
+        await write_queue.submit(city, sheet_name, rows, notify, chat_id)
+    return len(rows) + len(updates), skipped
+
+async def write_marketing(rows: list[tuple], city: str, notify: Notify | None = None,
+                          chat_id: int | None = None) -> int:
+    """Ставит все строки маркетинга одним батчем: (дата, план, факт, $, продаж, курс)."""
+    values = [[date, lp, l, "", sp, "", sl, "", "", "", rt, "", ""]
+              for date, lp, l, sp, sl, rt in rows]
+    if values:
+        await write_queue.submit(city, "Маркетинг", values, notify, chat_id)
+    return len(values)
+
+# ============================================================
+# 💾  ЖУРНАЛ ЗАПИСЕЙ (write-ahead)
+# ============================================================
+# Каждая порция строк сначала ложится в локальный SQLite (fsync), и только
+# потом уходит в Google. После успешного append запись помечается committed.
+# Всё, что не закоммичено (упал Google, перезапуск воркера), переигрывается
+# при старте и периодически, пока не запишется.
+
+JOURNAL_DB        = os.getenv("JOURNAL_DB", "journal.db")
+JOURNAL_RETRY     = int(os.getenv("JOURNAL_RETRY", "60"))        # сек между повторами
+JOURNAL_KEEP_DAYS = int(os.getenv("JOURNAL_KEEP_DAYS", "14"))    # сколько хранить записанное
+
+class Journal:
+    def __init__(self, path: str = JOURNAL_DB):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS journal ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " city TEXT NOT NULL, sheet TEXT NOT NULL, rows TEXT NOT NULL,"
+            " chat_id INTEGER, created REAL NOT NULL, committed REAL)"
+        )
+        cols = {r[1] for r in self._db.execute("PRAGMA table_info(journal)")}
+        if "at" not in cols:
+            # at — номера строк для перезаписи на месте (NULL = append)
+            self._db.execute("ALTER TABLE journal ADD COLUMN at TEXT")
+        if "undo" not in cols:
+            # undo — id отправки из истории, которую отменяет запись (/undo)
+            self._db.execute("ALTER TABLE journal ADD COLUMN undo INTEGER")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS journal_pending ON journal(id) WHERE committed IS NULL"
+        )
+
+    def append(self, city: str, sheet: str, rows: list[list], chat_id: int | None,
+               at: list[int] | None = None, undo: int | None = None) -> int:
+        with self._lock:
+            cur = self._db.execute(
+                "INSERT INTO journal (city, sheet, rows, chat_id, created, at, undo)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (city, sheet, json.dumps(rows, ensure_ascii=False), chat_id, time.time(),
+                 json.dumps(at) if at else None, undo),
+            )
+            return cur.lastrowid
+
+    def commit(self, ids: list[int]):
+        with self._lock:
+            self._db.executemany(
+                "UPDATE journal SET committed = ? WHERE id = ?",
+                [(time.time(), i) for i in ids],
+            )
+
+    def pending(self, after: int = 0, limit: int = 500
+                ) -> list[tuple[int, str, str, list[list], int | None, list[int] | None, int | None]]:
+        """Незакоммиченные записи с id > after (порция для повтора)."""
+        with self._lock:
+            cur = self._db.execute(
+                "SELECT id, city, sheet, rows, chat_id, at, undo FROM journal"
+                " WHERE committed IS NULL AND id > ? ORDER BY id LIMIT ?", (after, limit),
+            )
+            return [(i, c, sh, json.loads(r), ch, json.loads(at) if at else None, u)
+                    for i, c, sh, r, ch, at, u in cur.fetchall()]
+
+    def count_pending(self) -> int:
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM journal WHERE committed IS NULL"
+            ).fetchone()[0]
+
+    def prune(self, keep_days: int = JOURNAL_KEEP_DAYS) -> int:
+        with self._lock:
+            cur = self._db.execute(
+                "DELETE FROM journal WHERE committed IS NOT NULL AND committed < ?",
+                (time.time() - keep_days * 86400,),
+            )
+            return cur.rowcount
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def notify_all(n: int, notify: Notify) -> Notify:
+    """Склеивает n уведомлений в одно: notify вызывается после последнего,
+    err — первая из ошибок (если были)."""
+    left, errors = n, []
+    async def one(err: Exception | None):
+        nonlocal left
+        left -= 1
+        if err:
+            errors.append(err)
+        if left == 0:
+            await notify(errors[0] if errors else None)
+    return one
+
+# ============================================================
+# 📮  ОЧЕРЕДЬ ЗАПИСИ (write-behind)
+# ============================================================
+# Хендлеры только кладут строки в очередь и сразу отвечают пользователю.
+# У каждой таблицы своя полоса — очередь и воркер, — так что город, упёршийся
+# в квоту или медленный ответ Google, не задерживает запись остальных.
+# Воркер забирает всё, что накопилось, склеивает строки одного листа
+# в один append_rows и ждёт его в event loop (асинхронный клиент, без потоков).
+# Задание с at — перезапись существующих строк на месте (один batch_update).
+# Повтор из журнала пишется отдельно от соседей: перед append его ключи
+# ищутся в листе, и дошедшая в прошлый раз порция не дублируется.
+
+WRITE_LINGER   = float(os.getenv("WRITE_LINGER", "0.2"))   # сек ожидания соседей по батчу
+WRITE_MAX_ROWS = int(os.getenv("WRITE_MAX_ROWS", "500"))   # максимум строк в одном батче
+
+@dataclass
+class WriteJob:
+    city:   str
+    sheet:  str
+    rows:   list[list]
+    notify: Notify | None = None
+    jid:    int | None = None     # id в журнале
+    at:     list[int] | None = None   # номера строк в листе (после записи — всегда)
+    overwrite: bool = False           # at задан заранее: строки перезаписаны на месте
+    replay: bool = False              # повтор из журнала: прошлая попытка могла дойти
+    chat_id: int | None = None        # чей это ввод (None — служебная запись, не в историю)
+    undo:   int | None = None         # id отправки из истории, которую отменяет задание
+
+# Слушатель записи: (город, лист, задания). Вызывается в event loop после
+# успешной записи; у каждого задания заполнен at (если Google вернул диапазон).
+# Слушатель, который пишет на диск, — корутина: воркер дожидается её, прежде
+# чем звать следующего, так что порядок слушателей сохраняется.
+WriteListener = Callable[[str, str, list[WriteJob]], Awaitable[None] | None]
+# Слушатель неудачи: те же аргументы, вызывается после ошибки записи. Задания
+# больше не в очереди (журнал повторит их позже), так что индексы снимают
+# с их строк отметку «ещё записывается».
+FailureListener = Callable[[str, str, list[WriteJob]], None]
+
+def appended_start_row(resp) -> int | None:
+    """Номер первой добавленной строки из ответа append ('Лист'!A120:U121 → 120)."""
+    try:
+        m = re.search(r"![A-Z]+(\d+)", resp["updates"]["updatedRange"])
+    except (TypeError, KeyError):
+        return None
+    return int(m.group(1)) if m else None
+
+class WriteQueue:
+    def __init__(self, linger: float = WRITE_LINGER, max_rows: int = WRITE_MAX_ROWS,
+                 journal: Journal | None = None):
+        self.linger   = linger
+        self.max_rows = max_rows
+        self.journal  = journal
+        self.inflight: set[int] = set()   # id журнала, которые сейчас в очереди
+        self.listeners: list[WriteListener] = []
+        self.failure_listeners: list[FailureListener] = []
+        self._lanes: dict[str, asyncio.Queue[WriteJob | None]] = {}   # sid → очередь
+        self._workers: dict[str, asyncio.Task] = {}
+        self._notifies: set[asyncio.Task] = set()
+        self._started = False
+        self._closed = False
+
+    def _lane(self, sid: str) -> asyncio.Queue:
+        q = self._lanes.get(sid)
+        if q is None:
+            q = self._lanes[sid] = asyncio.Queue()
+        if self._started and sid not in self._workers:
+            self._workers[sid] = asyncio.create_task(self._run(q), name=f"write-lane-{sid[:8]}")
+        return q
+
+    def start(self):
+        if not self._started:
+            self._started, self._closed = True, False
+            for sid in list(self._lanes):
+                self._lane(sid)
+
+    async def submit(self, city: str, sheet: str, rows: list[list],
+                     notify: Notify | None = None, chat_id: int | None = None,
+                     jid: int | None = None, at: list[int] | None = None,
+                     undo: int | None = None):
+        """Ставит строки в очередь (at — перезаписать эти строки листа вместо
+        append, undo — это отмена отправки с таким id). Новые строки сначала
+        пишутся в журнал (fsync — в потоке, не в event loop) и возвращается
+        только после этого; jid передаётся при повторе уже журналированной
+        записи."""
+        if self._closed:
+            raise RuntimeError("Очередь записи остановлена")
+        replay = jid is not None
+        if jid is None and self.journal:
+            jid = await asyncio.to_thread(self.journal.append, city, sheet, rows, chat_id, at, undo)
+        if jid is not None:
+            self.inflight.add(jid)
+        self._lane(city_sid(city)).put_nowait(
+            WriteJob(city, sheet, rows, notify, jid, at, overwrite=bool(at), replay=replay,
+                     chat_id=chat_id, undo=undo))
+
+    def qsize(self) -> int:
+        return sum(q.qsize() for q in self._lanes.values())
+
+    def lane_sizes(self) -> dict[str, int]:
+        """Глубина очереди по таблицам (sid → заданий)."""
+        return {sid: q.qsize() for sid, q in self._lanes.items()}
+
+    async def close(self):
+        """Дописывает всё, что уже в очередях, и останавливает воркеры."""
+        if not self._started:
+            return
+        self._closed = True
+        for q in self._lanes.values():
+            q.put_nowait(None)
+        await asyncio.gather(*self._workers.values())
+        self._workers.clear()
+        self._started = False
+        if self._notifies:
+            await asyncio.gather(*self._notifies, return_exceptions=True)
+
+    async def _run(self, queue: asyncio.Queue):
+        stop = False
+        while not stop:
+            job = await queue.get()
+            if job is None:
+                break
+            if self.linger and queue.empty():
+                await asyncio.sleep(self.linger)
+            batch, n_rows = [job], len(job.rows)
+            while n_rows < self.max_rows and not queue.empty():
+                nxt = queue.get_nowait()
+                if nxt is None:
+                    stop = True
+                    break
+                batch.append(nxt)
+                n_rows += len(nxt.rows)
+            await self._flush(batch)
+
+    async def _flush(self, batch: list[WriteJob]):
+        groups: dict[tuple[str, str], list[WriteJob]] = {}
+        single: list[WriteJob] = []
+        for job in batch:
+            if job.at or job.replay:
+                single.append(job)
+            else:
+                groups.setdefault((job.city, job.sheet), []).append(job)
+        for (city, sheet), jobs in groups.items():
+            await self._write(city, sheet, jobs)
+        for job in single:
+            await self._write(job.city, job.sheet, [job])
+
+    async def _write(self, city: str, sheet: str, jobs: list[WriteJob]):
+        rows = [r for j in jobs for r in j.rows]
+        jids = [j.jid for j in jobs if j.jid is not None]
+        at   = jobs[0].at if len(jobs) == 1 else None
+        err  = None
+        try:
+            resp = await self._apply(city, sheet, rows, jids, at, jobs[0].replay)
+            logging.info(f"Sheets {'update' if at else 'append'}: {city}/{sheet} "
+                         f"rows={len(rows)} jobs={len(jobs)}")
+        except Exception as e:
+            logging.error(f"Write error {city}/{sheet}: {e}", exc_info=True)
+            err = e
+            if isinstance(e, RowsMovedError) and jids and self.journal:
+                # Повтор не поможет: номера строк устарели навсегда
+                await asyncio.to_thread(self.journal.commit, jids)
+            for listener in self.failure_listeners:
+                try:
+                    listener(city, sheet, jobs)
+                except Exception as le:
+                    logging.error(f"Write failure listener error: {le}", exc_info=True)
+        else:
+            if at is None:
+                start = appended_start_row(resp)
+                for j in jobs:
+                    if start is not None:
+                        j.at = list(range(start, start + len(j.rows)))
+                        start += len(j.rows)
+            for listener in self.listeners:
+                try:
+                    res = listener(city, sheet, jobs)
+                    if inspect.isawaitable(res):
+                        await res
+                except Exception as e:
+                    logging.error(f"Write listener error: {e}", exc_info=True)
+        self.inflight.difference_update(jids)
+        for j in jobs:
+            if j.notify:
+                t = asyncio.create_task(self._safe_notify(j.notify, err))
+                self._notifies.add(t)
+                t.add_done_callback(self._notifies.discard)
+
+    async def _apply(self, city: str, sheet: str, rows: list[list], jids: list[int],
+                     at: list[int] | None, replay: bool = False) -> dict:
+        if at:
+            resp = await update_rows(city, sheet, at, rows)
+        else:
+            resp = await append_rows(city, sheet, rows, probe=replay)
+        if jids and self.journal:
+            await asyncio.to_thread(self.journal.commit, jids)   # fsync — не в event loop
+        return resp
+
+    @staticmethod
+    async def _safe_notify(notify: Notify, err: Exception | None):
+        try:
+            await notify(err)
+        except Exception as e:
+            logging.error(f"Notify error: {e}", exc_info=True)
+
+journal     = Journal()
+write_queue = WriteQueue(journal=journal)
+
+# ============================================================
+# 🪞  ЛОКАЛЬНАЯ КОПИЯ ЛИСТОВ (для чтения)
+# ============================================================
+# Листы «Продажи», «Смены…» и «Маркетинг» обоих городов зеркалируются в
+# SQLite. Синхронизация инкрементальная: листы только растут вниз, поэтому
+# тянем строки начиная с последней известной. Строки, которые пишет сам
+# бот, попадают в копию сразу после append (слушатель write_queue).
+
+REPLICA_DB            = os.getenv("REPLICA_DB", "replica.db")
+REPLICA_SYNC_INTERVAL = int(os.getenv("REPLICA_SYNC_INTERVAL", "300"))   # сек
+REPLICA_SHEETS        = ["Продажи", "Смены флористов", "Смены логистов", "Маркетинг"]
+
+def iso_day(value) -> str | None:
+    """'16.10.2026' / '16.10.26' → '2026-10-16', иначе None (шапка, мусор)."""
+    m = re.match(r"^\s*(\d{1,2})\.(\d{1,2})\.(\d{2,4})\s*$", str(value))
+    if not m:
+        return None
+    d, mth, y = (int(x) for x in m.groups())
+    if y < 100:
+        y += 2000
+    try:
+        return datetime(y, mth, d).strftime("%Y-%m-%d")
+    except ValueError:
+        return None
+
+def _casefold(v):
+    return v.casefold() if v else v
+
+class Replica:
+    def __init__(self, path: str = REPLICA_DB):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._readers: list[sqlite3.Connection] = []
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # NOCASE в SQLite понимает только латиницу
+        self._db.create_function("casefold", 1, _casefold, deterministic=True)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS rows ("
+            " city TEXT NOT NULL, sheet TEXT NOT NULL, row INTEGER NOT NULL,"
+            " day TEXT, name TEXT, data TEXT NOT NULL,"
+            " PRIMARY KEY (city, sheet, row))"
+        )
+        # (день, строка) — индекс «дата → строки листа»: и суммы по периоду, и
+        # выгрузка по порядку без сортировки
+        self._db.execute("DROP INDEX IF EXISTS rows_day")
+        self._db.execute("CREATE INDEX IF NOT EXISTS rows_day_row ON rows(city, sheet, day, row)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sync ("
+            " city TEXT NOT NULL, sheet TEXT NOT NULL, nrows INTEGER NOT NULL,"
+            " synced REAL, PRIMARY KEY (city, sheet))"
+        )
+        self.sync_listeners: list[Callable[[], Awaitable[None]]] = []
+
+    def _reader(self) -> sqlite3.Connection:
+        """Своё соединение на поток для отчётов: в WAL читатели не ждут ни
+        друг друга, ни писателя, поэтому города считаются параллельно."""
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, check_same_thread=False)
+            db.create_function("casefold", 1, _casefold, deterministic=True)
+            with self._lock:
+                self._readers.append(db)
+        return db
+
+    def nrows(self, city: str, sheet: str) -> int:
+        with self._lock:
+            r = self._db.execute("SELECT nrows FROM sync WHERE city = ? AND sheet = ?",
+                                 (city, sheet)).fetchone()
+        return r[0] if r else 0
+
+    def _store(self, city: str, sheet: str, at: list[int], rows: list[list], advance: bool):
+        values = [
+            (city, sheet, n, iso_day(r[0]) if r else None,
+             str(r[1]).strip() if sheet != "Маркетинг" and len(r) > 1 else None,
+             json.dumps(r, ensure_ascii=False))
+            for n, r in zip(at, rows)
+        ]
+        end = max(at)
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO rows (city, sheet, row, day, name, data)"
+                " VALUES (?, ?, ?, ?, ?, ?)", values,
+            )
+            if advance:
+                self._db.execute(
+                    "INSERT INTO sync (city, sheet, nrows, synced) VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT (city, sheet) DO UPDATE SET"
+                    " nrows = MAX(nrows, excluded.nrows), synced = excluded.synced",
+                    (city, sheet, end, time.time()),
+                )
+
+    async def sync_sheet(self, city: str, sheet: str) -> int:
+        """Дочитывает новые строки листа."""
+        known = self.nrows(city, sheet)
+        sid = city_sid(city)
+        rows = await sheets_scheduler.acall(
+            sid, "read", sheets_api.get, sid, a1(sheet, f"A{known + 1}:Z"),
+            valueRenderOption="UNFORMATTED_VALUE", dateTimeRenderOption="FORMATTED_STRING",
+        )
+        if rows:
+            await asyncio.to_thread(self._store, city, sheet,
+                                    list(range(known + 1, known + 1 + len(rows))), rows, True)
+        return len(rows)
+
+    async def sync_all(self) -> int:
+        pairs = [(c, sh) for c in SPREADSHEETS for sh in REPLICA_SHEETS]
+        results = await asyncio.gather(
+            *(self.sync_sheet(c, sh) for c, sh in pairs), return_exceptions=True,
+        )
+        total = 0
+        for (c, sh), res in zip(pairs, results):
+            if isinstance(res, Exception):
+                logging.warning(f"Replica sync failed for {c}/{sh}: {res}")
+            else:
+                total += res
+        return total
+
+    async def sync_loop(self):
+        await sheets_ready.wait()   # не открываем таблицы наперегонки с прогревом
+        first = True
+        while True:
+            n = await self.sync_all()
+            if n:
+                logging.info(f"Replica sync: {n} new rows")
+            if n or first:
+                for listener in self.sync_listeners:
+                    try:
+                        await listener()
+                    except Exception as e:
+                        logging.error(f"Replica listener error: {e}", exc_info=True)
+            first = False
+            await asyncio.sleep(REPLICA_SYNC_INTERVAL)
+
+    def name_counts(self, sheets: list[str]) -> list[tuple[str, str, str, int]]:
+        """(город, лист, имя, сколько строк) по листам sheets, без шапок.
+        Вызывать в потоке."""
+        marks = ",".join("?" * len(sheets))
+        return self._reader().execute(
+            f"SELECT city, sheet, name, COUNT(*) FROM rows WHERE sheet IN ({marks})"
+            " AND day IS NOT NULL AND name IS NOT NULL AND name != '' GROUP BY city, sheet, name",
+            sheets,
+        ).fetchall()
+
+    def iter_rows(self, sheets: list[str]) -> list[tuple[str, str, int, list]]:
+        """Все строки указанных листов: (город, лист, номер строки, значения)."""
+        marks = ",".join("?" * len(sheets))
+        with self._lock:
+            cur = self._db.execute(
+                f"SELECT city, sheet, row, data FROM rows WHERE sheet IN ({marks}) ORDER BY row",
+                sheets,
+            )
+            return [(c, sh, n, json.loads(d)) for c, sh, n, d in cur.fetchall()]
+
+    def header(self, city: str, sheet: str) -> list | None:
+        """Шапка листа (первая строка, если она не данные)."""
+        with self._lock:
+            r = self._db.execute(
+                "SELECT data FROM rows WHERE city = ? AND sheet = ? AND row = 1 AND day IS NULL",
+                (city, sheet),
+            ).fetchone()
+        return json.loads(r[0]) if r else None
+
+    def iter_range(self, city: str, sheet: str, day_from: str, day_to: str,
+                   batch: int = 500) -> Iterator[list]:
+        """Строки листа за [day_from, day_to] (ISO) по дате и номеру строки,
+        порциями по batch — в памяти не больше одной порции. Вызывать в потоке."""
+        cur = self._reader().execute(
+            "SELECT data FROM rows WHERE city = ? AND sheet = ? AND day BETWEEN ? AND ?"
+            " ORDER BY day, row", (city, sheet, day_from, day_to),
+        )
+        while chunk := cur.fetchmany(batch):
+            for (data,) in chunk:
+                yield json.loads(data)
+
+    def rows_at(self, city: str, sheet: str, at: list[int]) -> dict[int, list]:
+        """Строки листа с номерами at, которые есть в копии."""
+        marks = ",".join("?" * len(at))
+        with self._lock:
+            cur = self._db.execute(
+                f"SELECT row, data FROM rows WHERE city = ? AND sheet = ? AND row IN ({marks})",
+                [city, sheet, *at],
+            )
+            return {n: json.loads(d) for n, d in cur.fetchall()}
+
+    async def on_written(self, city: str, sheet: str, jobs: list[WriteJob]):
+        """Слушатель write_queue: кладёт только что записанные строки в копию."""
+        if sheet not in REPLICA_SHEETS:
+            return
+        at   = [n for j in jobs if j.at for n in j.at]
+        rows = [r for j in jobs if j.at for r in j.rows]
+        if not at:
+            return
+        # Водяной знак двигаем, только если между нами и копией нет пропуска
+        # (чужие строки, дописанные руками, подтянет следующий sync)
+        advance = min(at) == self.nrows(city, sheet) + 1
+        await asyncio.to_thread(self._store, city, sheet, at, rows, advance)
+
+    def sales_by(self, city: str, day_from: str, day_to: str, group: str = "name",
+                 name: str | None = None) -> list[tuple]:
+        """Итоги «Продаж» за [day_from, day_to] (ISO) по group = name | day.
+        Строки: (ключ, лиды, заказы, итого ₸)."""
+        col = "name" if group == "name" else "day"
+        sql = (f"SELECT {col}, SUM(CAST(json_extract(data, '$[3]') AS INTEGER)),"
+               " SUM(CAST(json_extract(data, '$[4]') AS INTEGER)),"
+               " SUM(CAST(json_extract(data, '$[19]') AS INTEGER))"
+               " FROM rows WHERE city = ? AND sheet = 'Продажи' AND day BETWEEN ? AND ?")
+        args = [city, day_from, day_to]
+        if name:
+            sql += " AND casefold(name) = ?"
+            args.append(name.strip().casefold())
+        sql += f" GROUP BY {col} ORDER BY {col}"
+        return self._reader().execute(sql, args).fetchall()
+
+    def close(self):
+        with self._lock:
+            for db in self._readers:
+                db.close()
+            self._readers.clear()
+            self._db.close()
+
+replica = Replica()
+write_queue.listeners.append(replica.on_written)
+
+# ============================================================
+# 🔁  ИНДЕКС ДУБЛЕЙ
+# ============================================================
+# Ключи (город, дата, имя, смена) для «Продаж» и (город, дата, имя, роль)
+# для смен → номер строки в листе. Заполняется из локальной копии после
+# синхронизации и обновляется на каждой записи, так что проверка на дубль —
+# один поиск в dict без запросов к Sheets. None = строка ещё в очереди.
+
+DUP_KEY_COLS = {"Продажи": 3, "Смены флористов": 2, "Смены логистов": 2}
+
+def dup_key(city: str, sheet: str, row: list) -> tuple | None:
+    n = DUP_KEY_COLS.get(sheet)
+    if n is None or len(row) < n:
+        return None
+    day = iso_day(row[0])
+    if day is None:
+        return None
+    return (city, sheet, day, str(row[1]).strip().casefold(),
+            *(str(v).strip() for v in row[2:n]))
+
+class DuplicateIndex:
+    def __init__(self):
+        self._rows: dict[tuple, int | None] = {}
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    async def seed(self, source: Replica):
+        rows = await asyncio.to_thread(source.iter_rows, list(DUP_KEY_COLS))
+        fresh: dict[tuple, int | None] = {}
+        for city, sheet, n, values in rows:
+            key = dup_key(city, sheet, values)
+            if key is not None:
+                fresh.setdefault(key, n)     # перезаписываем самую раннюю строку
+        # Строки, которые ещё в очереди, из копии не видны — сохраняем только
+        # их; записанные берём из копии. Строки, удалённые из листа руками,
+        # копия не замечает — перезапись на месте сверяет их (check_rows)
+        for key, n in self._rows.items():
+            if n is None:
+                fresh.setdefault(key, n)
+        self._rows = fresh
+        logging.info(f"Duplicate index: {len(fresh)} keys")
+
+    def find(self, city: str, sheet: str, row: list) -> tuple[bool, int | None]:
+        """(есть ли уже такая запись, номер её строки или None)."""
+        key = dup_key(city, sheet, row)
+        if key is None or key not in self._rows:
+            return False, None
+        return True, self._rows[key]
+
+    def mark(self, city: str, sheet: str, rows: list[list]):
+        for row in rows:
+            key = dup_key(city, sheet, row)
+            if key is not None:
+                self._rows.setdefault(key, None)
+
+    def on_failed(self, city: str, sheet: str, jobs: list[WriteJob]):
+        """Слушатель неудачи: строки уже не «записываются» — снимаем отметку,
+        иначе «♻️ Перезаписать» ждал бы их до перезапуска. Повтор из журнала
+        вернёт ключ в on_written."""
+        for j in jobs:
+            if j.overwrite:
+                continue
+            for row in j.rows:
+                key = dup_key(city, sheet, row)
+                if key is not None and key in self._rows and self._rows[key] is None:
+                    del self._rows[key]
+
+    def forget(self, city: str, sheet: str, at: list[int], rows: list[list]):
+        """Убирает записи строк at, стёртых /undo (если ключ ещё указывает на них)."""
+        for n, row in zip(at, rows):
+            key = dup_key(city, sheet, row)
+            if key is not None and self._rows.get(key) == n:
+                del self._rows[key]
+
+    def on_written(self, city: str, sheet: str, jobs: list[WriteJob]):
+        for j in jobs:
+            for n, row in zip(j.at or [], j.rows):
+                key = dup_key(city, sheet, row)
+                if key is not None and self._rows.get(key) is None:
+                    self._rows[key] = n
+
+dup_index = DuplicateIndex()
+write_queue.listeners.append(dup_index.on_written)
+write_queue.failure_listeners.append(dup_index.on_failed)
+replica.sync_listeners.append(lambda: dup_index.seed(replica))
+
+# ============================================================
+# 🔑  КЛЮЧИ ОТПРАВКИ (идемпотентность)
+# ============================================================
+# Каждая строка «Продаж» и смен несёт в скрытой колонке Z ключ отправки —
+# chat:message[:n] апдейта, из которого она родилась. По ключам:
+#   • повторная доставка апдейта или второе нажатие не ставит строку снова;
+#   • после таймаута/5xx на append ищем ключи в хвосте листа (одно чтение)
+#     и повторяем запись, только если их там нет;
+#   • повтор из журнала сначала проверяет, не дошла ли прошлая попытка.
+# Sheets не умеет идемпотентный append, поэтому «хеджировать» запись
+# вторым параллельным запросом нельзя — вместо этого медленный запрос
+# обрывается по SHEETS_TIMEOUT и проверяется по ключу.
+
+IDEM_COL    = 26                 # Z
+IDEM_SHEETS = list(DUP_KEY_COLS)
+IDEM_PROBE_ROWS = 50             # сколько строк до водяного знака копии захватывать при поиске
+
+def with_key(row: list, key: str | None) -> list:
+    """Дописывает ключ в колонку IDEM_COL. Промежуток — None: при записи
+    Google пропускает такие ячейки, не затирая формулы справа от данных."""
+    if not key:
+        return row
+    return row + [None] * (IDEM_COL - 1 - len(row)) + [key]
+
+def row_key(row: list) -> str | None:
+    key = row[IDEM_COL - 1] if len(row) >= IDEM_COL else None
+    return str(key) if key else None
+
+def visible(row: list) -> list:
+    """Строка без служебной колонки ключа (для выгрузки)."""
+    return row[:IDEM_COL - 1]
+
+async def find_keys(city: str, sheet: str, keys: list[str]) -> dict[str, int]:
+    """Ищет ключи в колонке Z от водяного знака копии до конца листа.
+    Ключ → номер строки."""
+    start = max(1, replica.nrows(city, sheet) - IDEM_PROBE_ROWS)
+    col, sid = _col(IDEM_COL), city_sid(city)
+    values = await sheets_scheduler.acall(sid, "read", sheets_api.get, sid,
+                                          a1(sheet, f"{col}{start}:{col}"))
+    wanted, found = set(keys), {}
+    for i, r in enumerate(values):
+        if r and str(r[0]) in wanted:
+            found.setdefault(str(r[0]), start + i)
+    return found
+
+class IdempotencyIndex:
+    """Ключ отправки → номер строки (None — ещё в очереди)."""
+
+    def __init__(self):
+        self._rows: dict[str, int | None] = {}
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._rows
+
+    async def seed(self, source: Replica):
+        rows = await asyncio.to_thread(source.iter_rows, IDEM_SHEETS)
+        fresh: dict[str, int | None] = {}
+        for _, _, n, values in rows:
+            key = row_key(values)
+            if key:
+                fresh[key] = n
+        # Из старого индекса — только ключи, которые ещё в очереди (None):
+        # записанные есть в копии
+        for key, n in self._rows.items():
+            if n is None:
+                fresh.setdefault(key, n)
+        self._rows = fresh
+        logging.info(f"Idempotency index: {len(fresh)} keys")
+
+    def claim(self, rows: list[list]) -> list[list]:
+        """Оставляет строки, чьих ключей ещё не было, и запоминает их ключи."""
+        out = []
+        for row in rows:
+            key = row_key(row)
+            if key is not None:
+                if key in self._rows:
+                    continue
+                self._rows[key] = None
+            out.append(row)
+        return out
+
+    def response(self, sheet: str, keys: list[str],
+                 found: Mapping[str, int | None] | None = None) -> dict | None:
+        """Ответ как у append, если все ключи уже записаны (по found или по
+        индексу): одна порция всегда ложится подряд, начало — первый ключ."""
+        found = self._rows if found is None else found
+        if not keys or any(found.get(k) is None for k in keys):
+            return None
+        return {"updates": {"updatedRange": f"'{sheet}'!A{found[keys[0]]}"}}
+
+    def on_written(self, city: str, sheet: str, jobs: list[WriteJob]):
+        for j in jobs:
+            for n, row in zip(j.at or [], j.rows):
+                key = row_key(row)
+                if key:
+                    self._rows[key] = n
+
+    def on_failed(self, city: str, sheet: str, jobs: list[WriteJob]):
+        """Слушатель неудачи: отпускает ключи незаписанных строк, чтобы
+        повторная отправка не считалась уже принятой. Повтор из журнала
+        сперва ищет ключи в листе (probe) и не допишет то, что уже дошло."""
+        for j in jobs:
+            for row in j.rows:
+                key = row_key(row)
+                if key and key in self._rows and self._rows[key] is None:
+                    del self._rows[key]
+
+    def forget(self, at: list[int], rows: list[list]):
+        """Убирает ключи строк at, стёртых или заменённых /undo."""
+        for n, row in zip(at, rows):
+            key = row_key(row)
+            if key and self._rows.get(key) == n:
+                del self._rows[key]
+
+idem_index = IdempotencyIndex()
+write_queue.listeners.append(idem_index.on_written)
+write_queue.failure_listeners.append(idem_index.on_failed)
+replica.sync_listeners.append(lambda: idem_index.seed(replica))
+
+# ============================================================
+# 🔤  ИМЕНА
+# ============================================================
+# Имена менеджеров, флористов и логистов вводятся текстом, и «Дилара»,
+# «дилара » и «Дилара А.» дробят все итоги по людям. Индекс имён по
+# (город, лист) строится из копии таблиц и справочника, пополняется на
+# каждой записи и разрешает введённое имя так:
+#   • то же имя с точностью до регистра, пробелов, «ё» и точек — заменяется
+#     написанием, которое в таблице встречается чаще всего;
+#   • имя с инициалом («Дилара А.» ↔ «Дилара», «Дилара Ахметова») — тоже,
+#     если подходит ровно одно известное имя;
+#   • лишняя или другая фамилия целиком («Дилара Бекова» при известной
+#     «Дилара») — уже не сворачивается: это может быть другой человек,
+#     такие имена идут первыми в подсказке;
+#   • иначе похожие по триграммам имена предлагаются на выбор.
+# Имена с разными числами («Флорист 2» и «Флорист 3») — разные люди.
+# Кандидаты берутся из списков триграмм и по первому слову, а не перебором
+# всех имён.
+
+NAME_SHEETS      = list(DUP_KEY_COLS)
+NAME_SUGGEST_MIN = 0.5        # порог сходства: коэффициент Дайса по триграммам
+NAME_SUGGEST_MAX = 3
+NAME_REFERENCE_WEIGHT = 1_000_000   # написание из справочника важнее частоты в таблице
+
+def name_norm(name: str) -> str:
+    s = re.sub(r"[^\w\s-]", " ", name.casefold().replace("ё", "е"))
+    return " ".join(s.split())
+
+def _trigrams(norm: str) -> set[str]:
+    s = f"  {norm} "
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+def _initials_match(a: list[str], b: list[str]) -> bool:
+    """«дилара а» ~ «дилара» и «дилара ахметова», но не «дилара бекова»
+    и не «дилара ахметова» ~ «дилара»: лишнее или несовпавшее слово
+    допустимо, только если это инициал."""
+    if a == b or a[0] != b[0]:
+        return False
+    for i in range(1, max(len(a), len(b))):
+        x = a[i] if i < len(a) else ""
+        y = b[i] if i < len(b) else ""
+        if x != y and not (len(x) == 1 and y[:1] in ("", x) or len(y) == 1 and x[:1] in ("", y)):
+            return False
+    return True
+
+def _extends(a: list[str], b: list[str]) -> bool:
+    """Одно имя — начало другого: «дилара» и «дилара бекова»."""
+    n = min(len(a), len(b))
+    return a != b and a[:n] == b[:n]
+
+class NameIndex:
+    def __init__(self):
+        # (город, лист) → норма → написания с частотой
+        self._spellings: dict[tuple[str, str], dict[str, Counter[str]]] = {}
+        # (город, лист) → триграмма → нормы
+        self._grams: dict[tuple[str, str], dict[str, set[str]]] = {}
+        # (город, лист) → первое слово → нормы
+        self._first: dict[tuple[str, str], dict[str, set[str]]] = {}
+
+    def __len__(self) -> int:
+        return sum(len(v) for v in self._spellings.values())
+
+    def add(self, city: str, sheet: str, name, weight: int = 1):
+        name = str(name).strip()
+        norm = name_norm(name)
+        if not norm:
+            return
+        scope = (city, sheet)
+        spellings = self._spellings.setdefault(scope, {})
+        if norm not in spellings:
+            spellings[norm] = Counter()
+            grams = self._grams.setdefault(scope, {})
+            for g in _trigrams(norm):
+                grams.setdefault(g, set()).add(norm)
+            self._first.setdefault(scope, {}).setdefault(norm.split()[0], set()).add(norm)
+        spellings[norm][name] += weight
+
+    def _canonical(self, scope: tuple[str, str], norm: str) -> str:
+        return self._spellings[scope][norm].most_common(1)[0][0]
+
+    def resolve(self, city: str, sheet: str, name: str) -> tuple[str | None, list[str]]:
+        """(каноническое написание или None, похожие имена для подсказки)."""
+        scope, norm = (city, sheet), name_norm(name)
+        spellings = self._spellings.get(scope)
+        if not norm or not spellings:
+            return None, []
+        if norm in spellings:
+            return self._canonical(scope, norm), []
+        digits = re.findall(r"\d+", norm)
+        tokens = norm.split()
+        first = [n for n in self._first[scope].get(tokens[0], ()) if re.findall(r"\d+", n) == digits]
+        same = [n for n in first if _initials_match(tokens, n.split())]
+        if len(same) == 1:
+            return self._canonical(scope, same[0]), []
+        # «Дилара Бекова» при известной «Дилара» — только с подтверждением
+        longer = sorted(n for n in first if _extends(tokens, n.split()))
+        grams = _trigrams(norm)
+        common: Counter[str] = Counter()
+        index = self._grams[scope]
+        for g in grams:
+            common.update(index.get(g, ()))
+        # Дайс 2k / (|a| + |b|); у нормы из n символов ≈ n + 1 разных триграмм
+        scored = sorted((2 * k / (len(grams) + len(n) + 1), n) for n, k in common.items()
+                        if 2 * k / (len(grams) + len(n) + 1) >= NAME_SUGGEST_MIN
+                        and re.findall(r"\d+", n) == digits and n not in longer)
+        hints = longer + [n for _, n in scored[::-1]]
+        return None, [self._canonical(scope, n) for n in hints[:NAME_SUGGEST_MAX]]
+
+    async def seed(self, source: Replica):
+        counts = await asyncio.to_thread(source.name_counts, NAME_SHEETS)
+        fresh = NameIndex()
+        for city, sheet, name, n in counts:
+            fresh.add(city, sheet, name, n)
+        for city in CITIES:
+            for m in reference[city].managers:
+                fresh.add(city, "Продажи", m, NAME_REFERENCE_WEIGHT)
+        self._spellings, self._grams, self._first = fresh._spellings, fresh._grams, fresh._first
+        logging.info(f"Name index: {len(self)} names")
+
+    def on_written(self, city: str, sheet: str, jobs: list[WriteJob]):
+        if sheet not in NAME_SHEETS:
+            return
+        for j in jobs:
+            for row in j.rows:
+                if len(row) > 1:
+                    self.add(city, sheet, row[1])
+
+name_index = NameIndex()
+write_queue.listeners.append(name_index.on_written)
+replica.sync_listeners.append(lambda: name_index.seed(replica))
+
+# ============================================================
+# 📊  СВОДКИ
+# ============================================================
+# Итоги по дням и неделям обновляются на каждой записи (O(1) на строку)
+# и раз в ROLLUP_FLUSH_INTERVAL секунд уходят на лист SUMMARY_SHEET своей
+# таблицы одним batch_update — только изменившиеся строки. На листе три
+# таблицы рядом:
+#   A:T   — продажи: период × менеджер, лиды, заказы, 14 оплат, итого
+#   V:Z   — смены: период × роль, полных и пол-смены
+#   AB:AI — маркетинг: период, план/факт лидов, расход $ и ₸, продажи, ₸ за лид
+# После синхронизации копии сводка пересчитывается из неё целиком (так в
+# неё попадают и строки, внесённые руками) и лист переписывается полностью.
+
+SUMMARY_SHEET         = os.getenv("SUMMARY_SHEET", "Сводка")
+ROLLUP_FLUSH_INTERVAL = int(os.getenv("ROLLUP_FLUSH_INTERVAL", "60"))   # сек
+
+# блок → (первая колонка, шапка)
+ROLLUP_BLOCKS = {
+    "sales":     (1,  ["Период", "Дата", "Менеджер", "Лиды", "Заказы",
+                       *(label.split(" ", 1)[1] for _, label in PAYMENT_STEPS), "Итого"]),
+    "shifts":    (22, ["Период", "Дата", "Роль", "Полных", "Пол-смены"]),
+    "marketing": (28, ["Период", "Дата", "План", "Факт", "Расход $", "Расход ₸", "Продаж",
+                       "₸ за лид"]),
+}
+
+def _col(n: int) -> str:
+    """Номер колонки → буквы (1 → A, 28 → AB)."""
+    letters = ""
+    while n:
+        n, r = divmod(n - 1, 26)
+        letters = chr(65 + r) + letters
+    return letters
+
+def _num(v) -> float:
+    if isinstance(v, (int, float)):
+        return v
+    try:
+        return float(str(v).replace(" ", "").replace(",", "."))
+    except ValueError:
+        return 0
+
+def _cellv(x: float):
+    return int(x) if float(x).is_integer() else round(x, 2)
+
+def rollup_item(sheet: str, row: list) -> tuple[str, str, list[float]] | None:
+    """Вклад строки листа в сводку: (блок, ключ, слагаемые) или None."""
+    g = lambda i: _num(row[i]) if len(row) > i else 0
+    if sheet == "Продажи":
+        if len(row) < 5 or not str(row[1]).strip():
+            return None
+        n = len(PAYMENT_STEPS)
+        return "sales", str(row[1]).strip(), [g(i) for i in range(3, 5 + n)] + [g(5 + n)]
+    if sheet in ("Смены флористов", "Смены логистов"):
+        if len(row) < 2 or not str(row[1]).strip():
+            return None
+        half = len(row) > 2 and str(row[2]).strip() == "Пол-смены"
+        role = "Флорист" if sheet == "Смены флористов" else "Логист"
+        return "shifts", role, [0, 1] if half else [1, 0]
+    if sheet == "Маркетинг":
+        return "marketing", "", [g(1), g(2), g(4), g(4) * g(10), g(6)]
+    return None
+
+class Rollups:
+    def __init__(self, source: Replica):
+        self.source = source
+        # (город, блок, период, день ISO, ключ) → суммы
+        self._cells: dict[tuple, list[float]] = {}
+        self._rows:  dict[tuple, int] = {}             # тот же ключ → строка на листе
+        self._next:  dict[tuple[str, str], int] = {}   # (город, блок) → первая свободная строка
+        self._used:  dict[tuple[str, str], int] = {}   # (город, блок) → последняя записанная строка
+        self._dirty: set[tuple] = set()
+        self._full:  set[str] = set()                  # города, где лист переписываем целиком
+        self._grid:  dict[str, dict] = {}              # город → properties листа сводки
+        self._writes = 0
+        self.ready = False                             # сводка уже посчитана из копии
+
+    def _add(self, city: str, sheet: str, row: list, sign: int = 1):
+        item = rollup_item(sheet, row)
+        day = iso_day(row[0]) if row else None
+        if item is None or day is None:
+            return
+        block, key, values = item
+        d = datetime.fromisoformat(day)
+        monday = (d - timedelta(days=d.weekday())).strftime("%Y-%m-%d")
+        for period, start in (("день", day), ("неделя", monday)):
+            k = (city, block, period, start, key)
+            cell = self._cells.get(k)
+            if cell is None:
+                cell = self._cells[k] = [0.0] * len(values)
+                self._rows[k] = self._next.get((city, block), 2)
+                self._next[(city, block)] = self._rows[k] + 1
+            for i, x in enumerate(values):
+                cell[i] += sign * x
+            self._dirty.add(k)
+
+    def on_written(self, city: str, sheet: str, jobs: list[WriteJob]):
+        """Слушатель write_queue. Должен стоять раньше replica.on_written:
+        при перезаписи старые значения вычитаются по строке из копии."""
+        if sheet not in REPLICA_SHEETS:
+            return
+        for j in jobs:
+            if j.overwrite and j.at:
+                for old in self.source.rows_at(city, sheet, j.at).values():
+                    self._add(city, sheet, old, -1)
+            for row in j.rows:
+                self._add(city, sheet, row)
+        self._writes += 1
+
+    def _build(self) -> "Rollups":
+        fresh = Rollups(self.source)
+        for city, sheet, _, values in self.source.iter_rows(REPLICA_SHEETS):
+            if city in CITIES:
+                fresh._add(city, sheet, values)
+        # Полный пересчёт — заодно раскладываем строки по порядку дат
+        fresh._next.clear()
+        for k in sorted(fresh._cells, key=lambda k: (k[2], k[3], k[4])):
+            fresh._rows[k] = fresh._next.get((k[0], k[1]), 2)
+            fresh._next[(k[0], k[1])] = fresh._rows[k] + 1
+        return fresh
+
+    async def seed(self):
+        """Пересчёт из копии (слушатель синхронизации). Если пока считали,
+        пришли новые записи, — считаем ещё раз: они уже есть в копии."""
+        for _ in range(3):
+            writes = self._writes
+            fresh = await asyncio.to_thread(self._build)
+            if writes == self._writes:
+                break
+        self._cells, self._rows, self._next = fresh._cells, fresh._rows, fresh._next
+        self._dirty.clear()
+        self._full = set(SPREADSHEETS)
+        self.ready = True
+        logging.info(f"Rollups: {len(self._cells)} rows rebuilt")
+
+    def _render(self, k: tuple) -> list:
+        _, block, period, start, key = k
+        v = self._cells[k]
+        head = [period, datetime.fromisoformat(start).strftime("%d.%m.%Y")]
+        if block == "marketing":
+            return head + [_cellv(x) for x in v] + [round(v[3] / v[1]) if v[1] else ""]
+        return head + [key] + [_cellv(x) for x in v]
+
+    async def _summary(self, city: str) -> dict:
+        """properties листа сводки; листа нет — создаём."""
+        props = self._grid.get(city)
+        if props is not None:
+            return props
+        sid = city_sid(city)
+        sheets = await sheets_scheduler.acall(sid, "read", sheets_api.sheet_properties, sid)
+        props = sheets.get(SUMMARY_SHEET)
+        if props is None:
+            new = {"title": SUMMARY_SHEET, "gridProperties": {"rowCount": 1000, "columnCount": 40}}
+            resp = await sheets_scheduler.acall(sid, "write", sheets_api.batch_update_spreadsheet,
+                                                sid, [{"addSheet": {"properties": new}}])
+            props = resp["replies"][0]["addSheet"]["properties"]
+            logging.info(f"Rollups: created {city}/{SUMMARY_SHEET}")
+        self._grid[city] = props
+        return props
+
+    async def _write(self, city: str, data: list[dict]):
+        sid = city_sid(city)
+        props = await self._summary(city)
+        grid = props.setdefault("gridProperties", {})
+        need = max(int(re.search(r"\d+", d["range"]).group()) + len(d["values"]) - 1 for d in data)
+        cols = max(col + len(header) - 1 for col, header in ROLLUP_BLOCKS.values())
+        grow = []
+        if need > grid.get("rowCount", need):
+            grow.append(("ROWS", need - grid["rowCount"] + 500))
+        if cols > grid.get("columnCount", cols):
+            grow.append(("COLUMNS", cols - grid["columnCount"]))
+        if grow:
+            await sheets_scheduler.acall(sid, "write", sheets_api.batch_update_spreadsheet, sid, [
+                {"appendDimension": {"sheetId": props["sheetId"], "dimension": dim, "length": n}}
+                for dim, n in grow
+            ])
+            for dim, n in grow:
+                key = "rowCount" if dim == "ROWS" else "columnCount"
+                grid[key] += n
+        await sheets_scheduler.acall(sid, "write", sheets_api.batch_update, sid, [
+            {"range": a1(SUMMARY_SHEET, d["range"]), "values": d["values"]} for d in data
+        ])
+
+    async def flush(self):
+        """Один batch_update на таблицу: изменившиеся строки сводки, а после
+        пересчёта — лист целиком (шапки, все строки, хвост старой раскладки)."""
+        if not self.ready:
+            return
+        dirty, self._dirty = self._dirty, set()
+        full, self._full = self._full, set()
+        data: dict[str, list[dict]] = {}
+        for city in full:
+            for block, (col, header) in ROLLUP_BLOCKS.items():
+                data.setdefault(city, []).append({"range": f"{_col(col)}1", "values": [header]})
+                last = self._next.get((city, block), 2) - 1
+                stale = self._used.get((city, block), 1) - last
+                if stale > 0:
+                    data[city].append({"range": f"{_col(col)}{last + 1}",
+                                       "values": [[""] * len(header)] * stale})
+        keys = [k for k in self._cells if k[0] in full] + [k for k in dirty if k[0] not in full]
+        for k in keys:
+            data.setdefault(k[0], []).append(
+                {"range": f"{_col(ROLLUP_BLOCKS[k[1]][0])}{self._rows[k]}", "values": [self._render(k)]})
+        if not data:
+            return
+        cities = list(data)
+        results = await asyncio.gather(
+            *(self._write(c, data[c]) for c in cities), return_exceptions=True,
+        )
+        for city, res in zip(cities, results):
+            if isinstance(res, Exception):
+                logging.warning(f"Rollups flush failed for {city}: {res}")
+                self._grid.pop(city, None)      # лист могли удалить или переименовать
+                self._full.add(city)            # в следующий раз перепишем целиком
+                continue
+            for block in ROLLUP_BLOCKS:
+                self._used[(city, block)] = self._next.get((city, block), 2) - 1
+            logging.info(f"Rollups flush: {city} — {len(data[city])} ranges")
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(ROLLUP_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Rollups flush error: {e}", exc_info=True)
+
+rollups = Rollups(replica)
+write_queue.listeners.insert(0, rollups.on_written)   # раньше replica.on_written
+replica.sync_listeners.append(rollups.seed)
+
+# ============================================================
+# 🕘  ИСТОРИЯ ОТПРАВОК (/history, /undo)
+# ============================================================
+# Слушатель write_queue запоминает, куда легла каждая отправка: чат, лист,
+# номера строк из ответа append (или at перезаписи), а при перезаписи —
+# прежние значения строк из копии. /history читает только этот индекс,
+# /undo ставит в очередь одну перезапись тех же строк — прежними
+# значениями или пустыми ячейками с отметкой UNDONE_MARK в колонке ключа:
+# совсем пустая строка посреди листа разорвала бы таблицу, и append
+# Google начал бы дописывать в эту дыру. Таблицу при этом не читаем: что
+# строки с тех пор никто не переписал, проверяем по копии. Отмена идёт
+# через журнал с id отправки, так что отметку «отменено» и индексы
+# обновляет слушатель записи — и после повтора из журнала тоже.
+
+HISTORY_DB        = os.getenv("HISTORY_DB", JOURNAL_DB)
+HISTORY_KEEP_DAYS = int(os.getenv("HISTORY_KEEP_DAYS", "30"))   # сколько хранить отправки
+HISTORY_SHOW      = 5       # /history без числа
+HISTORY_SHOW_MAX  = 30
+UNDONE_MARK       = "undone:"   # + id отправки, в колонке ключа отменённой строки
+
+@dataclass
+class Submission:
+    id:      int
+    city:    str
+    sheet:   str
+    at:      list[int]
+    rows:    list[list]
+    prev:    list[list | None] | None   # значения строк до перезаписи (None — был append)
+    created: float
+    undone:  float | None = None
+
+def _cells(row: list) -> list[str]:
+    out = ["" if v is None else str(v).strip() for v in row]
+    while out and not out[-1]:
+        out.pop()
+    return out
+
+def same_row(a: list, b: list) -> bool:
+    """Та же ли это запись: по ключу отправки, если он есть, иначе по значениям."""
+    if row_key(a) or row_key(b):
+        return row_key(a) == row_key(b)
+    return _cells(a) == _cells(b)
+
+def undo_row(row: list, old: list | None, sub_id: int) -> list:
+    """Отмена записанной строки row: в занятые ею ячейки — прежние значения
+    old или пусто; ячейки, которые она пропустила (None), не трогаем.
+    Добавленная строка (old нет) получает отметку в колонке ключа."""
+    if old is None:
+        return with_key([None if v is None else "" for v in visible(row)], f"{UNDONE_MARK}{sub_id}")
+    return [None if v is None else old[i] if i < len(old) and old[i] is not None else ""
+            for i, v in enumerate(row)]
+
+class History:
+    """Чат → отправки: в какие строки какого листа легли его данные."""
+
+    def __init__(self, source: Replica, path: str = HISTORY_DB):
+        self.source = source
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL,"
+            " city TEXT NOT NULL, sheet TEXT NOT NULL, at TEXT NOT NULL, rows TEXT NOT NULL,"
+            " prev TEXT, created REAL NOT NULL, undone REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS history_chat ON history(chat_id, id)")
+
+    async def on_written(self, city: str, sheet: str, jobs: list[WriteJob]):
+        """Слушатель write_queue. Должен стоять раньше replica.on_written:
+        прежние значения перезаписанных строк берутся из копии."""
+        values = []
+        for j in jobs:
+            if j.chat_id is None or not j.at:
+                continue
+            prev = None
+            if j.overwrite:
+                old = self.source.rows_at(city, sheet, j.at)
+                prev = [old.get(n) for n in j.at]
+            values.append((j.chat_id, city, sheet, json.dumps(j.at),
+                           json.dumps(j.rows, ensure_ascii=False),
+                           json.dumps(prev, ensure_ascii=False) if prev else None, time.time()))
+        if values:
+            await asyncio.to_thread(self._insert, values)
+
+    def _insert(self, values: list[tuple]):
+        with self._lock:
+            self._db.executemany(
+                "INSERT INTO history (chat_id, city, sheet, at, rows, prev, created)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)", values,
+            )
+
+    def _select(self, where: str, args: tuple, limit: int) -> list[Submission]:
+        with self._lock:
+            cur = self._db.execute(
+                "SELECT id, city, sheet, at, rows, prev, created, undone FROM history"
+                f" WHERE {where} ORDER BY id DESC LIMIT ?", (*args, limit),
+            )
+            return [Submission(i, c, sh, json.loads(at), json.loads(r),
+                               json.loads(p) if p else None, cr, u)
+                    for i, c, sh, at, r, p, cr, u in cur.fetchall()]
+
+    def last(self, chat_id: int, n: int = HISTORY_SHOW) -> list[Submission]:
+        """Последние n отправок чата, новые первыми."""
+        return self._select("chat_id = ?", (chat_id,), n)
+
+    def get(self, chat_id: int, sub_id: int | None = None) -> Submission | None:
+        """Отправка sub_id этого чата или его последняя не отменённая."""
+        if sub_id is None:
+            found = self._select("chat_id = ? AND undone IS NULL", (chat_id,), 1)
+        else:
+            found = self._select("chat_id = ? AND id = ?", (chat_id, sub_id), 1)
+        return found[0] if found else None
+
+    def undo_rows(self, s: Submission) -> list[list] | None:
+        """Значения, которые отменяют s, или None, если строки с тех пор
+        переписаны (в копии уже не то, что записала эта отправка)."""
+        current = self.source.rows_at(s.city, s.sheet, s.at)
+        if any(n in current and not same_row(current[n], row) for n, row in zip(s.at, s.rows)):
+            return None
+        return [undo_row(row, old, s.id)
+                for row, old in zip(s.rows, s.prev or [None] * len(s.rows))]
+
+    def mark_undone(self, ids: list[int]) -> list[Submission]:
+        """Отмечает отправки отменёнными; возвращает их (ещё не отмеченные)."""
+        marks = ",".join("?" * len(ids))
+        found = self._select(f"id IN ({marks}) AND undone IS NULL", tuple(ids), len(ids))
+        with self._lock:
+            self._db.executemany("UPDATE history SET undone = ? WHERE id = ?",
+                                 [(time.time(), s.id) for s in found])
+        return found
+
+    async def on_undone(self, city: str, sheet: str, jobs: list[WriteJob]):
+        """Слушатель write_queue: отмена из /undo легла в таблицу (в том числе
+        повтором из журнала) — отмечаем отправку и снимаем её строки с
+        индексов ключей и дублей. Стоит после их on_written."""
+        ids = [j.undo for j in jobs if j.undo is not None]
+        if not ids:
+            return
+        for s in await asyncio.to_thread(self.mark_undone, ids):
+            idem_index.forget(s.at, s.rows)
+            if s.prev is None:
+                dup_index.forget(s.city, s.sheet, s.at, s.rows)
+
+    def prune(self, keep_days: int = HISTORY_KEEP_DAYS) -> int:
+        with self._lock:
+            cur = self._db.execute("DELETE FROM history WHERE created < ?",
+                                   (time.time() - keep_days * 86400,))
+            return cur.rowcount
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+history = History(replica)
+write_queue.listeners.insert(0, history.on_written)   # раньше replica.on_written
+write_queue.listeners.append(history.on_undone)
 
 # ============================================================
 # ⌨️  КЛАВИАТУРЫ
@@ -141,28 +2237,128 @@ def kb(*rows):
 main_kb   = kb(["📊 Отчёт менеджера", "🌺 Смены флористов"],
                ["🚗 Смены логистов",  "🎯 Маркетинг"],
                ["📋 Помощь"])
-city_kb   = kb(["🏙 Астана", "🏔 Алматы"], ["❌ Отмена"])
+city_kb   = kb(*[list(CITY_BY_BUTTON)[i:i+2] for i in range(0, len(CITY_BY_BUTTON), 2)],
+               ["❌ Отмена"])
 cancel_kb = kb(["❌ Отмена"])
 skip_kb   = kb(["0 — пропустить"], ["❌ Отмена"])
 
-def managers_kb(city: str):
-    names = MANAGERS.get(city, [])
+def _managers_kb(names: tuple[str, ...]):
     if not names:
         return cancel_kb
-    rows = [names[i:i+3] for i in range(0, len(names), 3)]
+    rows = [list(names[i:i+3]) for i in range(0, len(names), 3)]
     rows.append(["✏️ Другой менеджер"])
     rows.append(["❌ Отмена"])
     return kb(*rows)
 
-shifts_kb = kb(SHIFTS, ["❌ Отмена"])
+def managers_kb(city: str):
+    return reference[city].managers_kb if city in reference else cancel_kb
+
+def shifts_kb(city: str):
+    return reference[city].shifts_kb
+
+_dates_kb: tuple[str, ReplyKeyboardMarkup] | None = None   # (сегодня, клавиатура)
 
 def dates_kb():
+    """Клавиатура «Сегодня / Вчера» — пересобирается раз в сутки."""
+    global _dates_kb
     today = datetime.now().strftime("%d.%m.%Y")
-    yesterday = (datetime.now() - timedelta(days=1)).strftime("%d.%m.%Y")
-    return kb([f"📅 Сегодня ({today})", f"📅 Вчера ({yesterday})"],
-              ["✏️ Другая дата"], ["❌ Отмена"])
+    if _dates_kb is None or _dates_kb[0] != today:
+        yesterday = (datetime.now() - timedelta(days=1)).strftime("%d.%m.%Y")
+        _dates_kb = (today, kb([f"📅 Сегодня ({today})", f"📅 Вчера ({yesterday})"],
+                               ["✏️ Другая дата"], ["❌ Отмена"]))
+    return _dates_kb[1]
 
 confirm_kb = kb(["✅ Записать", "🔄 Начать заново"], ["❌ Отмена"])
+dup_kb     = kb(["♻️ Перезаписать", "⏭ Пропустить"], ["🔄 Начать заново", "❌ Отмена"])
+dup_schedule_kb = kb(["♻️ Перезаписать", "⏭ Пропустить дубли"], ["❌ Отмена"])
+names_kb   = kb(["🔤 Исправить", "✏️ Оставить как есть"], ["❌ Отмена"])
+NEW_NAME   = "➕ Новое имя: "
+
+# ============================================================
+# 📚  СПРАВОЧНИК
+# ============================================================
+# Менеджеров и смены города можно вести на листе «Справочник» его таблицы:
+# колонка A — менеджеры, B — смены, первая строка — шапка. Нет листа или
+# колонка пуста — берём из реестра городов. Лист перечитывается фоном раз в
+# REFERENCE_REFRESH секунд (одно чтение на город); если содержимое то же,
+# ничего не пересобирается. Клавиатуры строятся один раз на версию
+# справочника, а фильтр кнопок смен смотрит в shift_buttons, который
+# обновляется на месте, — хендлеры справочник не читают и не ждут.
+
+REFERENCE_SHEET   = "Справочник"
+REFERENCE_REFRESH = int(os.getenv("REFERENCE_REFRESH", "300"))   # сек между проверками
+
+@dataclass(frozen=True)
+class CityReference:
+    managers:    tuple[str, ...]
+    shifts:      tuple[str, ...]
+    version:     int
+    managers_kb: ReplyKeyboardMarkup
+    shifts_kb:   ReplyKeyboardMarkup
+
+def _column(rows: list[list], i: int) -> tuple[str, ...]:
+    return tuple(dict.fromkeys(v for r in rows if len(r) > i and (v := str(r[i]).strip())))
+
+class Reference:
+    def __init__(self, cities: dict[str, City]):
+        self._cities: dict[str, CityReference] = {}
+        self.shift_buttons: set[str] = set()     # все смены всех городов (для F.text.in_)
+        self.version = 0
+        for c in cities.values():
+            self._set(c.name, c.managers, c.shifts)
+
+    def __contains__(self, city: str) -> bool:
+        return city in self._cities
+
+    def __getitem__(self, city: str) -> CityReference:
+        return self._cities[city]
+
+    def _set(self, city: str, managers: tuple[str, ...], shifts: tuple[str, ...]) -> bool:
+        cur = self._cities.get(city)
+        if cur is not None and (cur.managers, cur.shifts) == (managers, shifts):
+            return False
+        self.version += 1
+        self._cities[city] = CityReference(managers, shifts, self.version, _managers_kb(managers),
+                                           kb(list(shifts), ["❌ Отмена"]))
+        buttons = {sh for r in self._cities.values() for sh in r.shifts}
+        self.shift_buttons.intersection_update(buttons)
+        self.shift_buttons.update(buttons)
+        return True
+
+    async def load(self, city: str) -> bool:
+        """Перечитывает справочник города; True — он изменился."""
+        c = CITIES[city]
+        try:
+            rows = await sheets_scheduler.acall(c.sid, "read", sheets_api.get, c.sid,
+                                                a1(REFERENCE_SHEET, "A2:B"))
+        except SheetsAPIError as e:
+            if e.status != 400:            # 400 — такого листа нет
+                raise
+            rows = []
+        managers, shifts = _column(rows, 0), _column(rows, 1)
+        if not self._set(city, managers or c.managers, shifts or c.shifts):
+            return False
+        for m in managers:
+            name_index.add(city, "Продажи", m, NAME_REFERENCE_WEIGHT)
+        r = self._cities[city]
+        logging.info(f"Reference {city}: {len(r.managers)} managers, {len(r.shifts)} shifts "
+                     f"(version {r.version}{', sheet' if managers or shifts else ''})")
+        return True
+
+    async def refresh(self):
+        cities = list(CITIES)
+        results = await asyncio.gather(*(self.load(c) for c in cities), return_exceptions=True)
+        for city, res in zip(cities, results):
+            if isinstance(res, Exception):
+                logging.warning(f"Reference refresh failed for {city}: {res}")
+
+    async def refresh_loop(self):
+        await sheets_ready.wait()
+        while True:
+            await self.refresh()
+            await asyncio.sleep(REFERENCE_REFRESH)
+
+reference = Reference(CITIES)
 
 # ============================================================
 # 🤖  FSM СОСТОЯНИЯ
@@ -181,17 +2377,425 @@ class S(StatesGroup):
     m_confirm     = State()
     # Текстовые сценарии (флористы, логисты, маркетинг)
     text_input    = State()
+    s_dupes       = State()   # смены уже есть в таблице: перезаписать или пропустить
+    s_names       = State()   # незнакомые имена в сменах: исправить на похожие или оставить
+
+# ============================================================
+# 🧠  ХРАНИЛИЩЕ FSM (SQLite)
+# ============================================================
+# Полузаполненные отчёты переживают перезапуск воркера. Все сессии живут
+# в памяти (чтение без обращения к диску), изменения копятся и сбрасываются
+# в SQLite одним executemany раз в FSM_FLUSH_DELAY. Брошенные сессии
+# удаляются через FSM_SESSION_TTL после последнего обращения.
+
+FSM_DB          = os.getenv("FSM_DB", "fsm.db")
+FSM_FLUSH_DELAY = float(os.getenv("FSM_FLUSH_DELAY", "0.5"))      # сек
+FSM_SESSION_TTL = int(os.getenv("FSM_SESSION_TTL", str(12 * 3600)))  # сек простоя
+
+@dataclass(slots=True)
+class SessionRecord:
+    state:   str | None
+    data:    dict
+    touched: float      # time.time() последнего обращения
+    parts:   list[str] | None = None    # data, закодированная по полям (SessionCodec.parts)
+    fields:  set[str] | None = None     # поля, изменённые после parts; None — все
+
+# ---------- компактная запись сессии ----------
+# data хранится в SQLite JSON-массивом по позициям FIELDS, без имён ключей:
+#   [2, действие, город, смена, роль, pay_index, [14 сумм], имя, дата, лиды, заказы, {прочее}]
+# Действие, город, смена и роль — номера в таблицах enums(); сами таблицы
+# лежат в fsm_meta, так что смена реестра городов или смен не ломает
+# сохранённые сессии. Оплаты — список сумм по позициям PAYMENT_STEPS.
+# Старые записи (JSON-объект, оплаты словарём) читаются и переписываются
+# в новом виде при загрузке. Закодированные поля хранилище держит рядом с
+# сессией, и при сбросе перекодирует только изменившиеся: шаг оплаты
+# меняет pay_index и payments, остальные поля склеиваются как были.
+
+def fsm_enums() -> dict[str, list[str]]:
+    return {
+        "action": ["manager", "florist", "logist", "marketing"],
+        "city":   list(CITIES),
+        "shift":  ALL_SHIFTS,
+        "role":   ["Флорист", "Логист"],
+    }
+
+class SessionCodec:
+    VERSION = 2
+    FIELDS  = ("action", "city", "shift", "role", "pay_index", "payments",
+               "name", "date", "leads", "orders")
+    _FIELD_SET = frozenset(FIELDS)
+    _INDEX     = {f: i for i, f in enumerate(FIELDS)}
+
+    def __init__(self, enums: dict[str, list[str]]):
+        self.enums = enums
+        self._codes = {f: {v: i for i, v in enumerate(values)} for f, values in enums.items()}
+
+    def _dump(self, f: str | None, v: Any) -> str:
+        codes = self._codes.get(f)
+        if codes is not None and v is not None:
+            v = codes.get(v, v)           # значения не из таблицы пишем как есть
+        return json.dumps(v, ensure_ascii=False, separators=(",", ":"))
+
+    def _dump_rest(self, data: Mapping[str, Any]) -> str:
+        rest = {k: v for k, v in data.items() if k not in self._FIELD_SET}
+        return self._dump(None, rest or None)
+
+    def parts(self, data: Mapping[str, Any], old: list[str] | None = None,
+              fields: set[str] | None = None) -> list[str]:
+        """Поля по отдельности, JSON-строками. С old перекодирует (на месте)
+        только fields; fields=None — все."""
+        if old is None or fields is None:
+            return [self._dump(f, data.get(f)) for f in self.FIELDS] + [self._dump_rest(data)]
+        for f in fields:
+            i = self._INDEX.get(f)
+            if i is None:
+                old[-1] = self._dump_rest(data)
+            else:
+                old[i] = self._dump(f, data.get(f))
+        return old
+
+    def join(self, parts: list[str]) -> str:
+        n = len(parts)
+        while n and parts[n - 1] == "null":
+            n -= 1
+        return "[" + ",".join([str(self.VERSION), *parts[:n]]) + "]"
+
+    def encode(self, data: Mapping[str, Any]) -> str:
+        return self.join(self.parts(data))
+
+    def decode(self, raw: str) -> tuple[dict, bool]:
+        """→ (data, запись устарела и её стоит переписать)."""
+        obj = json.loads(raw)
+        if isinstance(obj, dict):         # версия 1: словарь как есть
+            payments = obj.get("payments")
+            if isinstance(payments, dict):
+                obj["payments"] = [payments.get(c, 0) for c in PAYMENT_COLS]
+            return obj, True
+        data = {}
+        for f, v in zip(self.FIELDS, obj[1:]):
+            if v is None:
+                continue
+            if isinstance(v, int) and f in self.enums:
+                v = self.enums[f][v]
+            data[f] = v
+        if len(obj) > len(self.FIELDS) + 1:
+            data.update(obj[-1])
+        return data, False
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, path: str = FSM_DB, flush_delay: float = FSM_FLUSH_DELAY,
+                 ttl: int = FSM_SESSION_TTL):
+        self.flush_delay = flush_delay
+        self.ttl = ttl
+        self._keys  = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._db    = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock  = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS fsm ("
+            " key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL, touched REAL NOT NULL)"
+        )
+        self._db.execute("CREATE TABLE IF NOT EXISTS fsm_meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.codec = SessionCodec(fsm_enums())
+        self._sessions: dict[str, SessionRecord] = {}
+        self._dirty: set[str] = set()
+        self._flush_task: asyncio.Task | None = None
+        self.ops: Counter[str] = Counter()      # обращения хендлеров по операциям
+        self._load()
+
+    def _load(self):
+        """Тёплый старт: одна выборка всех живых сессий."""
+        t = time.perf_counter()
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            self._db.execute("DELETE FROM fsm WHERE touched < ?", (cutoff,))
+            rows = self._db.execute("SELECT key, state, data, touched FROM fsm").fetchall()
+            meta = self._db.execute("SELECT value FROM fsm_meta WHERE key = 'enums'").fetchone()
+        stored = json.loads(meta[0]) if meta else self.codec.enums
+        decoder = self.codec if stored == self.codec.enums else SessionCodec(stored)
+        stale = []
+        for key, state, raw, touched in rows:
+            data, old = decoder.decode(raw)
+            self._sessions[key] = SessionRecord(state, data, touched)
+            if old or decoder is not self.codec:
+                stale.append(key)
+        if stale:
+            # Переписываем в текущем формате сразу, пока не запущен цикл событий
+            self._write([(k, self._sessions[k].state, self.codec.encode(self._sessions[k].data),
+                          self._sessions[k].touched) for k in stale], [])
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO fsm_meta (key, value) VALUES ('enums', ?)",
+                             (json.dumps(self.codec.enums, ensure_ascii=False),))
+        logging.info(f"FSM storage: {len(rows)} sessions loaded ({len(stale)} migrated) "
+                     f"in {(time.perf_counter() - t) * 1000:.1f} ms")
+
+    def _record(self, key: StorageKey) -> SessionRecord:
+        k = self._keys.build(key)
+        rec = self._sessions.get(k)
+        if rec is None:
+            rec = self._sessions[k] = SessionRecord(None, {}, time.time())
+        else:
+            rec.touched = time.time()
+        return rec
+
+    @staticmethod
+    def _changed(rec: SessionRecord, fields: Iterable[str] | None):
+        if fields is None:
+            rec.fields = None
+        elif rec.fields is not None:
+            rec.fields.update(fields)
+
+    def _mark(self, key: StorageKey):
+        self._dirty.add(self._keys.build(key))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        await self.flush()
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        upserts, deletes = [], []
+        for k in keys:
+            rec = self._sessions.get(k)
+            if rec is None or (rec.state is None and not rec.data):
+                self._sessions.pop(k, None)
+                deletes.append((k,))
+            else:
+                if rec.parts is None or rec.fields is None or rec.fields:
+                    rec.parts = self.codec.parts(rec.data, rec.parts, rec.fields)
+                    rec.fields = set()
+                upserts.append((k, rec.state, self.codec.join(rec.parts), rec.touched))
+        await asyncio.to_thread(self._write, upserts, deletes)
+
+    def _write(self, upserts: list[tuple], deletes: list[tuple]):
+        with self._lock, self._db:
+            if upserts:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO fsm (key, state, data, touched) VALUES (?, ?, ?, ?)",
+                    upserts,
+                )
+            if deletes:
+                self._db.executemany("DELETE FROM fsm WHERE key = ?", deletes)
+
+    async def evict(self) -> int:
+        """Удаляет сессии, простаивающие дольше ttl."""
+        cutoff = time.time() - self.ttl
+        stale = [k for k, rec in self._sessions.items() if rec.touched < cutoff]
+        for k in stale:
+            self._sessions.pop(k, None)
+            self._dirty.discard(k)
+        if stale:
+            await asyncio.to_thread(self._write, [], [(k,) for k in stale])
+        return len(stale)
+
+    async def evict_loop(self, interval: float = 600):
+        while True:
+            await asyncio.sleep(interval)
+            n = await self.evict()
+            if n:
+                logging.info(f"FSM storage: {n} idle sessions evicted")
+
+    def _op(self, name: str):
+        self.ops[name] += 1
+        metrics.inc("fsm_storage_ops_total", op=name)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        self._op("set_state")
+        self._record(key).state = state.state if isinstance(state, State) else state
+        self._mark(key)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        self._op("get_state")
+        rec = self._sessions.get(self._keys.build(key))
+        return rec.state if rec else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        self._op("set_data")
+        rec = self._record(key)
+        rec.data = dict(data)
+        self._changed(rec, None)
+        self._mark(key)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        self._op("get_data")
+        rec = self._sessions.get(self._keys.build(key))
+        return rec.data.copy() if rec else {}
+
+    async def update_data(self, key: StorageKey, data: Mapping[str, Any]) -> dict[str, Any]:
+        self._op("update_data")
+        rec = self._record(key)
+        rec.data.update(data)
+        self._changed(rec, data.keys())
+        self._mark(key)
+        return rec.data.copy()
+
+    async def load(self, key: StorageKey) -> tuple[str | None, dict[str, Any]]:
+        """Состояние и данные одним обращением (см. FSMSnapshotMiddleware)."""
+        self._op("load")
+        rec = self._sessions.get(self._keys.build(key))
+        return (rec.state, rec.data.copy()) if rec else (None, {})
+
+    async def save(self, key: StorageKey, state: str | None, data: Mapping[str, Any],
+                   fields: set[str] | None = None) -> None:
+        """fields — какие ключи data изменились; None — заменить data целиком."""
+        self._op("save")
+        rec = self._record(key)
+        rec.state = state
+        if fields is None:
+            rec.data = dict(data)
+        else:
+            for f in fields:
+                if f in data:
+                    rec.data[f] = data[f]
+                else:
+                    rec.data.pop(f, None)
+        self._changed(rec, fields)
+        self._mark(key)
+
+    async def close(self) -> None:
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
+        with self._lock:
+            self._db.close()
 
 # ============================================================
 # 🚀  БОТ
 # ============================================================
 logging.basicConfig(level=logging.INFO)
 bot = Bot(token=BOT_TOKEN)
-dp  = Dispatcher()
+fsm_storage = SQLiteStorage()
+# FSM подключает FSMSnapshotMiddleware ниже — вместо стандартного middleware
+dp  = Dispatcher(storage=fsm_storage, events_isolation=SimpleEventIsolation(), disable_fsm=True)
+
+SAVED_NOTE = "💾 Данные сохранены и будут записаны автоматически."
 
 def check_access(uid: int) -> bool:
     return not ALLOWED_USERS or uid in ALLOWED_USERS
 
+def is_admin(uid: int) -> bool:
+    # Без явного списка админов /perf закрыт: там чужие апдейты
+    return uid in ADMIN_USERS
+
+# ---------- замер хендлеров ----------
+# Внутренний middleware: срабатывает, когда хендлер уже выбран, поэтому
+# знает его имя и состояние FSM, в котором пришёл апдейт.
+
+@dataclass
+class UpdateTiming:
+    at: float
+    seconds: float
+    handler: str
+    state: str
+    uid: int | None
+
+class HandlerTimer(BaseMiddleware):
+    def __init__(self):
+        self.recent: deque[UpdateTiming] = deque(maxlen=PERF_RECENT)
+
+    async def __call__(self, handler, event, data):
+        name  = getattr(data["handler"].callback, "__name__", "handler")
+        state = data.get("raw_state") or "-"
+        t = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", handler=name, state=state)
+            raise
+        finally:
+            dt = time.perf_counter() - t
+            metrics.observe("bot_handler_seconds", dt, handler=name, state=state)
+            user = data.get("event_from_user")
+            self.recent.append(UpdateTiming(time.time(), dt, name, state, user and user.id))
+
+handler_timer = HandlerTimer()
+dp.message.middleware(handler_timer)
+
+# ---------- снимок FSM на апдейт ----------
+# Хендлеры по нескольку раз за апдейт читают и пишут состояние
+# (get_data → update_data → get_data …). Middleware читает состояние и
+# данные из хранилища одним load, отдаёт хендлеру копию в памяти и в
+# конце апдейта пишет её одним save — только изменённые ключи, или
+# ничего, если ничего не менялось. Апдейты одного пользователя идут по очереди
+# (SimpleEventIsolation), иначе два снимка затёрли бы друг друга.
+# FSM_SNAPSHOT=0 — обычный FSMContext, для сравнения в /perf.
+
+FSM_SNAPSHOT = os.getenv("FSM_SNAPSHOT", "1") != "0"
+
+class FSMSnapshot(FSMContext):
+    def __init__(self, storage: SQLiteStorage, key: StorageKey, state: str | None, data: dict):
+        super().__init__(storage, key)
+        self._state, self._data = state, data
+        self.changed = False
+        self.fields: set[str] | None = set()    # изменённые ключи data; None — все
+
+    async def set_state(self, state: StateType = None) -> None:
+        self._state = state.state if isinstance(state, State) else state
+        self.changed = True
+
+    async def get_state(self) -> str | None:
+        return self._state
+
+    async def set_data(self, data: Mapping[str, Any]) -> None:
+        self._data = dict(data)
+        self.fields = None
+        self.changed = True
+
+    async def get_data(self) -> dict[str, Any]:
+        return self._data.copy()
+
+    async def get_value(self, key: str, default: Any | None = None) -> Any | None:
+        return self._data.get(key, default)
+
+    async def update_data(self, data: Mapping[str, Any] | None = None, **kwargs: Any) -> dict[str, Any]:
+        if data:
+            self._data.update(data)
+        self._data.update(kwargs)
+        if self.fields is not None:
+            self.fields.update(data or (), kwargs)
+        self.changed = True
+        return self._data.copy()
+
+    async def commit(self):
+        if self.changed:
+            await self.storage.save(self.key, self._state, self._data, self.fields)
+            self.changed, self.fields = False, set()
+
+class FSMSnapshotMiddleware(FSMContextMiddleware):
+    def __init__(self, storage: SQLiteStorage, events_isolation, enabled: bool = FSM_SNAPSHOT):
+        super().__init__(storage, events_isolation)
+        self.enabled = enabled
+        self.updates = 0
+
+    async def __call__(self, handler, event, data):
+        context = self.resolve_event_context(data["bot"], data)
+        data["fsm_storage"] = self.storage
+        if context is None:
+            return await handler(event, data)
+        self.updates += 1
+        metrics.inc("fsm_updates_total")
+        async with self.events_isolation.lock(key=context.key):
+            if not self.enabled:
+                data.update(state=context, raw_state=await context.get_state())
+                return await handler(event, data)
+            snap = FSMSnapshot(self.storage, context.key, *await self.storage.load(context.key))
+            data.update(state=snap, raw_state=snap._state)
+            try:
+                return await handler(event, data)
+            finally:
+                await snap.commit()
+
+    def ops_per_update(self) -> float:
+        return sum(self.storage.ops.values()) / self.updates if self.updates else 0.0
+
+fsm_snapshot = FSMSnapshotMiddleware(fsm_storage, dp.fsm.events_isolation)
+dp.update.outer_middleware(fsm_snapshot)
+
 # ---------- /start ----------
 @dp.message(Command("start"))
 async def cmd_start(msg: types.Message, state: FSMContext):
@@ -215,9 +2819,14 @@ async def cancel(msg: types.Message, state: FSMContext):
 async def help_cmd(msg: types.Message):
     await msg.answer(
         "📊 *Отчёт менеджера* — пошаговый ввод через кнопки\n"
+        "   ⚡ оплаты можно прислать одним сообщением, по строке на способ\n"
         "🌺 *Флористы* — текстом: дата, затем имена\n"
         "🚗 *Логисты* — текстом: дата, затем имена\n"
-        "🎯 *Маркетинг* — `дата план факт $ продаж курс`\n\n"
+        "🎯 *Маркетинг* — `дата план факт $ продаж курс`\n"
+        "📈 /stats — итоги: `сегодня`, `вчера`, `неделя`, `месяц`, `ДД.ММ` или имя\n"
+        "📤 /export — выгрузка: `/export Город ДД.ММ ДД.ММ [лист] [xlsx]`\n"
+        "🕘 /history — ваши последние отправки, /undo — отменить последнюю\n"
+        "📎 Вместо текста можно прислать файл CSV/XLSX (после выбора города)\n\n"
         "✅ Числа с точками (144.890 = 144 890) — понимает\n"
         "✅ Числа с пробелами (792 300) — понимает",
         parse_mode="Markdown",
@@ -229,6 +2838,536 @@ async def help_cmd(msg: types.Message):
 async def cmd_myid(msg: types.Message):
     await msg.answer(f"ID: `{msg.from_user.id}`", parse_mode="Markdown")
 
+# ---------- /status ----------
+@dp.message(Command("status"))
+async def cmd_status(msg: types.Message):
+    if not check_access(msg.from_user.id):
+        return
+    st = sheets_scheduler.stats()
+    pending = await asyncio.to_thread(journal.count_pending)
+    cities = {sid: city for city, sid in SPREADSHEETS.items()}
+    breakers = ", ".join(f"{cities.get(sid, sid)}: {b}" for sid, b in st["breakers"].items()) or "—"
+    lanes = ", ".join(f"{cities.get(sid, sid)}: {n}" for sid, n in write_queue.lane_sizes().items())
+    await msg.answer(
+        f"📮 Очередь записи: {write_queue.qsize()}" + (f" ({lanes})" if lanes else "") + "\n"
+        f"💾 Не записано в журнале: {pending}\n"
+        f"🚦 Ждут квоту: {st['waiting']}  |  ожидание ср. {st['avg_wait']:.2f} с, "
+        f"макс. {st['max_wait']:.2f} с\n"
+        f"🔁 Запросов: {st['calls']}, повторов: {st['retries']}, ошибок: {st['errors']}\n"
+        f"⚡ Предохранители: {breakers}\n"
+        f"📚 Справочник: версия {reference.version}"
+    )
+
+# ---------- /perf ----------
+def _pct(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] if values else 0.0
+
+@dp.message(Command("perf"))
+async def cmd_perf(msg: types.Message):
+    if not is_admin(msg.from_user.id):
+        return
+    recent = list(handler_timer.recent)
+    if not recent:
+        await msg.answer("📭 Ещё нет замеров.")
+        return
+    by_handler: dict[str, list[float]] = {}
+    for u in recent:
+        by_handler.setdefault(u.handler, []).append(u.seconds * 1000)
+    rows = sorted(by_handler.items(), key=lambda kv: -_pct(kv[1], 95))[:10]
+    lines = [f"📈 Последние {len(recent)} апдейтов (с {datetime.fromtimestamp(recent[0].at):%H:%M})"]
+    lines += [f"`{name}`: {len(v)} · p50 {_pct(v, 50):.0f} мс · p95 {_pct(v, 95):.0f} мс"
+              for name, v in rows]
+
+    lines.append("\n🐢 Самые медленные:")
+    for u in sorted(recent, key=lambda u: -u.seconds)[:5]:
+        lines.append(f"{u.seconds * 1000:.0f} мс `{u.handler}` в `{u.state}` "
+                     f"· {datetime.fromtimestamp(u.at):%H:%M:%S} · id …{str(u.uid)[-3:]}")
+
+    with metrics._lock:
+        calls = {dict(k)["op"]: h for k, h in metrics.histograms.get("sheets_call_seconds", {}).items()
+                 if dict(k).get("outcome") == "ok"}
+        snapshot = [(op, h.count, h.sum) for op, h in calls.items()]
+    if snapshot:
+        lines.append("\n🗂 Sheets (успешные запросы):")
+        for op, count, total in sorted(snapshot):
+            errors  = metrics.total("sheets_errors_total", op=op)
+            retries = metrics.total("sheets_retries_total", op=op)
+            lines.append(f"`{op}`: {count} · ср. {total / count * 1000:.0f} мс"
+                         f" · ошибок {errors:g}, повторов {retries:g}")
+    ops = ", ".join(f"`{op}` {n}" for op, n in fsm_storage.ops.most_common())
+    lines.append(f"\n🧠 FSM: {fsm_snapshot.ops_per_update():.1f} обращений к хранилищу на апдейт"
+                 f" (снимок {'вкл.' if fsm_snapshot.enabled else 'выкл.'}; {ops})")
+    await msg.answer("\n".join(lines), parse_mode="Markdown")
+
+# ---------- /stats ----------
+def _stats_period(arg: str) -> tuple[str, str, str] | None:
+    """Аргумент /stats → (с, по, подпись); None — аргумент не период."""
+    today = datetime.now().date()
+    arg = arg.lower()
+    if arg in ("", "сегодня", "день"):
+        return today.isoformat(), today.isoformat(), today.strftime("%d.%m.%Y")
+    if arg == "вчера":
+        d = today - timedelta(days=1)
+        return d.isoformat(), d.isoformat(), d.strftime("%d.%m.%Y")
+    if arg == "неделя":
+        monday = today - timedelta(days=today.weekday())
+        return monday.isoformat(), today.isoformat(), f"неделя с {monday:%d.%m}"
+    if arg == "месяц":
+        first = today.replace(day=1)
+        return first.isoformat(), today.isoformat(), f"{today:%m.%Y}"
+    day = iso_day(arg if arg.count(".") == 2 else f"{arg}.{today.year}")
+    if day:
+        return day, day, arg
+    return None
+
+def _stats_line(label: str, leads: int, orders: int, total: int) -> str:
+    leads, orders, total = leads or 0, orders or 0, total or 0
+    conv = round(orders / leads * 100, 1) if leads > 0 else 0
+    return f"{label}: {leads} → {orders} ({conv}%) · {total:,}₸"
+
+@dp.message(Command("stats"))
+async def cmd_stats(msg: types.Message):
+    if not check_access(msg.from_user.id):
+        return
+    arg = (msg.text.split(maxsplit=1)[1:] or [""])[0].strip()
+    t = time.perf_counter()
+    period = _stats_period(arg)
+    blocks = []
+    if period:
+        day_from, day_to, title = period
+        results = await asyncio.gather(*(asyncio.to_thread(replica.sales_by, city, day_from, day_to)
+                                         for city in SPREADSHEETS))
+        for city, rows in zip(SPREADSHEETS, results):
+            if not rows:
+                continue
+            lines = [_stats_line(f"👤 {n}", *v) for n, *v in rows]
+            sums = [sum(r[i] or 0 for r in rows) for i in (1, 2, 3)]
+            lines.append(_stats_line("💰 *Всего*", *sums))
+            blocks.append(f"📍 *{city}* — {title}\n" + "\n".join(lines))
+    else:
+        # /stats Имя — по дням за последние 7 дней
+        today = datetime.now().date()
+        day_from = (today - timedelta(days=6)).isoformat()
+        results = await asyncio.gather(*(
+            asyncio.to_thread(replica.sales_by, city, day_from, today.isoformat(), "day", name=arg)
+            for city in SPREADSHEETS))
+        for city, rows in zip(SPREADSHEETS, results):
+            if rows:
+                lines = [_stats_line(f"📅 {datetime.fromisoformat(d):%d.%m}", *v) for d, *v in rows]
+                blocks.append(f"📍 *{city}* — {arg}, 7 дней\n" + "\n".join(lines))
+    if not blocks:
+        await msg.answer("📭 Нет данных.\n"
+                         "Формат: `/stats [сегодня|вчера|неделя|месяц|ДД.ММ|Имя]`",
+                         parse_mode="Markdown")
+        return
+    ms = (time.perf_counter() - t) * 1000
+    await msg.answer("\n\n".join(blocks) + f"\n\n_⚡ {ms:.0f} мс_", parse_mode="Markdown")
+
+# ---------- /history, /undo ----------
+def _rows_label(at: list[int]) -> str:
+    if len(at) == 1:
+        return f"строка {at[0]}"
+    if at == list(range(at[0], at[0] + len(at))):
+        return f"строки {at[0]}–{at[-1]}"
+    return "строки " + ", ".join(map(str, at))
+
+def _submission_line(s: Submission) -> str:
+    first = s.rows[0]
+    if s.sheet == "Продажи":
+        what = f"{first[0]} · {first[1]} · {first[2]} · {first[5 + len(PAYMENT_COLS)]:,}₸"
+    elif s.sheet == "Маркетинг":
+        what = ", ".join(dict.fromkeys(str(r[0]) for r in s.rows))
+    else:
+        names = [str(r[1]) for r in s.rows]
+        what = f"{first[0]} · " + ", ".join(names[:5]) + (f" и ещё {len(names) - 5}" if len(names) > 5 else "")
+    when = datetime.fromtimestamp(s.created).strftime("%d.%m %H:%M")
+    mark = "  ↩️ _отменено_" if s.undone else ""
+    return f"`#{s.id}` {when} · {s.city} · {s.sheet}, {_rows_label(s.at)}{mark}\n    {what}"
+
+@dp.message(Command("history"))
+async def cmd_history(msg: types.Message):
+    if not check_access(msg.from_user.id):
+        return
+    arg = (msg.text.split(maxsplit=1)[1:] or [""])[0].strip()
+    n = min(int(arg), HISTORY_SHOW_MAX) if arg.isdigit() and int(arg) > 0 else HISTORY_SHOW
+    subs = history.last(msg.chat.id, n)
+    if not subs:
+        await msg.answer("📭 Записанных отправок пока нет.")
+        return
+    await msg.answer("🕘 *Ваши последние отправки:*\n\n" + "\n".join(map(_submission_line, subs))
+                     + "\n\n↩️ /undo — отменить последнюю, `/undo N` — отправку #N",
+                     parse_mode="Markdown")
+
+_undoing: set[int] = set()      # отправки, чья отмена ещё в очереди
+
+@dp.message(Command("undo"))
+async def cmd_undo(msg: types.Message):
+    if not check_access(msg.from_user.id):
+        return
+    arg = (msg.text.split(maxsplit=1)[1:] or [""])[0].strip().lstrip("#")
+    if arg and not arg.isdigit():
+        await msg.answer("Формат: `/undo` или `/undo N` (номер из /history)", parse_mode="Markdown")
+        return
+    s = history.get(msg.chat.id, int(arg) if arg else None)
+    if s is None:
+        await msg.answer("📭 Нечего отменять — см. /history")
+        return
+    if s.undone:
+        await msg.answer(f"↩️ Отправка #{s.id} уже отменена.")
+        return
+    if s.id in _undoing:
+        await msg.answer(f"⏳ Отправка #{s.id} уже отменяется.")
+        return
+    rows = history.undo_rows(s)
+    if rows is None:
+        await msg.answer(f"⚠️ Строки отправки #{s.id} с тех пор перезаписаны — "
+                         "исправьте их в таблице вручную.")
+        return
+    line = _submission_line(s)
+    restored = s.prev is not None
+
+    async def notify(err: Exception | None):
+        _undoing.discard(s.id)
+        if isinstance(err, RowsMovedError):
+            await msg.answer(f"⚠️ Отмена не выполнена: {err}")
+            return
+        if err:
+            await msg.answer(f"⚠️ Таблица недоступна: {err}\n{SAVED_NOTE}")
+            return
+        # Отправку отметил history.on_undone, когда строки переписаны
+        await msg.answer(f"↩️ *{'Восстановлены прежние данные' if restored else 'Отменено'}:*\n{line}",
+                         parse_mode="Markdown")
+
+    _undoing.add(s.id)
+    await write_queue.submit(s.city, s.sheet, rows, notify, at=s.at, undo=s.id)
+    await msg.answer("⏳ Отменяю…")
+
+# ============================================================
+# 📎  ИМПОРТ ИЗ ФАЙЛОВ (CSV / XLSX)
+# ============================================================
+# Вместо вставки текста можно прислать файл: смены (дата, имя[, пол-смены]),
+# отчёты менеджеров (дата, имя, смена, лиды, заказы, оплаты по PAYMENT_STEPS)
+# или маркетинг (как в тексте). Файл качается на диск и читается потоком;
+# в памяти только текущая порция IMPORT_CHUNK строк, которая сразу уходит
+# в очередь записи отдельным заданием. Первая строка без даты — шапка.
+
+IMPORT_CHUNK     = int(os.getenv("IMPORT_CHUNK", "200"))   # строк файла в одной порции (задании записи)
+IMPORT_MAX_BYTES = 20 * 1024 * 1024                        # лимит Bot API на скачивание
+IMPORT_MAX_ERRORS_SHOWN = 30
+IMPORT_DELIMITERS = ";,\t"
+
+def _cell(v) -> str:
+    if v is None:
+        return ""
+    if isinstance(v, datetime):
+        return v.strftime("%d.%m.%Y")
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v).strip()
+
+def iter_table(path: str, ext: str) -> Iterator[list[str]]:
+    """Строки CSV/XLSX как списки строк, без чтения файла целиком."""
+    if ext == ".xlsx":
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise RuntimeError("XLSX не поддерживается на сервере (нет openpyxl) — пришлите CSV")
+        wb = load_workbook(path, read_only=True, data_only=True)
+        try:
+            for values in wb.worksheets[0].iter_rows(values_only=True):
+                yield [_cell(v) for v in values]
+        finally:
+            wb.close()
+        return
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        sample = f.read(4096)
+        f.seek(0)
+        try:
+            dialect, fmt = csv.Sniffer().sniff(sample, delimiters=IMPORT_DELIMITERS), {}
+        except csv.Error:
+            # Sniffer сдаётся на «рваных» строках (Excel не пишет пустые оплаты
+            # в конце) — берём разделитель, которого больше всего в шапке
+            header = sample.splitlines()[0] if sample else ""
+            best = max(IMPORT_DELIMITERS, key=header.count)
+            if not header.count(best):
+                raise RuntimeError("не удалось определить разделитель колонок — "
+                                   "сохраните CSV с «;», «,» или табуляцией")
+            dialect, fmt = csv.excel, {"delimiter": best}
+        for values in csv.reader(f, dialect, **fmt):
+            yield [v.strip() for v in values]
+
+def import_entry(action: str, cells: list[str], city: str) -> tuple[Any, str | None]:
+    """Проверяет строку файла теми же правилами, что и ручной ввод.
+    Возвращает (запись, None) или (None, причина)."""
+    cells = list(cells)
+    while cells and not cells[-1]:
+        cells.pop()
+    if not cells:
+        return None, None                     # пустая строка — не ошибка
+    if not re.match(DATE_RE, cells[0]):
+        return None, "неверная дата"
+    date = full_date(cells[0])
+    if action in ("florist", "logist"):
+        role = "Флорист" if action == "florist" else "Логист"
+        e = schedule_entry(date, " ".join(cells[1:]), role)
+        return (e, None) if e else (None, "нет имени")
+    if action == "marketing":
+        return marketing_entry(cells)
+    # manager
+    if len(cells) < 5:
+        return None, "нужно минимум 5 колонок: дата, имя, смена, лиды, заказы"
+    name, shift = cells[1], cells[2]
+    if not name:
+        return None, "нет имени"
+    shifts = reference[city].shifts
+    if shift not in shifts:
+        return None, f"смена не из списка ({', '.join(shifts)})"
+    leads, orders = parse_number(cells[3]), parse_number(cells[4])
+    if leads <= 0:
+        return None, "лиды должны быть больше 0"
+    if orders < 0:
+        return None, "заказы не могут быть отрицательными"
+    amounts = [parse_number(c) if c else 0 for c in cells[5:5 + len(PAYMENT_STEPS)]]
+    if any(a < 0 for a in amounts):
+        return None, "отрицательная сумма оплаты"
+    entry = {"date": date, "name": name, "shift": shift, "leads": leads, "orders": orders}
+    entry.update(zip(PAYMENT_COLS, amounts))
+    return entry, None
+
+def _read_chunk(rows: Iterator[list[str]]) -> list[list[str]]:
+    """Следующие IMPORT_CHUNK строк файла (в потоке: разбор CSV/XLSX)."""
+    return list(islice(rows, IMPORT_CHUNK))
+
+def _import_chunk(lines: list[list[str]], action: str, start: int, city: str, sheet: str,
+                  seen: set[tuple], key: str | None = None
+                  ) -> tuple[list, list[tuple[int, str]], int]:
+    """Проверяет прочитанную порцию (в event loop: индексы и справочник
+    меняются там же). seen — ключи дублей, уже взятые из этого файла.
+    key — ключ отправки файла, к нему дописывается номер строки.
+    Возвращает (записи, ошибки, номер следующей строки)."""
+    entries, errors, n = [], [], start
+    for cells in lines:
+        entry, why = import_entry(action, cells, city)
+        if entry is None and why and n == 1:
+            why = None                        # шапка
+        if entry is not None:
+            dup_row = (manager_report_row(entry)[0] if action == "manager"
+                       else schedule_row(entry, entry["role"]) if action != "marketing" else None)
+            dk = dup_row and dup_key(city, sheet, dup_row)
+            if dk in seen:
+                entry, why = None, "повторяется в файле"
+            elif dup_row and dup_index.find(city, sheet, dup_row)[0]:
+                entry, why = None, "уже есть в таблице"
+            elif dk:
+                seen.add(dk)
+        if entry is not None:
+            if key and isinstance(entry, dict):
+                entry["key"] = f"{key}:{n}"
+            entries.append(entry)
+        elif why:
+            errors.append((n, why))
+        n += 1
+    return entries, errors, n
+
+def _import_sheet(action: str) -> str:
+    if action == "manager":
+        return "Продажи"
+    if action == "marketing":
+        return "Маркетинг"
+    return schedule_sheet("Флорист" if action == "florist" else "Логист")
+
+async def _import_write(action: str, entries: list, city: str, notify: Notify, chat_id: int) -> int:
+    """Ставит порцию в очередь; возвращает, сколько строк реально поставлено
+    (0 — всё отсеяли ключи отправки, notify не будет)."""
+    if action == "manager":
+        return await write_manager_reports(entries, city, notify, chat_id)
+    if action == "marketing":
+        return await write_marketing(entries, city, notify, chat_id)
+    return (await write_schedule(entries, city, entries[0]["role"], notify, chat_id))[0]
+
+@dp.message(S.text_input, F.document)
+@dp.message(S.m_name, F.document)
+async def import_document(msg: types.Message, state: FSMContext):
+    doc = msg.document
+    ext = os.path.splitext(doc.file_name or "")[1].lower()
+    if ext not in (".csv", ".xlsx"):
+        await msg.answer("❌ Поддерживаются только файлы .csv и .xlsx")
+        return
+    if doc.file_size and doc.file_size > IMPORT_MAX_BYTES:
+        await msg.answer("❌ Файл больше 20 МБ — разбейте его на части.")
+        return
+    data   = await state.get_data()
+    action = data["action"]
+    city   = data["city"]
+    sheet  = _import_sheet(action)
+    await state.clear()
+
+    progress = await msg.answer(f"📥 Загружаю {doc.file_name}…", reply_markup=main_kb)
+    fd, path = tempfile.mkstemp(suffix=ext)
+    os.close(fd)
+    written, errors, n_errors, chunks = 0, [], 0, 0
+    seen: set[tuple] = set()               # ключи дублей из этого файла
+    results: list[Exception | None] = []
+    expected: int | None = None          # станет известно, когда файл дочитан
+
+    async def final_report():
+        # Итог записи — когда очередь отчиталась по всем порциям
+        if expected is None or len(results) != expected:
+            return
+        failed = sum(1 for r in results if r)
+        if failed:
+            await msg.answer(f"⚠️ {failed} из {expected} порций пока не записаны.\n{SAVED_NOTE}",
+                             reply_markup=main_kb)
+        else:
+            await msg.answer(f"✅ Все {written} строк записаны в «{sheet}».", reply_markup=main_kb)
+
+    async def chunk_done(err: Exception | None):
+        results.append(err)
+        await final_report()
+
+    try:
+        await msg.bot.download(doc, destination=path)
+        rows, line, last_edit = iter_table(path, ext), 1, time.monotonic()
+        while True:
+            lines = await asyncio.to_thread(_read_chunk, rows)
+            entries, errs, line = _import_chunk(lines, action, line, city, sheet, seen,
+                                                f"{msg.chat.id}:{msg.message_id}")
+            n_errors += len(errs)
+            errors += errs[:max(0, IMPORT_MAX_ERRORS_SHOWN - len(errors))]
+            if entries:
+                queued = await _import_write(action, entries, city, chunk_done, msg.chat.id)
+                if queued:
+                    written += queued
+                    chunks += 1
+            if len(lines) < IMPORT_CHUNK:
+                break
+            if time.monotonic() - last_edit > 2:
+                last_edit = time.monotonic()
+                await progress.edit_text(f"📥 {doc.file_name}: обработано {line - 1} строк, "
+                                         f"принято {written}, ошибок {n_errors}…")
+    except Exception as e:
+        logging.error(f"Import error: {e}", exc_info=True)
+        await msg.answer(f"❌ Ошибка импорта: {e}", reply_markup=main_kb)
+        return
+    finally:
+        os.remove(path)
+
+    report = f"📎 {doc.file_name} → {sheet} ({city})\n✅ Принято строк: {written}"
+    if n_errors:
+        report += f"\n⚠️ Отклонено: {n_errors}\n" + "\n".join(
+            f"  стр. {n}: {why}" for n, why in errors)
+        if n_errors > len(errors):
+            report += f"\n  … и ещё {n_errors - len(errors)}"
+    await progress.edit_text(report)
+    if chunks:
+        expected = chunks
+        await final_report()
+
+# ============================================================
+# 📤  ВЫГРУЗКА ЗА ПЕРИОД
+# ============================================================
+# /export Астана 01.10 31.10 [лист] [xlsx] — строки листа за период файлом.
+# Читаем из локальной копии по индексу (город, лист, день, строка), а из
+# Google дочитываем только хвост листа, добавленный после синхронизации.
+# Файл пишется на диск порциями и уходит в Telegram потоком с диска.
+
+EXPORT_SHEETS = {
+    "продажи":   "Продажи",
+    "флористы":  "Смены флористов",
+    "логисты":   "Смены логистов",
+    "маркетинг": "Маркетинг",
+}
+EXPORT_USAGE = "Формат: `/export Город ДД.ММ ДД.ММ [продажи|флористы|логисты|маркетинг] [xlsx]`"
+
+def parse_export(args: list[str]) -> tuple[str, str, str, str, str] | str:
+    """→ (город, лист, с, по, формат) или текст ошибки."""
+    fmt = "csv"
+    if args and args[-1].lower() in ("csv", "xlsx"):
+        fmt = args.pop().lower()
+    if len(args) < 3:
+        return EXPORT_USAGE
+    city = next((c for c in CITIES if c.casefold() == args[0].casefold()), None)
+    if city is None:
+        return f"❌ Нет такого города. Доступны: {', '.join(CITIES)}"
+    sheet = "Продажи"
+    if len(args) > 3:
+        name = " ".join(args[3:]).casefold()
+        sheet = EXPORT_SHEETS.get(name) or next(
+            (sh for sh in REPLICA_SHEETS if sh.casefold() == name), None)
+        if sheet is None:
+            return f"❌ Неизвестный лист. {EXPORT_USAGE}"
+    days = [iso_day(full_date(d)) if re.match(DATE_RE, d) else None for d in args[1:3]]
+    if None in days:
+        return f"❌ Неверная дата. {EXPORT_USAGE}"
+    if days[0] > days[1]:
+        return "❌ Начало периода позже конца."
+    return city, sheet, days[0], days[1], fmt
+
+def write_export(path: str, fmt: str, header: list | None, rows: Iterator[list]) -> int:
+    """Пишет строки в CSV/XLSX построчно, возвращает их количество. В потоке."""
+    n = 0
+    if fmt == "xlsx":
+        try:
+            from openpyxl import Workbook
+        except ImportError:
+            raise RuntimeError("XLSX не поддерживается на сервере (нет openpyxl) — выгрузите CSV")
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet()
+        if header:
+            ws.append(header)
+        for row in rows:
+            ws.append(row)
+            n += 1
+        wb.save(path)
+        return n
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:   # BOM — для Excel
+        w = csv.writer(f, delimiter=";")
+        if header:
+            w.writerow(header)
+        for row in rows:
+            w.writerow(row)
+            n += 1
+    return n
+
+@dp.message(Command("export"))
+async def cmd_export(msg: types.Message):
+    if not check_access(msg.from_user.id):
+        return
+    parsed = parse_export(msg.text.split()[1:])
+    if isinstance(parsed, str):
+        await msg.answer(parsed, parse_mode="Markdown")
+        return
+    city, sheet, day_from, day_to, fmt = parsed
+
+    note = ""
+    try:
+        await replica.sync_sheet(city, sheet)
+    except Exception as e:
+        logging.warning(f"Export sync failed for {city}/{sheet}: {e}")
+        note = "\n⚠️ Таблица недоступна — выгрузка из локальной копии, свежие строки могут отсутствовать."
+
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        header = replica.header(city, sheet)
+        header = header and visible(header)
+        rows = map(visible, replica.iter_range(city, sheet, day_from, day_to))
+        n = await asyncio.to_thread(write_export, path, fmt, header, rows)
+        if not n:
+            await msg.answer("📭 За этот период строк нет." + note)
+            return
+        d1, d2 = (datetime.fromisoformat(d).strftime("%d.%m.%Y") for d in (day_from, day_to))
+        await msg.answer_document(
+            types.FSInputFile(path, filename=f"{city}_{sheet}_{day_from}_{day_to}.{fmt}"),
+            caption=f"📤 {city} · {sheet} · {d1}–{d2}, строк: {n}" + note,
+        )
+    except Exception as e:
+        logging.error(f"Export error: {e}", exc_info=True)
+        await msg.answer(f"❌ Ошибка выгрузки: {e}")
+    finally:
+        os.remove(path)
+
 # ============================================================
 # ШАГИ ОТЧЁТА МЕНЕДЖЕРА
 # ============================================================
@@ -249,25 +3388,26 @@ async def choose_action(msg: types.Message, state: FSMContext):
     await msg.answer("🏙 Выберите город:", reply_markup=city_kb)
 
 # --- Шаг 1: Город ---
-@dp.message(S.city, F.text.in_(["🏙 Астана", "🏔 Алматы"]))
+@dp.message(S.city, F.text.in_(CITY_BY_BUTTON))
 async def select_city(msg: types.Message, state: FSMContext):
-    city   = "Астана" if "Астана" in msg.text else "Алматы"
+    city   = CITY_BY_BUTTON[msg.text]
     data   = await state.get_data()
     action = data["action"]
     await state.update_data(city=city)
 
     if action == "manager":
         await state.set_state(S.m_name)
-        managers = MANAGERS.get(city, [])
+        managers = reference[city].managers
+        hint = "\n\n📎 _Или пришлите CSV/XLSX: дата, имя, смена, лиды, заказы, 14 оплат_"
         if managers:
             await msg.answer(
-                f"👤 *Шаг 1/7* — Менеджер ({city}):",
+                f"👤 *Шаг 1/7* — Менеджер ({city}):" + hint,
                 parse_mode="Markdown",
                 reply_markup=managers_kb(city),
             )
         else:
             await msg.answer(
-                f"👤 *Шаг 1/7* — Введите имя менеджера ({city}):",
+                f"👤 *Шаг 1/7* — Введите имя менеджера ({city}):" + hint,
                 parse_mode="Markdown",
                 reply_markup=cancel_kb,
             )
@@ -280,7 +3420,8 @@ async def select_city(msg: types.Message, state: FSMContext):
         await msg.answer(
             f"{icon} *{city}* — Смены {role.lower()}ов\n\n"
             "Формат:\n`01.06\nИмя Фамилия\nДругое Имя`\n\n"
-            "_(пол-смены → допишите «пол-смены» после имени)_",
+            "_(пол-смены → допишите «пол-смены» после имени)_\n\n"
+            "📎 _Или пришлите CSV/XLSX: дата, имя_",
             parse_mode="Markdown",
             reply_markup=cancel_kb,
         )
@@ -290,7 +3431,8 @@ async def select_city(msg: types.Message, state: FSMContext):
         await msg.answer(
             f"🎯 *{city}* — Маркетинг\n\n"
             "Формат: `дата план факт $ продаж курс`\n"
-            "Пример: `01.06 100 85 0.9 50 450`",
+            "Пример: `01.06 100 85 0.9 50 450`\n\n"
+            "📎 _Или пришлите CSV/XLSX с теми же колонками_",
             parse_mode="Markdown",
             reply_markup=cancel_kb,
         )
@@ -308,17 +3450,33 @@ async def step_name(msg: types.Message, state: FSMContext):
     if not name:
         await msg.answer("❌ Введите имя:")
         return
-    await state.update_data(name=name)
+    city = (await state.get_data())["city"]
+    if name.startswith(NEW_NAME):
+        name = name[len(NEW_NAME):].strip()
+    else:
+        canonical, hints = name_index.resolve(city, "Продажи", name)
+        if canonical:
+            name = canonical
+        elif hints:
+            await msg.answer(f"🤔 «{name}» ещё нет в таблице ({city}). Может, это:",
+                             reply_markup=kb(*[[h] for h in hints], [NEW_NAME + name], ["❌ Отмена"]))
+            return
+    data = await state.update_data(name=name)
     await state.set_state(S.m_shift)
     await msg.answer(
         f"✅ Менеджер: *{name}*\n\n⏰ *Шаг 2/7* — Выберите смену:",
         parse_mode="Markdown",
-        reply_markup=shifts_kb,
+        reply_markup=shifts_kb(data["city"]),
     )
 
 # --- Шаг 3: Смена ---
-@dp.message(S.m_shift, F.text.in_(SHIFTS))
+@dp.message(S.m_shift, F.text.in_(reference.shift_buttons))
 async def step_shift(msg: types.Message, state: FSMContext):
+    city = (await state.get_data())["city"]
+    if msg.text not in reference[city].shifts:
+        await msg.answer(f"❌ Такой смены нет в списке ({city}), выберите кнопкой:",
+                         reply_markup=shifts_kb(city))
+        return
     await state.update_data(shift=msg.text)
     await state.set_state(S.m_date)
     await msg.answer(
@@ -354,12 +3512,10 @@ async def step_date_custom(msg: types.Message, state: FSMContext):
     if text == "❌ Отмена":
         await cancel(msg, state)
         return
-    if not re.match(r"^\d{1,2}\.\d{1,2}(\.\d{2,4})?$", text):
+    if not re.match(DATE_RE, text):
         await msg.answer("❌ Формат: ДД.ММ.ГГГГ (например: 15.06.2025)")
         return
-    if len(text.split(".")) == 2:
-        text += f".{datetime.now().year}"
-    await _after_date(msg, state, text)
+    await _after_date(msg, state, full_date(text))
 
 async def _after_date(msg, state, date: str):
     await state.update_data(date=date)
@@ -404,7 +3560,7 @@ async def step_orders(msg: types.Message, state: FSMContext):
     await state.update_data(
         orders=n,
         pay_index=0,
-        payments={col: 0 for col, _ in PAYMENT_STEPS},
+        payments=[0] * len(PAYMENT_STEPS),   # суммы по позициям PAYMENT_STEPS
     )
     await state.set_state(S.m_payment)
     await _ask_payment(msg, state)
@@ -422,8 +3578,14 @@ async def _ask_payment(msg: types.Message, state: FSMContext):
 
     col, label = PAYMENT_STEPS[idx]
     progress   = f"{idx + 1}/{len(PAYMENT_STEPS)}"
+    hint = ""
+    if idx == 0:
+        hint = ("\n\n⚡ Или все оплаты одним сообщением, по строке на способ:\n"
+                "`Каспи пей 144.890`\n`Наличные 12 000`\n"
+                "_(или только суммы по порядку, остальные = 0)_")
     await msg.answer(
-        f"💰 *Шаг 6/7* — Оплаты [{progress}]\n\n*{label}*\n_(введите сумму или нажмите «0 — пропустить»)_",
+        f"💰 *Шаг 6/7* — Оплаты [{progress}]\n\n*{label}*\n_(введите сумму или нажмите «0 — пропустить»)_"
+        + hint,
         parse_mode="Markdown",
         reply_markup=skip_kb,
     )
@@ -435,24 +3597,39 @@ async def step_payment(msg: types.Message, state: FSMContext):
         await cancel(msg, state)
         return
 
+    bulk = parse_payments(text)
+    if bulk is not None:
+        parsed, errors = bulk
+        if errors:
+            await msg.answer("❌ Не удалось разобрать оплаты:\n" + "\n".join(errors))
+            return
+        # Суммы, уже введённые по шагам, не обнуляем — сообщение их дополняет
+        data = await state.get_data()
+        await state.update_data(
+            payments=[parsed.get(col, old) for col, old in zip(PAYMENT_COLS, data["payments"])],
+            pay_index=len(PAYMENT_STEPS),
+        )
+        await state.set_state(S.m_confirm)
+        await _show_confirm(msg, state)
+        return
+
     data = await state.get_data()
     idx  = data.get("pay_index", 0)
-    col, label = PAYMENT_STEPS[idx]
 
     amount = 0 if text == "0 — пропустить" else parse_number(text)
     if amount < 0:
         await msg.answer("❌ Введите 0 или положительное число:")
         return
 
-    payments = data.get("payments", {})
-    payments[col] = amount
+    payments = list(data["payments"])
+    payments[idx] = amount
     await state.update_data(payments=payments, pay_index=idx + 1)
     await _ask_payment(msg, state)
 
 # --- Шаг 8: Подтверждение ---
 async def _show_confirm(msg: types.Message, state: FSMContext):
     data     = await state.get_data()
-    payments = data.get("payments", {})
+    payments = dict(zip(PAYMENT_COLS, data["payments"]))
 
     pay_sum   = sum(payments.get(c, 0) for c in PAYMENT_COLS[:12])
     surcharge = payments.get("surcharge", 0)
@@ -479,7 +3656,12 @@ async def _show_confirm(msg: types.Message, state: FSMContext):
         text += "\n💳 *Оплаты:*\n" + "\n".join(lines)
     text += f"\n\n💰 *ИТОГО: {total:,}₸*"
 
-    await msg.answer(text, parse_mode="Markdown", reply_markup=confirm_kb)
+    found, row = dup_index.find(data["city"], "Продажи", [data["date"], data["name"], data["shift"]])
+    if found:
+        where = f"строка {row}" if row else "ещё записывается"
+        text += (f"\n\n⚠️ *Отчёт за эту дату и смену уже есть* ({where}).\n"
+                 "♻️ Перезаписать его или ⏭ пропустить?")
+    await msg.answer(text, parse_mode="Markdown", reply_markup=dup_kb if found else confirm_kb)
 
 @dp.message(S.m_confirm)
 async def step_confirm(msg: types.Message, state: FSMContext):
@@ -494,23 +3676,41 @@ async def step_confirm(msg: types.Message, state: FSMContext):
         await msg.answer("🔄 Начнём заново.", reply_markup=main_kb)
         return
 
-    if text == "✅ Записать":
+    if text == "⏭ Пропустить":
+        await state.clear()
+        await msg.answer("⏭ Пропущено — в таблице остаётся прежний отчёт.", reply_markup=main_kb)
+        return
+
+    if text in ("✅ Записать", "♻️ Перезаписать"):
         data     = await state.get_data()
-        payments = data.get("payments", {})
+        at = None
+        if text == "♻️ Перезаписать":
+            found, at = dup_index.find(data["city"], "Продажи",
+                                       [data["date"], data["name"], data["shift"]])
+            if found and at is None:
+                await msg.answer("⏳ Прежний отчёт ещё записывается — попробуйте через минуту.")
+                return
         entry    = {
             "date":   data["date"],
             "name":   data["name"],
             "shift":  data["shift"],
             "leads":  data["leads"],
             "orders": data["orders"],
+            "key":    f"{msg.chat.id}:{msg.message_id}",
         }
-        entry.update(payments)
+        entry.update(zip(PAYMENT_COLS, data["payments"]))
 
-        try:
-            total = write_manager_report(entry, data["city"])
-            conv  = round(data["orders"] / data["leads"] * 100, 1) if data["leads"] > 0 else 0
+        conv = round(data["orders"] / data["leads"] * 100, 1) if data["leads"] > 0 else 0
+
+        async def notify(err: Exception | None):
+            if isinstance(err, RowsMovedError):
+                await msg.answer(f"⚠️ Отчёт не перезаписан: {err}", reply_markup=main_kb)
+                return
+            if err:
+                await msg.answer(f"⚠️ Таблица недоступна: {err}\n{SAVED_NOTE}", reply_markup=main_kb)
+                return
             await msg.answer(
-                f"✅ *Записано!*\n\n"
+                f"✅ *{'Перезаписано' if at else 'Записано'}!*\n\n"
                 f"📍 {data['city']}  |  👤 {data['name']}\n"
                 f"⏰ {data['shift']}  |  📅 {data['date']}\n\n"
                 f"👥 {data['leads']} лидов → {data['orders']} продаж ({conv}%)\n"
@@ -518,6 +3718,15 @@ async def step_confirm(msg: types.Message, state: FSMContext):
                 parse_mode="Markdown",
                 reply_markup=main_kb,
             )
+
+        try:
+            total = await write_manager_report(entry, data["city"], notify, msg.chat.id, at)
+            if total is None:
+                await msg.answer("☑️ Этот отчёт уже принят — повторно не записываю.",
+                                 reply_markup=main_kb)
+            else:
+                await contacts.remember(data["city"], data["name"], data["shift"], msg.chat.id)
+                await msg.answer("⏳ Отчёт принят, записываю в таблицу…", reply_markup=main_kb)
         except Exception as e:
             logging.error(f"Write error: {e}", exc_info=True)
             await msg.answer(f"❌ Ошибка записи: {e}", reply_markup=main_kb)
@@ -531,31 +3740,135 @@ async def step_confirm(msg: types.Message, state: FSMContext):
 # ТЕКСТОВЫЕ СЦЕНАРИИ (флористы, логисты, маркетинг)
 # ============================================================
 
-def parse_schedule(text: str, role: str) -> list[dict]:
+async def _submit_schedule(msg: types.Message, entries: list[dict], city: str, role: str,
+                           overwrite: bool = False, skip_dupes: bool = False):
+    dates = sorted({e["date"] for e in entries})
+    names = sorted({e["name"] for e in entries})
+    half  = sum(1 for e in entries if e.get("shift_type") == "Пол-смены")
+    extra = f"\n⚡ Пол-смен: {half}" if half else ""
+
+    async def notify(err: Exception | None):
+        if isinstance(err, RowsMovedError):
+            await msg.answer(f"⚠️ Смены не перезаписаны ({city}): {err}", reply_markup=main_kb)
+        elif err:
+            await msg.answer(f"⚠️ Смены пока не записаны ({city}): {err}\n{SAVED_NOTE}",
+                             reply_markup=main_kb)
+        else:
+            await msg.answer(f"✅ {count} смен записано!\n📍 {city}{skipped_note}",
+                             reply_markup=main_kb)
+
+    count, skipped = await write_schedule(entries, city, role, notify, msg.chat.id,
+                                          overwrite, skip_dupes)
+    skipped_note = ""
+    if skipped:
+        listed = ", ".join(f"{e['date']} — {e['name']}" for e in skipped[:10])
+        more = f" и ещё {len(skipped) - 10}" if len(skipped) > 10 else ""
+        skipped_note = f"\n⏭ Пропущены дубли ({len(skipped)}): {listed}{more}"
+    if not count:
+        await msg.answer("⏭ Все смены уже в таблице, записывать нечего." + skipped_note,
+                         reply_markup=main_kb)
+        return
+    renamed = dict.fromkeys(f"{e['typed']} → {e['name']}" for e in entries if "typed" in e)
+    if renamed:
+        extra += "\n🔤 Имена приведены: " + "; ".join(renamed)
+    await msg.answer(
+        f"⏳ {count} смен принято, записываю…\n📍 {city}\n"
+        f"📅 {dates[0]}—{dates[-1]}\n👤 {', '.join(names)}{extra}{skipped_note}",
+        reply_markup=main_kb,
+    )
+
+async def _schedule_dupes_or_submit(msg: types.Message, state: FSMContext, entries: list[dict],
+                                    city: str, role: str) -> bool:
+    """Спрашивает, что делать с дублями (True — ждём ответа), или сразу
+    ставит смены в очередь."""
+    sheet = schedule_sheet(role)
+    dupes = [e for e in entries if dup_index.find(city, sheet, schedule_row(e, role))[0]]
+    if not dupes:
+        await _submit_schedule(msg, entries, city, role)
+        return False
+    await state.update_data(entries=entries, role=role)
+    await state.set_state(S.s_dupes)
+    listed = "\n".join(f"  {e['date']} — {e['name']}" for e in dupes[:20])
+    if len(dupes) > 20:
+        listed += f"\n  … и ещё {len(dupes) - 20}"
+    await msg.answer(
+        f"⚠️ Уже есть в таблице ({len(dupes)} из {len(entries)}):\n{listed}\n\n"
+        "♻️ Перезаписать их или ⏭ пропустить дубли?",
+        reply_markup=dup_schedule_kb,
+    )
+    return True
+
+def schedule_entry(date: str, line: str, role: str) -> dict | None:
+    """Одна смена: имя (с пометкой «пол-смены») на дату date."""
+    shift_type = "Полная"
+    name = line.strip()
+    if any(x in name.lower() for x in ["пол-смены", "пол смены", "половина"]):
+        shift_type = "Пол-смены"
+        name = re.sub(r"\s*(пол-смены|пол смены|половина)\s*", "", name,
+                      flags=re.IGNORECASE).strip()
+    if not name:
+        return None
+    e = {"date": date, "name": name, "role": role}
+    if role == "Логист":
+        e["shift_type"] = shift_type
+    return e
+
+def parse_schedule(text: str, role: str, city: str | None = None) -> list[dict]:
+    """Смены из вставки «дата, имена построчно». С city имена приводятся
+    к известным (см. 🔤 ИМЕНА): у заменённых в записи остаётся typed —
+    как ввели, у незнакомых — hints, похожие известные имена."""
     results, current_date = [], None
     for line in text.strip().split("\n"):
         line = line.strip()
         if not line:
             continue
-        if re.match(r"^\d{1,2}\.\d{1,2}(?:\.\d{2,4})?$", line) and len(line) <= 10:
-            current_date = line
-            if len(current_date.split(".")) == 2:
-                current_date += f".{datetime.now().year}"
+        if re.match(DATE_RE, line) and len(line) <= 10:
+            current_date = full_date(line)
             continue
         if current_date:
-            shift_type = "Полная"
-            name = line
-            if any(x in line.lower() for x in ["пол-смены", "пол смены", "половина"]):
-                shift_type = "Пол-смены"
-                name = re.sub(r"\s*(пол-смены|пол смены|половина)\s*", "", line,
-                              flags=re.IGNORECASE).strip()
-            if name:
-                e = {"date": current_date, "name": name, "role": role}
-                if role == "Логист":
-                    e["shift_type"] = shift_type
+            e = schedule_entry(current_date, line, role)
+            if e and city:
+                canonical, hints = name_index.resolve(city, schedule_sheet(role), e["name"])
+                if canonical and canonical != e["name"]:
+                    e["typed"], e["name"] = e["name"], canonical
+                elif hints:
+                    e["hints"] = hints
+            if e:
                 results.append(e)
     return results
 
+MARKETING_FIELDS = ["план", "факт", "$", "продаж", "курс"]
+
+def parse_marketing(text: str) -> tuple[list[tuple], list[tuple[int, str]]]:
+    """Разбирает вставку маркетинга целиком.
+    Возвращает (строки, ошибки), ошибки — [(номер строки, причина)]."""
+    rows, errors = [], []
+    for n, line in enumerate(text.strip().split("\n"), start=1):
+        p = line.strip().split()
+        if not p:
+            continue
+        row, why = marketing_entry(p)
+        if row:
+            rows.append(row)
+        else:
+            errors.append((n, why))
+    return rows, errors
+
+def marketing_entry(p: list[str]) -> tuple[tuple | None, str | None]:
+    """Одна строка маркетинга из полей → (строка, None) или (None, причина)."""
+    if len(p) < 6:
+        return None, f"нужно 6 значений, найдено {len(p)}"
+    d = p[0]
+    if not re.match(DATE_RE, d):
+        return None, "неверная дата"
+    values = []
+    for field, raw, conv in zip(MARKETING_FIELDS, p[1:6], (int, int, float, int, float)):
+        try:
+            values.append(conv(raw.replace(",", ".")) if conv is float else conv(raw))
+        except ValueError:
+            return None, f"«{field}» — не число"
+    return (full_date(d), *values), None
+
 @dp.message(S.text_input)
 async def process_text_input(msg: types.Message, state: FSMContext):
     text = msg.text.strip()
@@ -568,59 +3881,52 @@ async def process_text_input(msg: types.Message, state: FSMContext):
     city   = data["city"]
 
     try:
-        if action == "florist":
-            entries = parse_schedule(text, "Флорист")
+        if action in ("florist", "logist"):
+            role    = "Флорист" if action == "florist" else "Логист"
+            entries = parse_schedule(text, role, city)
             if not entries:
                 await msg.answer("❌ Не распознано.")
                 return
-            count = write_schedule(entries, city, "Флорист")
-            dates = sorted({e["date"] for e in entries})
-            names = sorted({e["name"] for e in entries})
-            await msg.answer(
-                f"✅ {count} смен записано!\n📍 {city}\n"
-                f"📅 {dates[0]}—{dates[-1]}\n👤 {', '.join(names)}",
-                reply_markup=main_kb,
-            )
-
-        elif action == "logist":
-            entries = parse_schedule(text, "Логист")
-            if not entries:
-                await msg.answer("❌ Не распознано.")
+            for i, e in enumerate(entries):
+                e["key"] = f"{msg.chat.id}:{msg.message_id}:{i}"
+            unsure = dict.fromkeys(f"  {e['name']} → {e['hints'][0]}?" for e in entries if "hints" in e)
+            if unsure:
+                await state.update_data(entries=entries, role=role)
+                await state.set_state(S.s_names)
+                await msg.answer(
+                    f"🤔 Этих имён ещё нет в таблице ({city}):\n" + "\n".join(unsure) +
+                    "\n\n🔤 Исправить на предложенные или ✏️ оставить как есть?",
+                    reply_markup=names_kb,
+                )
+                return
+            if await _schedule_dupes_or_submit(msg, state, entries, city, role):
                 return
-            count = write_schedule(entries, city, "Логист")
-            dates = sorted({e["date"] for e in entries})
-            names = sorted({e["name"] for e in entries})
-            half  = sum(1 for e in entries if e.get("shift_type") == "Пол-смены")
-            extra = f"\n⚡ Пол-смен: {half}" if half else ""
-            await msg.answer(
-                f"✅ {count} смен записано!\n📍 {city}\n"
-                f"📅 {dates[0]}—{dates[-1]}\n👤 {', '.join(names)}{extra}",
-                reply_markup=main_kb,
-            )
 
         elif action == "marketing":
-            count = 0
-            for line in text.strip().split("\n"):
-                p = line.strip().split()
-                if len(p) < 6:
-                    continue
-                d = p[0]
-                if len(d.split(".")) == 2:
-                    d += f".{datetime.now().year}"
-                try:
-                    write_marketing(d, int(p[1]), int(p[2]),
-                                    float(p[3]), int(p[4]),
-                                    float(p[5].replace(",", ".")), city)
-                    count += 1
-                except Exception:
-                    continue
-            if not count:
+            rows, errors = parse_marketing(text)
+            rejected = "\n".join(f"  стр. {n}: {why}" for n, why in errors[:20])
+            if len(errors) > 20:
+                rejected += f"\n  … и ещё {len(errors) - 20}"
+            if not rows:
                 await msg.answer(
-                    "❌ Формат: `дата план факт $ продаж курс`",
+                    "❌ Формат: `дата план факт $ продаж курс`"
+                    + (f"\n\nОтклонено:\n{rejected}" if rejected else ""),
                     parse_mode="Markdown",
                 )
                 return
-            await msg.answer(f"✅ {count} строк!\n📍 {city}", reply_markup=main_kb)
+
+            async def notify(err: Exception | None):
+                if err:
+                    await msg.answer(f"⚠️ Маркетинг пока не записан ({city}): {err}\n{SAVED_NOTE}",
+                                     reply_markup=main_kb)
+                else:
+                    await msg.answer(f"✅ {len(rows)} строк!\n📍 {city}", reply_markup=main_kb)
+
+            await write_marketing(rows, city, notify, msg.chat.id)
+            text = f"⏳ {len(rows)} строк принято, записываю…\n📍 {city}"
+            if rejected:
+                text += f"\n\n⚠️ Отклонено {len(errors)}:\n{rejected}"
+            await msg.answer(text, reply_markup=main_kb)
 
     except Exception as e:
         logging.error(f"Error in text_input: {e}", exc_info=True)
@@ -628,12 +3934,392 @@ async def process_text_input(msg: types.Message, state: FSMContext):
 
     await state.clear()
 
+@dp.message(S.s_names)
+async def step_schedule_names(msg: types.Message, state: FSMContext):
+    text = msg.text.strip()
+    if text == "❌ Отмена":
+        await cancel(msg, state)
+        return
+    if text not in ("🔤 Исправить", "✏️ Оставить как есть"):
+        await msg.answer("Нажмите 🔤 Исправить, ✏️ Оставить как есть или ❌ Отмена")
+        return
+    data    = await state.get_data()
+    entries = data["entries"]
+    for e in entries:
+        hints = e.pop("hints", None)
+        if hints and text == "🔤 Исправить":
+            e["typed"], e["name"] = e["name"], hints[0]
+    try:
+        if await _schedule_dupes_or_submit(msg, state, entries, data["city"], data["role"]):
+            return
+    except Exception as e:
+        logging.error(f"Error in schedule names: {e}", exc_info=True)
+        await msg.answer(f"❌ Ошибка: {e}", reply_markup=main_kb)
+    await state.clear()
+
+@dp.message(S.s_dupes)
+async def step_schedule_dupes(msg: types.Message, state: FSMContext):
+    text = msg.text.strip()
+    if text == "❌ Отмена":
+        await cancel(msg, state)
+        return
+    if text not in ("♻️ Перезаписать", "⏭ Пропустить дубли"):
+        await msg.answer("Нажмите ♻️ Перезаписать, ⏭ Пропустить дубли или ❌ Отмена")
+        return
+    data    = await state.get_data()
+    city    = data["city"]
+    role    = data["role"]
+    entries = data["entries"]
+    skip    = text == "⏭ Пропустить дубли"
+    try:
+        await _submit_schedule(msg, entries, city, role, overwrite=not skip, skip_dupes=skip)
+    except Exception as e:
+        logging.error(f"Error in schedule dupes: {e}", exc_info=True)
+        await msg.answer(f"❌ Ошибка: {e}", reply_markup=main_kb)
+    await state.clear()
+
+# ============================================================
+# ⏰  НАПОМИНАНИЯ ОБ ОТЧЁТАХ
+# ============================================================
+# Через REMIND_AFTER минут после конца каждой смены бот пишет менеджерам,
+# которые обычно работают эту смену, но отчёт за неё не сдали. Кто в каком
+# чате и какую смену сдавал последней — запоминаем при каждом отчёте
+# (contacts), сдан ли отчёт — смотрим в индексе дублей (город, дата, имя,
+# смена), без запросов к Sheets. Отчёты, вбитые в таблицу руками, видны
+# после синхронизации копии.
+#
+# Рассылка идёт через telegram_sender: общая корзина токенов на весь бот,
+# не чаще сообщения в TG_CHAT_INTERVAL в один чат, не больше
+# TG_SEND_CONCURRENCY запросов разом, на 429 — пауза retry_after для всех.
+# Лимит взят с запасом от 30 сообщений/с Telegram, чтобы ответы
+# хендлеров (они идут мимо отправителя) не упирались во флуд-контроль.
+
+REMIND_AFTER        = int(os.getenv("REMIND_AFTER", "15"))    # мин после конца смены; <0 — выкл.
+CONTACTS_DB         = os.getenv("CONTACTS_DB", FSM_DB)
+TG_SEND_RPS         = int(os.getenv("TG_SEND_RPS", "20"))      # фоновых сообщений в секунду
+TG_CHAT_INTERVAL    = 1.0      # сек между сообщениями в один чат
+TG_SEND_CONCURRENCY = 4
+TG_SEND_RETRIES     = 3
+
+class TelegramSender:
+    def __init__(self, per_second: int = TG_SEND_RPS, chat_interval: float = TG_CHAT_INTERVAL,
+                 concurrency: int = TG_SEND_CONCURRENCY, retries: int = TG_SEND_RETRIES):
+        self.bucket = TokenBucket(per_second * 60, burst=per_second)
+        self.chat_interval = chat_interval
+        self.retries = retries
+        self._sem = asyncio.Semaphore(concurrency)
+        self._next_at: dict[int, float] = {}     # чат → когда можно следующее
+        self._paused_until = 0.0                 # после 429 ждут все
+
+    async def _slot(self, chat_id: int):
+        now = time.monotonic()
+        at = max(now, self._next_at.get(chat_id, 0.0), self._paused_until)
+        self._next_at[chat_id] = at + self.chat_interval
+        wait = max(at - now, self.bucket.reserve())
+        if wait:
+            await asyncio.sleep(wait)
+
+    async def send(self, chat_id: int, text: str, **kwargs) -> bool:
+        """Отправляет сообщение с учётом лимитов. False — не доставлено."""
+        async with self._sem:
+            for attempt in range(self.retries + 1):
+                await self._slot(chat_id)
+                try:
+                    await bot.send_message(chat_id, text, **kwargs)
+                except TelegramRetryAfter as e:
+                    metrics.inc("telegram_sent_total", outcome="retry_after")
+                    logging.warning(f"Telegram flood control: pause {e.retry_after}s")
+                    self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                    continue
+                except (TelegramForbiddenError, TelegramBadRequest) as e:
+                    metrics.inc("telegram_sent_total", outcome="rejected")
+                    logging.info(f"Telegram send to {chat_id} rejected: {e}")
+                    return False
+                except (TelegramNetworkError, TelegramServerError) as e:
+                    metrics.inc("telegram_sent_total", outcome="error")
+                    logging.warning(f"Telegram send to {chat_id} failed: {e}")
+                    await asyncio.sleep(min(30, 2 ** attempt))
+                    continue
+                metrics.inc("telegram_sent_total", outcome="ok")
+                return True
+            return False
+
+    async def fan_out(self, messages: list[tuple[int, str]]) -> int:
+        """Рассылает (чат, текст), возвращает число доставленных."""
+        results = await asyncio.gather(*(self.send(c, t) for c, t in messages))
+        return sum(results)
+
+telegram_sender = TelegramSender()
+metrics.describe("telegram_sent_total", "Background Telegram messages by outcome")
+
+class Contacts:
+    """(город, имя менеджера) → (чат, последняя сданная смена)."""
+
+    def __init__(self, path: str = CONTACTS_DB):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS contacts ("
+            " city TEXT NOT NULL, name TEXT NOT NULL, chat_id INTEGER NOT NULL,"
+            " shift TEXT, seen REAL, PRIMARY KEY (city, name))"
+        )
+        self._cache: dict[tuple[str, str], tuple[int, str]] = {
+            (c, n): (chat, sh)
+            for c, n, chat, sh in self._db.execute("SELECT city, name, chat_id, shift FROM contacts")
+        }
+
+    async def remember(self, city: str, name: str, shift: str, chat_id: int):
+        key = (city, name.strip())
+        if self._cache.get(key) == (chat_id, shift):
+            return
+        self._cache[key] = (chat_id, shift)
+        await asyncio.to_thread(self._save, *key, chat_id, shift)
+
+    def _save(self, city: str, name: str, chat_id: int, shift: str):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO contacts VALUES (?, ?, ?, ?, ?)",
+                             (city, name, chat_id, shift, time.time()))
+
+    def on_shift(self, city: str, shift: str) -> list[tuple[str, int]]:
+        """(имя, чат) менеджеров города, последней сдававших смену shift.
+        Если у города задан список менеджеров — только из него."""
+        managers = {m.casefold() for m in reference[city].managers}
+        return [(n, chat) for (c, n), (chat, sh) in self._cache.items()
+                if c == city and sh == shift and (not managers or n.casefold() in managers)]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+contacts = Contacts()
+
+def shift_bounds(shift: str) -> tuple[tuple[int, int], tuple[int, int]] | None:
+    """'16:30-01:00' → ((16, 30), (1, 0))."""
+    m = re.fullmatch(r"\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*", shift)
+    if not m:
+        return None
+    h1, m1, h2, m2 = map(int, m.groups())
+    return (h1, m1), (h2, m2)
+
+def next_reminder(now: datetime) -> tuple[datetime, tuple[int, int]] | None:
+    """Ближайший момент напоминания и конец смены, к которому он относится."""
+    ends = {b[1] for c in CITIES for s in reference[c].shifts if (b := shift_bounds(s))}
+    best = None
+    for h, m in ends:
+        at = now.replace(hour=h, minute=m, second=0, microsecond=0) + timedelta(minutes=REMIND_AFTER)
+        while at <= now:
+            at += timedelta(days=1)
+        if best is None or at < best[0]:
+            best = (at, (h, m))
+    return best
+
+def missing_reports(end: datetime) -> list[tuple[int, str]]:
+    """Напоминания по сменам, закончившимся в end: (чат, текст)."""
+    out = []
+    for city in CITIES.values():
+        for shift in reference[city.name].shifts:
+            b = shift_bounds(shift)
+            if not b or b[1] != (end.hour, end.minute):
+                continue
+            # Ночная смена (конец раньше начала) записывается на дату начала
+            day = end - timedelta(days=1) if b[1] < b[0] else end
+            date = day.strftime("%d.%m.%Y")
+            for name, chat_id in contacts.on_shift(city.name, shift):
+                if not dup_index.find(city.name, "Продажи", [date, name, shift])[0]:
+                    out.append((chat_id, f"📝 {name}, смена {shift} за {date} закончилась, "
+                                         f"а отчёта ({city.name}) пока нет.\n"
+                                         "Нажмите «📊 Отчёт менеджера»."))
+    return out
+
+async def reminder_loop():
+    if REMIND_AFTER < 0:
+        return
+    await sheets_ready.wait()
+    while (nxt := next_reminder(datetime.now())) is not None:
+        at, (h, m) = nxt
+        await asyncio.sleep(max(0.0, (at - datetime.now()).total_seconds()))
+        try:
+            end = at - timedelta(minutes=REMIND_AFTER)
+            messages = missing_reports(end)
+            if messages:
+                sent = await telegram_sender.fan_out(messages)
+                logging.info(f"Reminders for {h}:{m:02d}: {sent}/{len(messages)} sent")
+        except Exception as e:
+            logging.error(f"Reminder error: {e}", exc_info=True)
+        await asyncio.sleep(1)     # не сработать дважды в ту же секунду
+
 # ============================================================
 # 🏁  ЗАПУСК
 # ============================================================
+def _replayed_notify(chat_id: int | None, sheet: str, n_rows: int) -> Notify:
+    async def notify(err: Exception | None):
+        if err is None and chat_id:
+            await telegram_sender.send(chat_id, f"✅ Записано после повтора: {sheet} ({n_rows} стр.)")
+    return notify
+
+async def replay_journal() -> int:
+    """Ставит в очередь незаписанные записи журнала порциями, пропуская те,
+    что уже в очереди. Возвращает количество поставленных записей."""
+    n, after = 0, 0
+    while True:
+        entries = await asyncio.to_thread(journal.pending, after)
+        if not entries:
+            return n
+        for jid, city, sheet, rows, chat_id, at, undo in entries:
+            after = jid
+            if jid in write_queue.inflight:
+                continue
+            if city not in CITIES:
+                logging.warning(f"Journal entry {jid}: city {city!r} is not in the registry, skipped")
+                continue
+            await write_queue.submit(city, sheet, rows, _replayed_notify(chat_id, sheet, len(rows)),
+                                     chat_id, jid=jid, at=at, undo=undo)
+            n += 1
+
+async def journal_retry_loop():
+    while True:
+        await asyncio.sleep(JOURNAL_RETRY)
+        try:
+            n = await replay_journal()
+            if n:
+                logging.info(f"Journal retry: {n} entries requeued")
+        except Exception as e:
+            logging.error(f"Journal retry error: {e}", exc_info=True)
+
+_background: set[asyncio.Task] = set()
+_metrics_runner: web.AppRunner | None = None
+
+async def on_startup():
+    global _metrics_runner
+    write_queue.start()
+    _background.add(asyncio.create_task(sheets_warmup(), name="sheets-warmup"))
+    try:
+        _metrics_runner = await serve_metrics()
+    except OSError as e:
+        logging.warning(f"Metrics server not started: {e}")
+    pruned = await asyncio.to_thread(journal.prune)
+    n = await replay_journal()
+    logging.info(f"Journal: {n} pending entries replayed, {pruned} old entries pruned")
+    pruned = await asyncio.to_thread(history.prune)
+    if pruned:
+        logging.info(f"History: {pruned} old submissions pruned")
+    _background.add(asyncio.create_task(journal_retry_loop(), name="journal-retry"))
+    _background.add(asyncio.create_task(fsm_storage.evict_loop(), name="fsm-evict"))
+    _background.add(asyncio.create_task(replica.sync_loop(), name="replica-sync"))
+    _background.add(asyncio.create_task(rollups.flush_loop(), name="rollups-flush"))
+    _background.add(asyncio.create_task(reminder_loop(), name="reminders"))
+    _background.add(asyncio.create_task(reference.refresh_loop(), name="reference-refresh"))
+    logging.info(f"Startup: ready in {time.perf_counter() - STARTED_AT:.2f}s")
+
+async def on_shutdown():
+    for t in _background:
+        t.cancel()
+    _background.clear()
+    # Дописываем всё, что успели принять, пока сессия бота ещё открыта
+    await write_queue.close()
+    try:
+        await rollups.flush()
+    except Exception as e:
+        logging.warning(f"Rollups final flush failed: {e}")
+    await sheets_api.close()
+    journal.close()
+    replica.close()
+    history.close()
+    contacts.close()
+    if _metrics_runner:
+        await _metrics_runner.cleanup()
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
+# ---------- вебхук ----------
+# BOT_MODE=webhook поднимает aiohttp-сервер на PORT и принимает апдейты на
+# WEBHOOK_PATH. Каждый апдейт обрабатывается в отдельной задаче, но не более
+# WEBHOOK_MAX_INFLIGHT одновременно: сверх лимита запрос ждёт слот, и
+# Telegram сам притормаживает. Если WEBHOOK_URL не задан, вебхук в Telegram
+# не регистрируется — удобно для локальной проверки:
+#   curl -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \
+#        -d @update.json localhost:8080/webhook
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    def __init__(self, *args, max_inflight: int = WEBHOOK_MAX_INFLIGHT, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._slots = asyncio.Semaphore(max_inflight)
+        self._closing = False
+
+    @property
+    def inflight(self) -> int:
+        return len(self._background_feed_update_tasks)
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        if self._closing:
+            return web.Response(status=503, text="Shutting down")
+        await self._slots.acquire()
+        try:
+            return await super()._handle_request_background(bot, request)
+        except Exception:
+            self._slots.release()
+            return web.Response(status=400, text="Bad update")
+
+    async def _background_feed_update(self, bot: Bot, update: dict[str, Any]) -> None:
+        try:
+            await super()._background_feed_update(bot, update)
+        except Exception as e:
+            logging.error(f"Update error: {e}", exc_info=True)
+        finally:
+            self._slots.release()
+
+    async def close(self) -> None:
+        """Перестаёт принимать апдейты и дожидается тех, что уже в работе.
+        Сессию бота закрывает on_cleanup — после того как допишется очередь."""
+        self._closing = True
+        if self._background_feed_update_tasks:
+            await asyncio.gather(*self._background_feed_update_tasks, return_exceptions=True)
+
+def build_webhook_app() -> web.Application:
+    app = web.Application()
+    handler = BoundedRequestHandler(dp, bot, secret_token=WEBHOOK_SECRET or None)
+    # Порядок важен: сначала дожидаемся апдейтов, потом dp.shutdown (очередь записи)
+    handler.register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    async def close_session(_app):
+        await bot.session.close()
+    app.on_cleanup.append(close_session)
+    return app
+
+async def run_webhook():
+    app = build_webhook_app()
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", WEBHOOK_PORT).start()
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=min(WEBHOOK_MAX_INFLIGHT, 100),
+        )
+    logging.info(f"Webhook server listening on :{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        logging.info("Webhook server stopping...")
+        await runner.cleanup()
+
 async def main():
-    logging.info("🌸 Flower Dashboard Bot v4.0 starting...")
-    await dp.start_polling(bot)
+    logging.info(f"🌸 Flower Dashboard Bot v4.0 starting "
+                 f"(imports {time.perf_counter() - STARTED_AT:.2f}s)...")
+    if BOT_MODE == "webhook":
+        await run_webhook()
+    else:
+        await dp.start_polling(bot)
 
 if __name__ == "__main__":
     asyncio.run(main())